@@ -1,33 +1,112 @@
-from flask import Flask, request, jsonify
-from google.cloud import storage, texttospeech
+from flask import Flask, Response, request, jsonify, stream_with_context
+from google.cloud import storage
+from google.cloud import texttospeech_v1beta1 as texttospeech
 import os
-from openai import OpenAI
 from dotenv import load_dotenv
 import json
 import uuid
 import random
 import requests
+import time
+import tempfile
+import threading
+from stage_scheduler import StageScheduler
+from tts import EAGER_VOICES, UPLOAD_CHUNK_SIZE, VOICES_BY_KEY, SpeechRenderer, voice_blob_name, voice_language
+from audio_cache import AudioCache
+from story_document import StoryDocument
+from languages import STORY_LANGUAGES, TARGET_LANGUAGES
+import translation
+import image_variants
+from completion_cache import CompletionCache
+from checkpoint import StoryCheckpoint
+import metrics
+import rate_limit
+import story_store
+import clients
+import idempotency
+from idempotency import IdempotencyConflict, IdempotentRequests
+from jobs import JobQueue, QueueFull
+from catalog import image_variant_blobs, make_entry, record_story
 
 app = Flask(__name__)
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Verify the environment variable is loaded correctly
-credentials_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-print("GOOGLE_APPLICATION_CREDENTIALS:", credentials_path)
-
-# Set up Cloud Storage
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = credentials_path
-storage_client = storage.Client()
 bucket_name = 'storytellerbucket'
-bucket = storage_client.bucket(bucket_name)
 
-# Set up OpenAI
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Set STORYTELLER_FAKE_BACKENDS to run against the in-process fakes in fakes.py
+FAKE_BACKENDS = os.getenv("STORYTELLER_FAKE_BACKENDS", "").lower() in ('1', 'true', 'yes')
+
+if FAKE_BACKENDS:
+    import fakes
+    bucket, client, tts_client, fake_http_session = fakes.backends_from_env(bucket_name)
+else:
+    # Verify the environment variable is loaded correctly
+    credentials_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+    print("GOOGLE_APPLICATION_CREDENTIALS:", credentials_path)
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = credentials_path
+
+    def create_openai_client():
+        from openai import OpenAI  # Imported here, the openai package is slow to import
+        # Retries are left to rate_limit.py, which shares what it learns from them across threads
+        return OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+    # The clients are created on first use (or by the warm-up when run as a server)
+    bucket = clients.register("bucket", lambda: storage.Client().bucket(bucket_name))
+    client = clients.register("openai", create_openai_client)
+    tts_client = clients.register("tts", texttospeech.TextToSpeechClient)
+
+# Metrics exposed on /metrics
+openai_request_seconds = metrics.histogram("storyteller_openai_request_seconds", "Latency of OpenAI requests")
+gcs_upload_seconds = metrics.histogram("storyteller_gcs_upload_seconds", "Time spent uploading to Cloud Storage")
+bytes_transferred_total = metrics.counter("storyteller_bytes_transferred_total", "Bytes uploaded to Cloud Storage")
+pipeline_seconds = metrics.histogram("storyteller_pipeline_seconds", "End-to-end story pipeline latency")
+pipelines_in_flight = metrics.gauge("storyteller_pipelines_in_flight", "Story pipelines currently running")
+
+# Opt-in cache of chat completions, enabled by setting COMPLETION_CACHE_PATH
+completion_cache = None
+if os.getenv("COMPLETION_CACHE_PATH"):
+    completion_cache = CompletionCache(
+        os.getenv("COMPLETION_CACHE_PATH"),
+        max_bytes=int(os.getenv("COMPLETION_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+        ttl_seconds=int(os.getenv("COMPLETION_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+    )
 
-# Set up Google Text-to-Speech
-tts_client = texttospeech.TextToSpeechClient()
+# Pooled HTTP session for downloading generated images
+if FAKE_BACKENDS:
+    http_session = fake_http_session
+else:
+    http_session = requests.Session()
+    http_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=int(os.getenv("HTTP_POOL_SIZE", "16"))))
+
+# Rendered audio is cached by content so that re-renders skip the TTS API.
+# Opening it scans the cache directory, so that is deferred to first use too.
+tts_cache = clients.register("tts_cache", lambda: AudioCache(
+    os.getenv("TTS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "storyteller-tts-cache")),
+    max_bytes=int(os.getenv("TTS_CACHE_MAX_BYTES", str(512 * 1024 * 1024))),
+    bucket=bucket if os.getenv("TTS_CACHE_GCS", "").lower() in ('1', 'true', 'yes') else None
+))
+speech = SpeechRenderer(tts_client, bucket, tts_cache)
+
+# Background workers for asynchronous /generate-story requests
+job_queue = JobQueue(
+    max_workers=int(os.getenv("JOB_WORKERS", "4")),
+    max_queue_depth=int(os.getenv("JOB_QUEUE_DEPTH", "32")),
+    retention_seconds=int(os.getenv("JOB_RETENTION_SECONDS", "3600"))
+)
+
+# Requests with an Idempotency-Key return the first request's story for this long
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))
+idempotent_requests = IdempotentRequests(
+    IDEMPOTENCY_TTL_SECONDS,
+    max_keys=int(os.getenv("IDEMPOTENCY_MAX_KEYS", "1000"))
+)
+# The request and job of every asynchronous request with an Idempotency-Key, by key
+idempotent_jobs = {}
+idempotent_jobs_lock = threading.Lock()
+
+SUPPORTED_GENRES = ("fantasy", "sci-fi")
 
 # List of generic fantasy protagonists
 fantasy_protagonists = [
@@ -82,103 +161,105 @@ sci_fi_location_names = [
     "Quantum Peaks", "Nebula Quay", "Starfall Ridge", "Photon Bay", "Stellar Springs",
     "Orion's Harbor", "Cosmic Heights", "Asteroid Shores", "Galactic Nexus", "Pulsar Haven"
 ]
-def generate_story(prompt, system_message, protagonist):
+def story_messages(prompt, system_message, protagonist):
     unique_context = f"This is a story about {protagonist}."
     full_prompt = f"{prompt} {unique_context}"
-    
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": f"{system_message} Make sure this is suitable for children."},
-            {"role": "user", "content": full_prompt}
-        ],
+    return [
+        {"role": "system", "content": f"{system_message} Make sure this is suitable for children."},
+        {"role": "user", "content": full_prompt}
+    ]
+
+def complete_chat(messages, max_tokens, operation, temperature=None, seed=None, cacheable=True):
+    """Return the text of a gpt-4o chat completion, going through the completion cache if enabled.
+
+    operation names the call in the latency metrics.
+    """
+    request = {"model": "gpt-4o", "messages": messages, "max_tokens": max_tokens}
+    if temperature is not None:
+        request["temperature"] = temperature
+    if seed is not None:
+        request["seed"] = seed
+
+    use_cache = completion_cache is not None and cacheable
+    if use_cache:
+        cache_key = CompletionCache.key("gpt-4o", messages, max_tokens, temperature, seed)
+        content = completion_cache.get(cache_key)
+        if content is not None:
+            return content
+
+    def create():
+        with openai_request_seconds.time(operation=operation):
+            return client.chat.completions.create(**request)
+
+    response = rate_limit.call("openai", create)
+    content = response.choices[0].message.content
+    if use_cache:
+        completion_cache.put(cache_key, content)
+    return content
+
+def generate_story(prompt, system_message, protagonist, seed=None):
+    # Stories are only replayed from the cache when a seed is requested
+    content = complete_chat(
+        story_messages(prompt, system_message, protagonist),
         max_tokens=2500,
+        operation="story",
         temperature=0.7,
-        stop=None
+        seed=seed,
+        cacheable=seed is not None
     )
-    content = response.choices[0].message.content
     return add_ssml_anchors(content)
 
+def stream_story(prompt, system_message, protagonist):
+    """Yield the raw story paragraphs as soon as each one is complete.
+
+    Joining the yielded paragraphs with blank lines gives back the full story text.
+    """
+    # Not retried: paragraphs may already have been yielded when the stream fails
+    with rate_limit.slot("openai"), openai_request_seconds.time(operation="story_stream"):
+        stream = client.chat.completions.create(
+            model="gpt-4o",
+            messages=story_messages(prompt, system_message, protagonist),
+            max_tokens=2500,
+            temperature=0.7,
+            stop=None,
+            stream=True
+        )
+        buffer = ""
+        for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            buffer += chunk.choices[0].delta.content
+            while "\n\n" in buffer:
+                paragraph, buffer = buffer.split("\n\n", 1)
+                yield paragraph
+        yield buffer
+
+def summary_messages(story):
+    return [
+        {"role": "system", "content": "You are a summarizer."},
+        {"role": "user", "content": f"Summarize the following story in a concise manner:\n\n{story}"}
+    ]
+
 def summarize_story(story):
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "You are a summarizer."},
-            {"role": "user", "content": f"Summarize the following story in a concise manner:\n\n{story}"}
-        ],
-        max_tokens=100
-    )
-    summary = response.choices[0].message.content
+    summary = complete_chat(summary_messages(story), max_tokens=100, operation="summary")
     return summary
 
-def translate_story(story):
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "You are a translator."},
-            {"role": "user", "content": f"Translate the following story to Turkish. When you encounter names, translate them phonetically so they are pronounceable in Turkish. For example, 'Sir Alaric' should become 'Sör Alarik':\n\n{story}"}
-        ],
-        max_tokens=2500
-    )
-    translated_content = response.choices[0].message.content
-    return add_ssml_anchors(translated_content)
+def build_glossary(story, languages=TARGET_LANGUAGES):
+    """Translate the names in a story (SSML) to every language, for consistent names across translate_story calls."""
+    text = "\n\n".join(paragraph.text for paragraph in StoryDocument.from_ssml(story).paragraphs)
+    content = complete_chat(translation.glossary_messages(text, languages), max_tokens=800, operation="glossary")
+    return translation.parse_glossary(content, languages)
 
-def add_ssml_anchors(text):
-    paragraphs = text.split("\n\n")
-    ssml = "<speak>"
-    for i, paragraph in enumerate(paragraphs):
-        ssml += f'<p>{paragraph}</p>'
-        ssml += f'<mark name="page_{i+1}"/>'
-    ssml += "</speak>"
-    return ssml.replace(".", ".<break time='700ms'/>")
-
-def chunk_text_to_ssml(text, max_size=5000):
-    """Splits text into SSML-valid chunks of specified byte size."""
-    current_chunk = []
-    current_size = len('<speak>') + len('</speak>')  # Account for <speak> and </speak> tags
-    
-    for paragraph in text.split('<p>'):
-        paragraph = paragraph.strip()
-        paragraph_ssml = f"<p>{paragraph}</p>"
-        paragraph_bytes = len(paragraph_ssml.encode('utf-8'))
-        
-        if current_size + paragraph_bytes > max_size:
-            yield f"<speak>{''.join(current_chunk)}</speak>"
-            current_chunk = []
-            current_size = len('<speak>') + len('</speak>')
-        
-        current_chunk.append(paragraph_ssml)
-        current_size += paragraph_bytes
-    
-    if current_chunk:
-        yield f"<speak>{''.join(current_chunk)}</speak>"
-
-def synthesize_speech(ssml_text, language_code, name, gender):
-    chunks = chunk_text_to_ssml(ssml_text, max_size=5000)
-    audio_contents = []
-    
-    for chunk in chunks:
-        synthesis_input = texttospeech.SynthesisInput(ssml=chunk)
-        voice = texttospeech.VoiceSelectionParams(
-            language_code=language_code,
-            name=name,
-            ssml_gender=gender
-        )
-        audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.MP3,
-            speaking_rate=0.9  # Adjust speaking rate to slow down the speech
-        )
-        response = tts_client.synthesize_speech(
-            input=synthesis_input, voice=voice, audio_config=audio_config
-        )
-        audio_contents.append(response.audio_content)
-    
-    return b"".join(audio_contents)  # Concatenate all audio parts into a single byte stream
+def complete_translation(messages, max_tokens):
+    return complete_chat(messages, max_tokens=max_tokens, operation="translation")
 
-def upload_to_gcs(content, file_path):
-    blob = bucket.blob(file_path)
-    blob.upload_from_string(content, content_type='audio/mpeg' if file_path.endswith('.mp3') else 'image/png')
-    return blob.public_url
+def translate_story(story, language="tr", glossary=None):
+    """Translate a story (SSML) to language, a few paragraphs per concurrent request (see translation.py)."""
+    document = StoryDocument.from_ssml(story)
+    return translation.translate_document(document, language, glossary or {}, complete_translation).to_ssml()
+
+def add_ssml_anchors(text):
+    return StoryDocument.from_text(text).to_ssml()
 
 def extract_key_points(story, num_points=3):
     sentences = story.split('. ')
@@ -188,109 +269,393 @@ def extract_key_points(story, num_points=3):
     return [sentences[i*step] for i in range(num_points)]
 
 def generate_image(prompt, char_profile):
-    response = client.images.generate(
-        model="dall-e-3",
-        prompt=f"{prompt} Character profile: {char_profile}. The image should not contain any text, writing, or captions.",
-        n=1,
-        size="1024x1024"
-    )
+    def create():
+        with openai_request_seconds.time(operation="image"):
+            return client.images.generate(
+                model="dall-e-3",
+                prompt=f"{prompt} Character profile: {char_profile}. The image should not contain any text, writing, or captions.",
+                n=1,
+                size="1024x1024"
+            )
+
+    response = rate_limit.call("dalle", create)
     return response.data[0].url
 
-def generate_and_store_story_content(prompt, title, tags, genre):
-    # Select protagonist and location based on genre
+# extract_key_points yields at most this many points, so at most this many images
+NUM_IMAGES = 3
+
+def transfer_image(url, file_path):
+    """Stream a generated image into Cloud Storage without buffering it whole."""
+    with gcs_upload_seconds.time(kind="image"), http_session.get(url, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        blob = bucket.blob(file_path, chunk_size=UPLOAD_CHUNK_SIZE)
+        blob.upload_from_file(response.raw, content_type='image/png')
+    bytes_transferred_total.inc(blob.size or 0, kind="image")
+    return blob.public_url
+
+def store_image_variants(file_path):
+    """Store resized, compressed variants of a stored image next to it.
+
+    Returns the width, format and URL of every variant.
+    """
+    variants = []
+    for width, fmt, data in image_variants.encode(bucket.blob(file_path).download_as_bytes()):
+        blob = bucket.blob(image_variants.variant_blob_name(file_path, width, fmt))
+        with gcs_upload_seconds.time(kind="image_variant"):
+            blob.upload_from_string(data, content_type=image_variants.FORMATS[fmt][2])
+        bytes_transferred_total.inc(len(data), kind="image_variant")
+        variants.append({"width": width, "format": fmt, "url": blob.public_url})
+    return variants
+
+class StoryPipelineError(Exception):
+    """A story pipeline failed; its completed stages can be resumed with resume_story_content."""
+
+    def __init__(self, genre, story_id, cause):
+        super().__init__(f"Story {genre}/{story_id} failed: {cause}")
+        self.genre = genre
+        self.story_id = story_id
+
+def choose_setting(genre, seed=None):
+    """Select protagonist and location based on genre, or (None, None) for unsupported genres.
+
+    The same seed always selects the same setting.
+    """
+    rng = random.Random(seed) if seed is not None else random
     if genre == "fantasy":
-        protagonist = random.choice(fantasy_protagonists)
-        location = random.choice(fantasy_land_names)
+        return rng.choice(fantasy_protagonists), rng.choice(fantasy_land_names)
     elif genre == "sci-fi":
-        protagonist = random.choice(sci_fi_protagonists)
-        location = random.choice(sci_fi_location_names)
-    else:
+        return rng.choice(sci_fi_protagonists), rng.choice(sci_fi_location_names)
+    return None, None
+
+def generate_and_store_story_content(prompt, title, tags, genre, progress=None,
+                                     protagonist=None, location=None, content_en=None,
+                                     translations=None, summary=None, seed=None, story_id=None, trace=False):
+    """Generate a story with its translations, images and audio and store it all.
+
+    The story is translated to every language in TARGET_LANGUAGES.
+    protagonist and location are chosen at random unless given. content_en
+    (the story as SSML), translations (SSML by language code) and summary
+    are used instead of being generated when given. A seed selects replay mode: the same request with
+    the same seed replays the same setting and (cached) story text.
+
+    Stage outputs are checkpointed under the story's directory. Passing the
+    story_id of an unfinished story continues it from its checkpoints; if the
+    pipeline fails, a StoryPipelineError carries the story_id to resume.
+
+    With trace=True the result includes the timing of every stage and the
+    pipeline's critical path.
+    """
+    if protagonist is None:
+        protagonist, location = choose_setting(genre, seed)
+    if protagonist is None:
         return {"error": "Unsupported genre"}
 
+    pipeline_request = {
+        "prompt": prompt, "title": title, "tags": tags, "genre": genre,
+        "protagonist": protagonist, "location": location, "seed": seed
+    }
+
     # Update prompt with selected location
     prompt = prompt.format(location)
     char_profile = f"Main character: {protagonist}"
 
-    # Generate a unique ID for the story
-    story_id = str(uuid.uuid4())
+    # Generate a unique ID for the story, unless an unfinished one is resumed
+    checkpoint = StoryCheckpoint(bucket, genre, story_id) if story_id else None
+    completed = checkpoint.completed() if checkpoint else {}
+    story_id = story_id or str(uuid.uuid4())
+    checkpoint = checkpoint or StoryCheckpoint(bucket, genre, story_id)
+    image_path_template = f'stories/{genre}/{story_id}/images/image_{{}}.png'
 
-    # Generate English story content
-    content_en = generate_story(prompt, "You are a storyteller.", protagonist)
-    
-    # Translate English story content to Turkish
-    content_tr = translate_story(content_en)
-
-    # Summarize the story
-    summary = summarize_story(content_en)
-
-    # Extract key points
-    key_points = extract_key_points(summary)
-
-    # Generate images for each key point
-    image_urls = []
-    for point in key_points:
-        image_url = generate_image(point, char_profile)
-        image_urls.append(image_url)
-
-    # Store images in Cloud Storage
-    image_paths = []
-    for i, url in enumerate(image_urls):
-        response = requests.get(url)
-        file_path = f'stories/{genre}/{story_id}/images/image_{i+1}.png'
-        blob = bucket.blob(file_path)
-        blob.upload_from_string(response.content, content_type='image/png')
-        image_paths.append(blob.public_url)
-
-    # Add anchors to the story text
-    content_en_with_anchors = insert_image_tags(content_en, image_paths)
-    content_tr_with_anchors = insert_image_tags(content_tr, image_paths)
-
-    # Define TTS voices and generate TTS for English and Turkish stories
-    voices = [
-        {"name": "en-US-Wavenet-D", "gender": texttospeech.SsmlVoiceGender.MALE, "age": "young_man"},
-        {"name": "en-GB-Wavenet-A", "gender": texttospeech.SsmlVoiceGender.FEMALE, "age": "young_woman"},
-        {"name": "en-GB-Wavenet-D", "gender": texttospeech.SsmlVoiceGender.MALE, "age": "old_man"},
-        {"name": "en-US-Wavenet-C", "gender": texttospeech.SsmlVoiceGender.FEMALE, "age": "old_woman"},
-        {"name": "tr-TR-Wavenet-B", "gender": texttospeech.SsmlVoiceGender.MALE, "age": "young_man"},  # Corrected
-        {"name": "tr-TR-Wavenet-C", "gender": texttospeech.SsmlVoiceGender.FEMALE, "age": "young_woman"},  # Corrected
-        {"name": "tr-TR-Wavenet-E", "gender": texttospeech.SsmlVoiceGender.MALE, "age": "old_man"},
-        {"name": "tr-TR-Wavenet-D", "gender": texttospeech.SsmlVoiceGender.FEMALE, "age": "old_woman"}  # Corrected
-        
-    ]
-
-    tts_urls = {}
-    for voice in voices:
-        language_code = voice['name'][:5]
-        content = content_en_with_anchors if "en-" in voice['name'] else content_tr_with_anchors
-        tts_audio = synthesize_speech(content, language_code, voice['name'], voice['gender'])
-        directory = "en" if "en-" in voice['name'] else "tr"
-        file_path = f'stories/{genre}/{story_id}/{directory}/{voice["age"]}.mp3'
-        tts_urls[f'{voice["age"]}_{directory}'] = upload_to_gcs(tts_audio, file_path)
+    # Every stage starts as soon as the stages it depends on are done, so the
+    # story latency is the critical path (story -> translation -> TTS) rather
+    # than the sum of all the calls.
+    scheduler = StageScheduler(listener=progress, checkpoint=checkpoint)
 
-    # Store story content and TTS URLs in Cloud Storage
+    # Generate English story content
+    if content_en is None:
+        scheduler.add("content_en", lambda: generate_story(prompt, "You are a storyteller.", protagonist, seed=seed),
+                      checkpoint=True)
+    else:
+        scheduler.add("content_en", lambda: content_en, checkpoint=True)
+
+    # Translations and summary all only need the English story. Names are
+    # translated first, so that every part of a translation uses the same ones.
+    translations = translations or {}
+    missing = [language for language in TARGET_LANGUAGES if language not in translations]
+    if missing:
+        scheduler.add("glossary", lambda story: build_glossary(story, missing), deps=["content_en"], checkpoint=True)
+    for language in TARGET_LANGUAGES:
+        if language in translations:
+            scheduler.add(f"content_{language}", lambda language=language: translations[language], checkpoint=True)
+        else:
+            def translate(story, glossary, language=language):
+                return translate_story(story, language, glossary.get(language))
+
+            scheduler.add(f"content_{language}", translate, deps=["content_en", "glossary"], checkpoint=True)
+    if summary is None:
+        scheduler.add("summary", summarize_story, deps=["content_en"], checkpoint=True)
+    else:
+        scheduler.add("summary", lambda: summary, checkpoint=True)
+    scheduler.add("key_points", extract_key_points, deps=["summary"], checkpoint=True)
+
+    # Image URLs are known as soon as we know how many images there will be,
+    # so the text (and therefore TTS) does not wait for the images themselves.
+    def image_paths_for(key_points):
+        return [bucket.blob(image_path_template.format(i + 1)).public_url for i in range(len(key_points))]
+
+    scheduler.add("image_paths", image_paths_for, deps=["key_points"])
+
+    # Generate each image and store it in Cloud Storage independently
+    image_stages = []
+    variant_stages = []
+    for i in range(NUM_IMAGES):
+        def generate_nth_image(key_points, i=i):
+            if i >= len(key_points):
+                return None
+            return generate_image(key_points[i], char_profile)
+
+        def transfer_nth_image(url, i=i):
+            if url is None:
+                return None
+            return transfer_image(url, image_path_template.format(i + 1))
+
+        scheduler.add(f"image_{i+1}", generate_nth_image, deps=["key_points"])
+        # The generated image URLs expire, so only the stored images are checkpointed
+        scheduler.add(f"image_{i+1}_upload", transfer_nth_image, deps=[f"image_{i+1}"], provider="gcs", checkpoint=True)
+        image_stages.append(f"image_{i+1}_upload")
+
+        def store_nth_image_variants(url, i=i):
+            if url is None:
+                return None
+            return store_image_variants(image_path_template.format(i + 1))
+
+        # Encoding happens on the image process pool; the stage thread only waits for it
+        scheduler.add(f"image_{i+1}_variants", store_nth_image_variants, deps=[f"image_{i+1}_upload"], checkpoint=True)
+        variant_stages.append(f"image_{i+1}_variants")
+
+    # Parse each language once; the stored text and the TTS chunks are both rendered from it
+    for directory in STORY_LANGUAGES:
+        scheduler.add(f"document_{directory}", StoryDocument.from_ssml, deps=[f"content_{directory}"])
+        scheduler.add(f"content_{directory}_with_anchors", lambda document, image_paths: document.to_html(image_paths),
+                      deps=[f"document_{directory}", "image_paths"])
+        scheduler.add(f"tts_chunks_{directory}", lambda document: document.tts_chunks(), deps=[f"document_{directory}"])
+
+    # Generate TTS for the eager voices only; the story API renders the others on first request
+    tts_stages = {}
+    tts_blobs = {}
+    for key in EAGER_VOICES:
+        voice = VOICES_BY_KEY[key]
+        if voice_language(voice) not in STORY_LANGUAGES:
+            continue
+        file_path = voice_blob_name(genre, story_id, voice)
+
+        def synthesize_voice(chunks, voice=voice, file_path=file_path):
+            return speech.render_voice(chunks, voice, file_path)
+
+        # TTS concurrency is limited per chunk inside synthesize_chunk
+        scheduler.add(f"tts_{key}", synthesize_voice, deps=[f"tts_chunks_{voice_language(voice)}"], checkpoint=True)
+        tts_stages[key] = f"tts_{key}"
+        tts_blobs[key] = file_path
+
+    checkpoint.start(pipeline_request, scheduler.checkpointed_stages())
+    try:
+        with pipelines_in_flight.track(), pipeline_seconds.time():
+            results = scheduler.run(completed)
+    except Exception as e:
+        checkpoint.finish("failed", str(e))
+        raise StoryPipelineError(genre, story_id, e) from e
+
+    contents = {f"content_{language}": results[f"content_{language}_with_anchors"] for language in STORY_LANGUAGES}
+    image_paths = [results[stage] for stage in image_stages if results[stage] is not None]
+    variants = [results[stage] for stage in variant_stages if results[stage] is not None]
+    tts_urls = {key: results[stage]["url"] for key, stage in tts_stages.items()}
+
+    # Store story content and TTS URLs in Cloud Storage (see story_store.py for the layout).
+    # The page index of each voice is stored next to its audio by render_voice.
     story_data = {
         'title': title,
-        'content_en': content_en_with_anchors,
-        'content_tr': content_tr_with_anchors,
+        **contents,
         'tags': tags,
         'genre': genre,
+        'summary': results["summary"],
         'tts_urls': tts_urls,
-        'image_urls': image_paths
+        'image_urls': image_paths,
+        'image_variants': variants
     }
-    story_blob = bucket.blob(f'stories/{genre}/{story_id}/story_data.json')
-    story_blob.upload_from_string(json.dumps(story_data), content_type='application/json')
-
+    with gcs_upload_seconds.time(kind="story_data"):
+        story_blob = story_store.write_story(bucket, f'stories/{genre}/{story_id}/', story_data)
+
+    # Make the story visible to the story API's catalog
+    image_blobs = [image_path_template.format(i + 1) for i in range(len(image_paths))]
+    record_story(bucket, make_entry(story_id, title, genre, tags, story_blob, image_blobs, tts_blobs,
+                                    image_variant_blobs(variants), STORY_LANGUAGES))
+    checkpoint.finish("complete")
+
+    result = story_result(story_id, story_data)
+    if trace:
+        result["trace"] = scheduler.trace()
+    return result
+
+def story_result(story_id, story_data):
+    """The response to a request for a story, from its story_data (as stored, see story_store.py)."""
     return {
         "story_id": story_id,
-        "title": title,
-        "content_en": content_en_with_anchors,
-        "content_tr": content_tr_with_anchors,
-        "tags": tags,
-        "genre": genre,
-        "tts_urls": tts_urls,
-        "image_urls": image_paths
+        "title": story_data["title"],
+        **{key: value for key, value in story_data.items() if key.startswith('content_')},
+        "tags": story_data.get("tags", []),
+        "genre": story_data["genre"],
+        "tts_urls": story_data.get("tts_urls", {}),
+        "image_urls": story_data.get("image_urls", [])
     }
 
+def resume_story_content(genre, story_id, progress=None):
+    """Continue an unfinished story from its last completed stages."""
+    checkpoint = StoryCheckpoint(bucket, genre, story_id)
+    manifest = checkpoint.load_manifest()
+    if manifest is None:
+        return {"error": "Unknown story"}
+
+    if manifest.get("status") == "complete":
+        story_data = story_store.read_story(bucket, story_store.find_story(bucket, checkpoint.prefix))
+        return story_result(story_id, story_data)
+
+    pipeline_request = manifest["request"]
+    return generate_and_store_story_content(
+        pipeline_request["prompt"], pipeline_request["title"], pipeline_request["tags"], genre,
+        progress=progress, protagonist=pipeline_request["protagonist"], location=pipeline_request["location"],
+        seed=pipeline_request.get("seed"), story_id=story_id
+    )
+
+def checkpoint_story_text(prompt, title, tags, genre, protagonist, location, content_en):
+    """Store the English story as the checkpoint of a failed story, which /resume-story completes.
+
+    Returns the story_id.
+    """
+    story_id = str(uuid.uuid4())
+    checkpoint = StoryCheckpoint(bucket, genre, story_id)
+    checkpoint.start({
+        "prompt": prompt, "title": title, "tags": tags, "genre": genre,
+        "protagonist": protagonist, "location": location, "seed": None
+    }, ["content_en"])
+    checkpoint.record("content_en", content_en)
+    checkpoint.finish("failed", "The job queue was full")
+    return story_id
+
+def idempotency_key_story(idempotency_key, genre):
+    """The checkpoint and manifest of the story with the key's story id, in whichever genre it was requested.
+
+    The manifest is None if it hasn't started yet; it is then created in genre.
+    """
+    story_id = idempotency.story_id(idempotency_key)
+    for story_genre in sorted(SUPPORTED_GENRES, key=lambda g: g != genre):
+        checkpoint = StoryCheckpoint(bucket, story_genre, story_id)
+        manifest = checkpoint.load_manifest()
+        if manifest is not None:
+            return checkpoint, manifest
+    return StoryCheckpoint(bucket, genre, story_id), None
+
+def idempotent_story(idempotency_key, genre):
+    """The checkpoint and manifest of the current story of an idempotency key (see idempotency_key_story).
+
+    That is the story with the key's story id, or the story that replaced it
+    once the key expired.
+    """
+    checkpoint, manifest = idempotency_key_story(idempotency_key, genre)
+    if manifest is not None and manifest.get("replaced_by"):
+        replacement = manifest["replaced_by"]
+        checkpoint = StoryCheckpoint(bucket, replacement["genre"], replacement["story_id"])
+        manifest = checkpoint.load_manifest()
+    return checkpoint, manifest
+
+def idempotency_key_expired(manifest):
+    """Whether the idempotency key of the story of manifest has expired, which frees it for any request."""
+    return time.time() - manifest["updated_at"] >= IDEMPOTENCY_TTL_SECONDS
+
+def check_idempotency_key(idempotency_key, story_request, manifest=None):
+    """Raise IdempotencyConflict if the key was used for a request other than story_request."""
+    idempotent_requests.check(idempotency_key, story_request)
+    if manifest is None or idempotency_key_expired(manifest):
+        return
+    if {field: manifest["request"].get(field) for field in story_request} != story_request:
+        raise IdempotencyConflict(f"Idempotency key {idempotency_key} was used for a different request")
+
+def generate_story_once(idempotency_key, prompt, title, tags, genre, seed=None, trace=False, progress=None):
+    """generate_and_store_story_content, at most once per idempotency key; returns (result, replayed).
+
+    The story is stored under the key's story id, so a retry that reaches
+    another instance (or this one after a restart) gets the stored story,
+    or continues the unfinished one from its checkpoints. Once the key
+    expires it is free again: the next request with it makes a new story,
+    which the key's story points to.
+    Raises IdempotencyConflict if the key was used for a different request.
+    """
+    story_request = {"prompt": prompt, "title": title, "tags": tags, "genre": genre, "seed": seed}
+    stored = []
+
+    def generate():
+        checkpoint, manifest = idempotent_story(idempotency_key, genre)
+        if manifest is None:
+            return generate_and_store_story_content(prompt, title, tags, genre, progress=progress, seed=seed,
+                                                    story_id=checkpoint.story_id, trace=trace)
+        if idempotency_key_expired(manifest):
+            # The request makes a new story; its id is recorded first, so that
+            # retries of this request on any instance find it
+            story_id = str(uuid.uuid4())
+            idempotency_key_story(idempotency_key, genre)[0].replace(genre, story_id)
+            return generate_and_store_story_content(prompt, title, tags, genre, progress=progress, seed=seed,
+                                                    story_id=story_id, trace=trace)
+        check_idempotency_key(idempotency_key, story_request, manifest)
+        if manifest.get("status") != "complete":
+            return resume_story_content(checkpoint.genre, checkpoint.story_id, progress=progress)
+        stored.append(True)
+        story_data = story_store.read_story(bucket, story_store.find_story(bucket, checkpoint.prefix))
+        return story_result(checkpoint.story_id, story_data)
+
+    result, replayed = idempotent_requests.run(idempotency_key, story_request, generate)
+    return result, replayed or bool(stored)
+
+def idempotent_story_content(idempotency_key, *args, **kwargs):
+    """The result of generate_story_once, for background jobs."""
+    return generate_story_once(idempotency_key, *args, **kwargs)[0]
+
+def submit_idempotent_job(idempotency_key, prompt, title, tags, genre, seed=None, trace=False):
+    """Queue generate_story_once as a job, unless the key already has one; returns (job, created).
+
+    A job that failed is replaced by a new one, which resumes its story.
+    Raises IdempotencyConflict (before queueing anything) if the key was
+    used for a different request.
+    """
+    story_request = {"prompt": prompt, "title": title, "tags": tags, "genre": genre, "seed": seed}
+
+    def existing_job():
+        # Called with idempotent_jobs_lock held
+        previous = idempotent_jobs.get(idempotency_key)
+        if previous is None or previous[1].status == "failed":
+            return None
+        if previous[0] != story_request:
+            raise IdempotencyConflict(f"Idempotency key {idempotency_key} was used for a different request")
+        return previous[1]
+
+    with idempotent_jobs_lock:
+        # The queue forgets jobs after JOB_RETENTION_SECONDS, and so does this
+        for key in [key for key, (_, job) in idempotent_jobs.items() if job_queue.get(job.id) is None]:
+            del idempotent_jobs[key]
+        job = existing_job()
+    if job is not None:
+        return job, False
+    check_idempotency_key(idempotency_key, story_request, idempotent_story(idempotency_key, genre)[1])
+
+    with idempotent_jobs_lock:
+        # Another request with the key may have queued a job meanwhile
+        job = existing_job()
+        if job is not None:
+            return job, False
+        job = job_queue.submit(idempotent_story_content, idempotency_key, prompt, title, tags, genre,
+                               seed=seed, trace=trace)
+        idempotent_jobs[idempotency_key] = (story_request, job)
+    return job, True
+
 @app.route('/')
 def home():
     return "Welcome to the Storyteller Backend"
@@ -298,117 +663,186 @@ def home():
 
 @app.route('/generate-story', methods=['POST'])
 def generate_and_store_story():
+    """Generate and store a story.
+
+    With an Idempotency-Key header, a retried request returns the story of
+    the first one instead of generating another (with an
+    Idempotent-Replayed: true header); retries that arrive while it is being
+    generated wait for it. A key reused for a different request gets 422.
+    """
     data = request.json
     prompt = data.get('prompt')
     title = data.get('title')
     tags = data.get('tags', [])
     genre = data.get('genre')
+    seed = data.get('seed')  # Optional: replay the same story for the same seed
+    trace = request.args.get('trace', '').lower() in ('1', 'true', 'yes')
+    idempotency_key = request.headers.get(idempotency.HEADER)
 
     if not prompt or not title or not genre:
         return jsonify({"error": "Prompt, title, and genre are required"}), 400
 
-    # Select protagonist and location based on genre
-    if genre == "fantasy":
-        protagonist = random.choice(fantasy_protagonists)
-        location = random.choice(fantasy_land_names)
-    elif genre == "sci-fi":
-        protagonist = random.choice(sci_fi_protagonists)
-        location = random.choice(sci_fi_location_names)
-    else:
+    if genre not in SUPPORTED_GENRES:
         return jsonify({"error": "Unsupported genre"}), 400
 
-    # Update prompt with selected location
-    prompt = prompt.format(location)
-
-    char_profile = f"Main character: {protagonist}"
-
-    # Generate a unique ID for the story
-    story_id = str(uuid.uuid4())
+    if idempotency_key is not None and not idempotency.valid_key(idempotency_key):
+        return jsonify({"error": f"{idempotency.HEADER} must have 1 to {idempotency.MAX_KEY_LENGTH} characters"}), 400
+
+    # Job mode: answer right away and let the client poll /jobs/<id>
+    if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+        headers = {}
+        try:
+            if idempotency_key:
+                job, created = submit_idempotent_job(idempotency_key, prompt, title, tags, genre, seed=seed,
+                                                     trace=trace)
+                if not created:
+                    headers["Idempotent-Replayed"] = "true"
+            else:
+                job = job_queue.submit(generate_and_store_story_content, prompt, title, tags, genre,
+                                       seed=seed, trace=trace)
+        except IdempotencyConflict as e:
+            return jsonify({"error": str(e)}), 422
+        except QueueFull:
+            return jsonify({"error": "Too many stories are being generated, try again later"}), 503, {"Retry-After": "30"}
+        status_url = f"/jobs/{job.id}"
+        headers["Location"] = status_url
+        return jsonify({"job_id": job.id, "status": job.status, "status_url": status_url}), 202, headers
+
+    headers = {}
+    try:
+        if idempotency_key:
+            result, replayed = generate_story_once(idempotency_key, prompt, title, tags, genre, seed=seed, trace=trace)
+            if replayed:
+                headers["Idempotent-Replayed"] = "true"
+        else:
+            result = generate_and_store_story_content(prompt, title, tags, genre, seed=seed, trace=trace)
+    except IdempotencyConflict as e:
+        return jsonify({"error": str(e)}), 422
+    except StoryPipelineError as e:
+        return jsonify(pipeline_error_response(e)), 500
+    if "error" in result:
+        return jsonify(result), 400
+
+    return jsonify(result), 201, headers
+
+
+def pipeline_error_response(error):
+    return {"error": str(error), "genre": error.genre, "story_id": error.story_id, "resume_url": "/resume-story"}
+
+
+@app.route('/resume-story', methods=['POST'])
+def resume_story():
+    """Resume a failed story from its checkpoints. Supports ?async=true like /generate-story."""
+    data = request.json
+    genre = data.get('genre')
+    story_id = data.get('story_id')
+
+    if not genre or not story_id:
+        return jsonify({"error": "Genre and story_id are required"}), 400
+
+    if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+        try:
+            job = job_queue.submit(resume_story_content, genre, story_id)
+        except QueueFull:
+            return jsonify({"error": "Too many stories are being generated, try again later"}), 503, {"Retry-After": "30"}
+        status_url = f"/jobs/{job.id}"
+        return jsonify({"job_id": job.id, "status": job.status, "status_url": status_url}), 202, {"Location": status_url}
+
+    try:
+        result = resume_story_content(genre, story_id)
+    except StoryPipelineError as e:
+        return jsonify(pipeline_error_response(e)), 500
+    if "error" in result:
+        return jsonify(result), 404
+
+    return jsonify(result), 201
+
+
+@app.route('/generate-story/stream', methods=['POST'])
+def generate_story_stream():
+    """Stream the English story as server-sent events while it is being written.
+
+    Events: "paragraph" for each finished paragraph, then "job" once the rest
+    of the pipeline is queued; clients poll its status_url for the story.
+    With ?follow=true the stream stays open instead, with "progress" events
+    as the stages finish and finally "complete" (or "error") with the same
+    payload as /generate-story.
+
+    A full job queue is refused before the story is written. If the queue
+    fills up while it is, the story is checkpointed and the "error" event
+    carries the story_id to pass to /resume-story.
+    """
+    data = request.json
+    prompt = data.get('prompt')
+    title = data.get('title')
+    tags = data.get('tags', [])
+    genre = data.get('genre')
 
-    # Generate English story content
-    content_en = generate_story(prompt, "You are a storyteller.", protagonist)
-    
-    # Translate English story content to Turkish
-    content_tr = translate_story(content_en)
-
-    # Summarize the story
-    summary = summarize_story(content_en)
-
-    # Extract key points
-    key_points = extract_key_points(summary)
-
-    # Generate images for each key point
-    image_urls = []
-    for point in key_points:
-        image_url = generate_image(point, char_profile)
-        image_urls.append(image_url)
-
-    # Store images in Cloud Storage
-    image_paths = []
-    for i, url in enumerate(image_urls):
-        response = requests.get(url)
-        file_path = f'stories/{genre}/{story_id}/images/image_{i+1}.png'
-        blob = bucket.blob(file_path)
-        blob.upload_from_string(response.content, content_type='image/png')
-        image_paths.append(blob.public_url)
-
-    # Add anchors to the story text
-    content_en_with_anchors = insert_image_tags(content_en, image_paths)
-    content_tr_with_anchors = insert_image_tags(content_tr, image_paths)
-
-    # Define TTS voices with corrected gender for Turkish voices and more distinct old voices
-    voices = [
-        {"name": "en-US-Wavenet-D", "gender": texttospeech.SsmlVoiceGender.MALE, "age": "young_man"},
-        {"name": "en-GB-Wavenet-A", "gender": texttospeech.SsmlVoiceGender.FEMALE, "age": "young_woman"},
-        {"name": "en-GB-Wavenet-D", "gender": texttospeech.SsmlVoiceGender.MALE, "age": "old_man"},
-        {"name": "en-US-Wavenet-C", "gender": texttospeech.SsmlVoiceGender.FEMALE, "age": "old_woman"},
-        {"name": "tr-TR-Wavenet-B", "gender": texttospeech.SsmlVoiceGender.MALE, "age": "young_man"},  # Corrected
-        {"name": "tr-TR-Wavenet-C", "gender": texttospeech.SsmlVoiceGender.FEMALE, "age": "young_woman"},  # Corrected
-        {"name": "tr-TR-Wavenet-E", "gender": texttospeech.SsmlVoiceGender.MALE, "age": "old_man"},
-        {"name": "tr-TR-Wavenet-D", "gender": texttospeech.SsmlVoiceGender.FEMALE, "age": "old_woman"}  # Corrected
-    ]
+    if not prompt or not title or not genre:
+        return jsonify({"error": "Prompt, title, and genre are required"}), 400
 
-    # Generate TTS for English and Turkish stories with different voices
-    tts_urls = {}
-    for voice in voices:
-        language_code = voice['name'][:5]  # Extract language code from name
-        content = content_en_with_anchors if "en-" in voice['name'] else content_tr_with_anchors
-        tts_audio = synthesize_speech(content, language_code, voice['name'], voice['gender'])
-        directory = "en" if "en-" in voice['name'] else "tr"
-        file_path = f'stories/{genre}/{story_id}/{directory}/{voice["age"]}.mp3'
-        tts_urls[f'{voice["age"]}_{directory}'] = upload_to_gcs(tts_audio, file_path)
-
-    # Store story content and TTS URLs in Cloud Storage
-    story_data = {
-        'title': title,
-        'content_en': content_en_with_anchors,
-        'content_tr': content_tr_with_anchors,
-        'tags': tags,
-        'genre': genre,
-        'tts_urls': tts_urls,
-        'image_urls': image_paths
-    }
-    story_blob = bucket.blob(f'stories/{genre}/{story_id}/story_data.json')
-    story_blob.upload_from_string(json.dumps(story_data), content_type='application/json')
+    protagonist, location = choose_setting(genre)
+    if protagonist is None:
+        return jsonify({"error": "Unsupported genre"}), 400
 
-    return jsonify({
-        "story_id": story_id,
-        "title": title,
-        "content_en": content_en_with_anchors,
-        "content_tr": content_tr_with_anchors,
-        "tags": tags,
-        "genre": genre,
-        "tts_urls": tts_urls,
-        "image_urls": image_paths
-    }), 201
-
-def insert_image_tags(content, image_paths):
-    paragraphs = content.split('</p>')
-    for i, image_url in enumerate(image_paths):
-        if i < len(paragraphs):
-            paragraphs[i] += f' <img src="{image_url}" alt="story_image_{i+1}" />'
-    return '</p>'.join(paragraphs)
+    # Don't pay for a story that can't be queued
+    if job_queue.full():
+        return jsonify({"error": "Too many stories are being generated, try again later"}), 503, {"Retry-After": "30"}
+    follow = request.args.get('follow', '').lower() in ('1', 'true', 'yes')
+
+    def sse(event, payload):
+        return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+    def events():
+        paragraphs = []
+        for paragraph in stream_story(prompt.format(location), "You are a storyteller.", protagonist):
+            paragraphs.append(paragraph)
+            if paragraph.strip():
+                yield sse("paragraph", {"index": len(paragraphs) - 1, "text": paragraph})
+
+        content_en = add_ssml_anchors("\n\n".join(paragraphs))
+        try:
+            job = job_queue.submit(generate_and_store_story_content, prompt, title, tags, genre,
+                                   protagonist=protagonist, location=location, content_en=content_en)
+        except QueueFull:
+            story_id = checkpoint_story_text(prompt, title, tags, genre, protagonist, location, content_en)
+            yield sse("error", {"error": "Too many stories are being generated, resume the story later",
+                                "genre": genre, "story_id": story_id, "resume_url": "/resume-story"})
+            return
+        yield sse("job", {"job_id": job.id, "status_url": f"/jobs/{job.id}"})
+        if not follow:
+            return
+
+        done_stages = set()
+        while job.finished_at is None:
+            time.sleep(1)
+            for stage, status in job.to_dict()["stages"].items():
+                if status == "done" and stage not in done_stages:
+                    done_stages.add(stage)
+                    yield sse("progress", {"stage": stage})
+
+        job_info = job.to_dict()
+        if job_info["status"] == "succeeded":
+            yield sse("complete", job_info["result"])
+        else:
+            yield sse("error", {"error": job_info.get("error") or job_info["result"].get("error")})
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers=headers)
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict()), 200
 
 if __name__ == '__main__':
+    clients.warm_up_in_background()
     app.run(debug=True)
-
@@ -0,0 +1,94 @@
+import hashlib
+import os
+import threading
+import uuid
+
+
+class AudioCache:
+    """Content-addressed cache of synthesized audio.
+
+    Entries live in a local directory bounded to max_bytes (least recently
+    used files are evicted first) and, if a bucket is given, in a shared GCS
+    tier under gcs_prefix so that other instances can reuse them.
+    Eviction brings the directory down to EVICT_TO of max_bytes, so that the
+    directory is only scanned once in a while rather than on every put.
+    """
+
+    EVICT_TO = 0.9
+
+    def __init__(self, directory, max_bytes, bucket=None, gcs_prefix='tts-cache/'):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._bucket = bucket
+        self._gcs_prefix = gcs_prefix
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+    @staticmethod
+    def key(*parts):
+        """Hash the given str/bytes parts into a cache key."""
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode('utf-8')
+            # Length-prefix every part so that different splits never collide
+            digest.update(len(part).to_bytes(8, 'big'))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                audio = f.read()
+            os.utime(path)  # Mark as recently used
+            return audio
+        except FileNotFoundError:
+            pass
+
+        if self._bucket is None:
+            return None
+        blob = self._bucket.blob(self._gcs_prefix + key)
+        if not blob.exists():
+            return None
+        audio = blob.download_as_bytes()
+        self._store_locally(key, audio)
+        return audio
+
+    def put(self, key, audio):
+        self._store_locally(key, audio)
+        if self._bucket is not None:
+            blob = self._bucket.blob(self._gcs_prefix + key)
+            blob.upload_from_string(audio, content_type='application/octet-stream')
+
+    def _path(self, key):
+        return os.path.join(self._directory, key)
+
+    def _store_locally(self, key, audio):
+        path = self._path(key)
+        # Write under a temporary name so readers never see a partial file
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(audio)
+        with self._lock:
+            previous = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            self._size += len(audio) - previous
+            if self._size > self._max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(
+            (entry for entry in os.scandir(self._directory) if entry.is_file() and not entry.name.endswith('.tmp')),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in entries:
+            if self._size <= self._max_bytes * self.EVICT_TO:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self._size -= size
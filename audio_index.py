@@ -0,0 +1,89 @@
+"""Page index of the synthesized story audio.
+
+TTS requests ask for the time of every <mark name="page_N"/>, which sits at
+the end of page N. The index maps every page to its start and end time and
+to the byte range of the MP3 frames that play it, so a player can fetch a
+single page with a Range request and start playback immediately.
+"""
+from bisect import bisect_right
+
+# Bitrates in kbps of MPEG Layer III by bitrate index, for MPEG-1 and for MPEG-2/2.5
+_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),   # MPEG-1
+    2: (22050, 24000, 16000),   # MPEG-2
+    0: (11025, 12000, 8000),    # MPEG-2.5
+}
+
+
+def _id3_size(data):
+    if data[:3] != b'ID3' or len(data) < 10:
+        return 0
+    size = data[6] << 21 | data[7] << 14 | data[8] << 7 | data[9]
+    return 10 + size
+
+
+def frames(data):
+    """Return the (byte offset, start time) of every MPEG Layer III frame in data, and the duration.
+
+    Anything that isn't a frame (ID3 tags, garbage between frames) is skipped.
+    """
+    result = []
+    offset = _id3_size(data)
+    seconds = 0.0
+    while offset + 4 <= len(data):
+        b1, b2 = data[offset + 1], data[offset + 2]
+        version = (b1 >> 3) & 0x3
+        bitrate_index = b2 >> 4
+        sample_rate_index = (b2 >> 2) & 0x3
+        if (data[offset] != 0xFF or (b1 & 0xE0) != 0xE0 or version == 1 or (b1 >> 1) & 0x3 != 1
+                or bitrate_index in (0, 15) or sample_rate_index == 3):
+            offset += 1
+            continue
+        bitrate = _BITRATES[1 if version == 3 else 2][bitrate_index] * 1000
+        sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+        samples = 1152 if version == 3 else 576
+        length = samples // 8 * bitrate // sample_rate + ((b2 >> 1) & 0x1)
+        result.append((offset, seconds))
+        seconds += samples / sample_rate
+        offset += length
+    return result, seconds
+
+
+class AudioIndexBuilder:
+    """Builds the page index of an MP3 assembled from consecutively synthesized chunks."""
+
+    def __init__(self):
+        self.bytes = 0
+        self.seconds = 0.0
+        self._marks = []
+
+    def add(self, audio, marks):
+        """Append a chunk's audio and its (mark name, seconds into the chunk) timepoints."""
+        chunk_frames, duration = frames(audio)
+        starts = [start for _, start in chunk_frames]
+        for name, seconds in marks:
+            seconds = min(seconds, duration)
+            # Pages start at the frame that is playing when the previous page ends
+            i = bisect_right(starts, seconds) - 1
+            offset = chunk_frames[i][0] if i >= 0 else 0
+            self._marks.append((name, self.seconds + seconds, self.bytes + offset))
+        self.bytes += len(audio)
+        self.seconds += duration
+
+    def index(self):
+        pages = []
+        start_seconds, start_byte = 0.0, 0
+        for name, seconds, byte in self._marks:
+            pages.append({
+                "page": name,
+                "start_seconds": round(start_seconds, 3),
+                "end_seconds": round(seconds, 3),
+                "start_byte": start_byte,
+                "end_byte": byte,
+            })
+            start_seconds, start_byte = seconds, byte
+        return {"duration_seconds": round(self.seconds, 3), "bytes": self.bytes, "pages": pages}
@@ -1,33 +1,106 @@
-from flask import request, jsonify
-from app import generate_and_store_story_content, app  # Import the helper function
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Response, request, jsonify, stream_with_context
+from app import generate_and_store_story_content, generate_story_once, app, job_queue  # Import the helper function
+from jobs import QueueFull
+from bulk_batch import run_bulk
+import metrics
+import clients
+import idempotency
+
+# Batch items from all requests share this pool, which bounds how many
+# stories are generated at the same time
+batch_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("BATCH_CONCURRENCY", "4")),
+    thread_name_prefix="batch"
+)
+
+batch_item_seconds = metrics.histogram("storyteller_batch_item_seconds", "Latency of batch items, by outcome")
+batch_items_in_flight = metrics.gauge("storyteller_batch_items_in_flight", "Batch items currently being generated")
+
+def generate_batch_item(item, idempotency_key=None):
+    with batch_items_in_flight.track():
+        start = time.perf_counter()
+        result = _generate_batch_item(item, idempotency_key)
+        batch_item_seconds.observe(time.perf_counter() - start, status=result["status"])
+        return result
+
+def _generate_batch_item(item, idempotency_key=None):
+    try:
+        prompt = item.get('prompt')
+        title = item.get('title')
+        tags = item.get('tags', [])
+        genre = item.get('genre')
+        seed = item.get('seed')
+
+        # Generate the story using the imported function
+        if idempotency_key:
+            response, _ = generate_story_once(idempotency_key, prompt, title, tags, genre, seed=seed)
+        else:
+            response = generate_and_store_story_content(prompt, title, tags, genre, seed=seed)
+        return {
+            "status": "success",
+            "data": response
+        }
+    except Exception as e:
+        return {
+            "status": "error",
+            "message": str(e)
+        }
 
 @app.route('/generate-stories-batch', methods=['POST'])
 def generate_stories_batch():
+    """Generate every story of the batch concurrently.
+
+    Results are streamed as NDJSON, one line per item in completion order,
+    each carrying the item's index in the request. With ?format=json the
+    whole batch is returned as a single JSON list in request order instead.
+
+    With ?mode=bulk the text is generated through the OpenAI Batch API: the
+    request is queued as a job (202) whose result is the list of item results.
+
+    Outside bulk mode, an item with an "idempotency_key" is generated at most
+    once for its key, like a /generate-story request with an Idempotency-Key.
+    With an Idempotency-Key header, the other items get "<key>:<index>" as
+    their key.
+    """
     data = request.json
     if not isinstance(data, list):
         return jsonify({"error": "Expected a list of story requests"}), 400
-    
-    results = []
-    for item in data:
+
+    batch_key = request.headers.get(idempotency.HEADER)
+    item_keys = [(isinstance(item, dict) and item.get('idempotency_key')) or
+                 (f"{batch_key}:{index}" if batch_key else None)
+                 for index, item in enumerate(data)]
+    if any(key is not None and not idempotency.valid_key(key) for key in item_keys):
+        return jsonify({"error": f"Idempotency keys must have 1 to {idempotency.MAX_KEY_LENGTH} characters"}), 400
+
+    if request.args.get('mode') == 'bulk':
         try:
-            prompt = item.get('prompt')
-            title = item.get('title')
-            tags = item.get('tags', [])
-            genre = item.get('genre')
-            
-            # Generate the story using the imported function
-            response = generate_and_store_story_content(prompt, title, tags, genre)
-            results.append({
-                "status": "success",
-                "data": response
-            })
-        except Exception as e:
-            results.append({
-                "status": "error",
-                "message": str(e)
-            })
-    
-    return jsonify(results), 201
+            job = job_queue.submit(run_bulk, data, executor=batch_executor)
+        except QueueFull:
+            return jsonify({"error": "Too many jobs are queued, try again later"}), 503, {"Retry-After": "30"}
+        status_url = f"/jobs/{job.id}"
+        return jsonify({"job_id": job.id, "status": job.status, "status_url": status_url}), 202, {"Location": status_url}
+
+    futures = {batch_executor.submit(generate_batch_item, item, item_keys[index]): index
+               for index, item in enumerate(data)}
+
+    if request.args.get('format') == 'json':
+        results = [None] * len(data)
+        for future, index in futures.items():
+            results[index] = future.result()
+        return jsonify(results), 201
+
+    def lines():
+        for future in as_completed(futures):
+            result = {"index": futures[future], **future.result()}
+            yield json.dumps(result) + "\n"
+
+    return Response(stream_with_context(lines()), status=201, mimetype='application/x-ndjson')
 
 if __name__ == '__main__':
+    clients.warm_up_in_background()
     app.run(debug=True, port=5001)  # Ensure this runs on a different port if necessary
@@ -0,0 +1,131 @@
+"""Offline throughput benchmark of /generate-story and /generate-stories-batch.
+
+The apps run in-process against the fakes in fakes.py, so no OpenAI, TTS or
+Cloud Storage requests are made. Backend latencies, jitter and error rates
+are set with the FAKE_* environment variables described in fakes.py.
+
+For every concurrency level, /generate-story is called by that many
+concurrent clients, and /generate-stories-batch is sent one batch that is
+generated by that many batch workers. Each run reports stories/minute,
+p50/p95 story latency, failures and the peak Python heap.
+
+Usage: python bench_pipeline.py [--stories N] [--concurrency 1,4,16] [--endpoint story|batch|both] [--output results.json]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+# The fakes have to be configured before app.py creates its clients
+os.environ.setdefault("STORYTELLER_FAKE_BACKENDS", "1")
+os.environ.setdefault("TTS_CACHE_DIR", tempfile.mkdtemp(prefix="bench-tts-cache-"))
+os.environ.pop("COMPLETION_CACHE_PATH", None)
+
+import app  # noqa: E402
+import batch_processor  # noqa: E402
+
+
+def story_request(i):
+    genre = app.SUPPORTED_GENRES[i % len(app.SUPPORTED_GENRES)]
+    return {"prompt": f"Benchmark story {i}", "title": f"Story {i}", "tags": ["benchmark"], "genre": genre}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def bench_story(stories, concurrency):
+    """Return the latency of every successful /generate-story call and the number of failures."""
+    def call(i):
+        start = time.perf_counter()
+        response = app.app.test_client().post('/generate-story', json=story_request(i))
+        return response.status_code == 201, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(call, range(stories)))
+    return [latency for ok, latency in results if ok], sum(1 for ok, _ in results if not ok)
+
+
+def bench_batch(stories, concurrency):
+    """Send one batch and time the arrival of every streamed item."""
+    shared_executor = batch_processor.batch_executor
+    batch_processor.batch_executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch")
+    try:
+        latencies, failures = [], 0
+        start = time.perf_counter()
+        response = app.app.test_client().post(
+            '/generate-stories-batch', json=[story_request(i) for i in range(stories)], buffered=False
+        )
+        for line in response.response:
+            result = json.loads(line)
+            if result["status"] == "success":
+                latencies.append(time.perf_counter() - start)
+            else:
+                failures += 1
+        return latencies, failures
+    finally:
+        batch_processor.batch_executor.shutdown()
+        batch_processor.batch_executor = shared_executor
+
+
+def run(endpoint, stories, concurrency):
+    app.bucket.clear()
+    tracemalloc.start()
+    start = time.perf_counter()
+    latencies, failures = BENCHMARKS[endpoint](stories, concurrency)
+    seconds = time.perf_counter() - start
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "stories": stories,
+        "failures": failures,
+        "seconds": round(seconds, 3),
+        "stories_per_minute": round(len(latencies) / seconds * 60, 2),
+        "p50_seconds": round(percentile(latencies, 0.5), 3) if latencies else None,
+        "p95_seconds": round(percentile(latencies, 0.95), 3) if latencies else None,
+        "peak_heap_mb": round(peak_bytes / 2 ** 20, 1),
+    }
+
+
+BENCHMARKS = {"story": bench_story, "batch": bench_batch}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--stories", type=int, default=16, help="stories per run")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated concurrency levels")
+    parser.add_argument("--endpoint", choices=("story", "batch", "both"), default="both")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    endpoints = ("story", "batch") if args.endpoint == "both" else (args.endpoint,)
+    results = []
+    print(f"{'endpoint':>8} {'conc':>5} {'stories/min':>12} {'p50 s':>8} {'p95 s':>8} {'failed':>7} {'peak MB':>8}")
+    for endpoint in endpoints:
+        for concurrency in (int(level) for level in args.concurrency.split(',')):
+            result = run(endpoint, args.stories, concurrency)
+            results.append(result)
+            print(f"{endpoint:>8} {concurrency:>5} {result['stories_per_minute']:>12} {result['p50_seconds']!s:>8} "
+                  f"{result['p95_seconds']!s:>8} {result['failures']:>7} {result['peak_heap_mb']:>8}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"environment": fake_environment(), "results": results}, f, indent=2, sort_keys=True)
+
+
+def fake_environment():
+    """The settings that shape the results, recorded next to them."""
+    return {name: value for name, value in sorted(os.environ.items())
+            if name.startswith("FAKE_") or name.endswith(("_CONCURRENCY", "_WORKERS", "_REQUESTS_PER_MINUTE"))}
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Cold start benchmark of story_api.py.
+
+Starts the service as a fresh process, the way Cloud Run does, and measures
+the time from spawning it to its first response on / (the port is bound and
+serving) and to its first /random-story (the clients and the catalog are
+ready). Each start is repeated and the median and minimum are reported.
+
+The service runs with the environment of this script, so it talks to the
+real backends unless STORYTELLER_FAKE_BACKENDS=1 is set.
+
+Usage: python bench_startup.py [--runs 5] [--port 8090] [--timeout 60] [--output startup.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+SERVICE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "story_api.py")
+
+
+def first_response(url, deadline):
+    """Poll url until the service answers (with any status); return its status."""
+    while True:
+        try:
+            with urllib.request.urlopen(url, timeout=max(deadline - time.monotonic(), 0.1)) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+        except (urllib.error.URLError, ConnectionError, TimeoutError):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"No response from {url}")
+            time.sleep(0.01)
+
+
+def cold_start(port, timeout):
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, PORT=str(port))
+    start = time.monotonic()
+    process = subprocess.Popen([sys.executable, SERVICE], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = start + timeout
+        first_response(base_url + "/", deadline)
+        serving = time.monotonic() - start
+        status = first_response(base_url + "/random-story", deadline)
+        ready = time.monotonic() - start
+    finally:
+        process.terminate()
+        process.wait()
+    return {"first_response_seconds": round(serving, 3), "first_story_seconds": round(ready, 3),
+            "first_story_status": status}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for a start")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    runs = []
+    for i in range(args.runs):
+        run = cold_start(args.port, args.timeout)
+        runs.append(run)
+        print(f"run {i + 1}: first response {run['first_response_seconds']:.3f}s, "
+              f"first story {run['first_story_seconds']:.3f}s (HTTP {run['first_story_status']})")
+
+    summary = {}
+    for metric in ("first_response_seconds", "first_story_seconds"):
+        values = [run[metric] for run in runs]
+        summary[metric] = {"median": round(statistics.median(values), 3), "min": min(values)}
+        print(f"{metric}: median {summary[metric]['median']:.3f}s, min {summary[metric]['min']:.3f}s")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"runs": runs, "summary": summary}, f, indent=2, sort_keys=True)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""Load test of the story_api read path against a synthetic catalog.
+
+story_api.py runs in-process on the in-memory bucket from fakes.py, filled
+with a synthetic catalog of every requested size. /random-story is then
+driven at fixed request rates, with and without the genre filter. Requests
+are sent on schedule whether or not earlier ones finished, and latency is
+measured from the scheduled time, so a service that falls behind shows up
+in the percentiles instead of slowing the load down.
+
+Every run reports p50/p95/p99 latency, the achieved throughput, errors,
+the process CPU time and the bytes of stored stories read per request.
+Stories are stored in the layout of story_store.py, or as the legacy
+single story_data.json with --legacy. The results are written as sorted JSON
+so that runs of two versions can be diffed.
+
+Usage: python bench_story_api.py [--sizes 100,100000] [--rates 50,200] [--duration 10] [--legacy]
+       [--output story_api_loadtest.json]
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("STORYTELLER_FAKE_BACKENDS", "1")
+
+import fakes  # noqa: E402
+import story_api  # noqa: E402
+import story_store  # noqa: E402
+from catalog import Catalog, make_entry, write_manifest  # noqa: E402
+from languages import LEGACY_LANGUAGES, STORY_LANGUAGES  # noqa: E402
+from tts import index_blob_name  # noqa: E402
+
+GENRES = ("fantasy", "sci-fi")
+
+
+def tts_keys(languages):
+    return [f"{age}_{language}" for age in ("young_man", "young_woman", "old_man", "old_woman")
+            for language in languages]
+
+
+def story_objects(genre, paragraphs, legacy):
+    """The stored objects (name under the story prefix, data) of a typical story.
+
+    Their content doesn't matter to the API, only their size.
+    """
+    text = fakes.fake_text(random.Random(genre), paragraphs)
+    meta = {"title": f"A {genre} story", "genre": genre, "tags": [genre], "summary": text[:300]}
+    # A page index per voice, as audio_index.py makes them
+    index = {"duration_seconds": 60.0 * paragraphs, "bytes": 240000 * paragraphs, "pages": [
+        {"page": f"page_{n + 1}", "start_seconds": 60.0 * n, "end_seconds": 60.0 * (n + 1),
+         "start_byte": 240000 * n, "end_byte": 240000 * (n + 1)} for n in range(paragraphs)
+    ]}
+    if legacy:
+        story_data = dict(meta, content_en=text, content_tr=text,
+                          tts_indexes={key: index for key in tts_keys(LEGACY_LANGUAGES)})
+        return [(story_store.LEGACY_NAME, json.dumps(story_data).encode('utf-8'))]
+    meta['languages'] = list(STORY_LANGUAGES)
+    objects = [(story_store.content_blob_name('', language), story_store.encode_content(text))
+               for language in STORY_LANGUAGES]
+    objects += [(index_blob_name(tts_blob_name('', key)), json.dumps(index).encode('utf-8'))
+                for key in tts_keys(STORY_LANGUAGES)]
+    return objects + [(story_store.META_NAME, json.dumps(meta).encode('utf-8'))]
+
+
+def tts_blob_name(prefix, key):
+    return f'{prefix}tts/{key}.mp3'
+
+
+def build_catalog(bucket, stories, paragraphs, legacy=False):
+    """Store `stories` stories, split evenly between the genres, and a manifest listing them."""
+    objects = {genre: story_objects(genre, paragraphs, legacy) for genre in GENRES}
+    entries = []
+    for i in range(stories):
+        genre = GENRES[i % len(GENRES)]
+        story_id = str(uuid.UUID(int=i))
+        prefix = f'stories/{genre}/{story_id}/'
+        for name, data in objects[genre]:
+            bucket.blob(prefix + name).upload_from_string(data)
+        entries.append(make_entry(
+            story_id, f"Story {i}", genre, [genre], prefix + objects[genre][-1][0],
+            [f'{prefix}images/image_{n}.png' for n in range(1, 4)],
+            {key: tts_blob_name(prefix, key) for key in tts_keys(LEGACY_LANGUAGES if legacy else STORY_LANGUAGES)},
+            languages=None if legacy else STORY_LANGUAGES
+        ))
+    write_manifest(bucket, entries)
+
+
+def use_catalog(stories, paragraphs, legacy=False):
+    """Point story_api at a fresh bucket holding the synthetic catalog; returns the catalog load time."""
+    bucket = fakes.FakeBucket.from_env(story_api.bucket_name)
+    latency, bucket.latency = bucket.latency, fakes.Latency()
+    build_catalog(bucket, stories, paragraphs, legacy)
+    bucket.latency = latency
+
+    story_api.bucket = bucket
+    story_api.catalog = Catalog(bucket, refresh_seconds=int(os.getenv("CATALOG_REFRESH_SECONDS", "60")))
+    story_api.signed_url_cache = story_api.SignedUrlCache(
+        max_entries=int(os.getenv("SIGNED_URL_CACHE_SIZE", "10000")),
+        safety_margin=int(os.getenv("SIGNED_URL_SAFETY_MARGIN", "600"))
+    )
+    start = time.perf_counter()
+    story_api.catalog.refresh()
+    return time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def drive(path, rate, duration, workers):
+    """Send GET path at rate requests/second for duration seconds."""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def call(scheduled):
+        response = story_api.app.test_client().get(path)
+        latency = time.perf_counter() - scheduled
+        with lock:
+            if response.status_code == 200:
+                latencies.append(latency)
+            else:
+                errors[0] += 1
+
+    total = int(rate * duration)
+    bytes_start = story_store.story_bytes_read.total()
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i in range(total):
+            scheduled = start + i / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(call, scheduled)
+    seconds = time.perf_counter() - start
+    cpu_seconds = time.process_time() - cpu_start
+    bytes_read = story_store.story_bytes_read.total() - bytes_start
+
+    return {
+        "requests": total,
+        "errors": errors[0],
+        "throughput_rps": round(len(latencies) / seconds, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        "cpu_ms_per_request": round(cpu_seconds / total * 1000, 3),
+        "story_bytes_per_request": round(bytes_read / total),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default="100,100000", help="comma separated catalog sizes")
+    parser.add_argument("--rates", default="50,200", help="comma separated request rates (requests/second)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per run")
+    parser.add_argument("--workers", type=int, default=32, help="concurrent client threads")
+    parser.add_argument("--paragraphs", type=int, default=6, help="paragraphs per synthetic story")
+    parser.add_argument("--legacy", action="store_true", help="store stories as a single story_data.json")
+    parser.add_argument("--fields", help="the fields parameter of /random-story (default: all fields)")
+    parser.add_argument("--output", default="story_api_loadtest.json")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'stories':>8} {'genre':>8} {'rate':>6} {'rps':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'errors':>7} {'cpu ms/req':>11} {'KB/req':>7}")
+    for size in (int(size) for size in args.sizes.split(',')):
+        load_seconds = use_catalog(size, args.paragraphs, args.legacy)
+        for genre in (None, GENRES[0]):
+            query = [f'genre={genre}'] if genre else []
+            query += [f'fields={args.fields}'] if args.fields else []
+            path = '/random-story' + ('?' + '&'.join(query) if query else '')
+            for rate in (float(rate) for rate in args.rates.split(',')):
+                result = drive(path, rate, args.duration, args.workers)
+                result.update({"stories": size, "genre": genre or "any", "rate": rate,
+                               "catalog_load_seconds": round(load_seconds, 3)})
+                results.append(result)
+                print(f"{size:>8} {result['genre']:>8} {rate:>6g} {result['throughput_rps']:>7} "
+                      f"{result['p50_ms']!s:>8} {result['p95_ms']!s:>8} {result['p99_ms']!s:>8} "
+                      f"{result['errors']:>7} {result['cpu_ms_per_request']:>11} "
+                      f"{result['story_bytes_per_request'] / 1024:>7.1f}")
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            "settings": {"duration": args.duration, "workers": args.workers, "paragraphs": args.paragraphs,
+                         "legacy": args.legacy, "fields": args.fields,
+                         "fake_environment": {name: value for name, value in sorted(os.environ.items())
+                                              if name.startswith("FAKE_")}},
+            "results": results
+        }, f, indent=2, sort_keys=True)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Micro-benchmark of StoryDocument against the previous string-based helpers.
+
+Usage: python bench_story_document.py [paragraphs] [repeats]
+"""
+import random
+import sys
+import timeit
+from story_document import StoryDocument
+
+
+# The string-based implementations that StoryDocument replaced
+def legacy_add_ssml_anchors(text):
+    paragraphs = text.split("\n\n")
+    ssml = "<speak>"
+    for i, paragraph in enumerate(paragraphs):
+        ssml += f'<p>{paragraph}</p>'
+        ssml += f'<mark name="page_{i+1}"/>'
+    ssml += "</speak>"
+    return ssml.replace(".", ".<break time='700ms'/>")
+
+def legacy_insert_image_tags(content, image_paths):
+    paragraphs = content.split('</p>')
+    for i, image_url in enumerate(image_paths):
+        if i < len(paragraphs):
+            paragraphs[i] += f' <img src="{image_url}" alt="story_image_{i+1}" />'
+    return '</p>'.join(paragraphs)
+
+def legacy_chunk_text_to_ssml(text, max_size=5000):
+    current_chunk = []
+    current_size = len('<speak>') + len('</speak>')
+    for paragraph in text.split('<p>'):
+        paragraph = paragraph.strip()
+        paragraph_ssml = f"<p>{paragraph}</p>"
+        paragraph_bytes = len(paragraph_ssml.encode('utf-8'))
+        if current_size + paragraph_bytes > max_size:
+            yield f"<speak>{''.join(current_chunk)}</speak>"
+            current_chunk = []
+            current_size = len('<speak>') + len('</speak>')
+        current_chunk.append(paragraph_ssml)
+        current_size += paragraph_bytes
+    if current_chunk:
+        yield f"<speak>{''.join(current_chunk)}</speak>"
+
+
+def make_story(num_paragraphs, seed=0):
+    rng = random.Random(seed)
+    words = ["the", "brave", "knight", "rode", "through", "enchanted", "forest", "dragon", "çocuk", "yıldız"]
+    paragraphs = []
+    for _ in range(num_paragraphs):
+        sentences = [" ".join(rng.choice(words) for _ in range(rng.randint(6, 18))).capitalize() + "."
+                     for _ in range(rng.randint(3, 8))]
+        paragraphs.append(" ".join(sentences))
+    return "\n\n".join(paragraphs)
+
+
+def legacy_pipeline(text, image_paths):
+    ssml = legacy_add_ssml_anchors(text)
+    tagged = legacy_insert_image_tags(ssml, image_paths)
+    return tagged, list(legacy_chunk_text_to_ssml(tagged))
+
+
+def document_pipeline(text, image_paths):
+    document = StoryDocument.from_text(text)
+    return document.to_html(image_paths), document.tts_chunks()
+
+
+def main():
+    num_paragraphs = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    text = make_story(num_paragraphs)
+    image_paths = [f"https://storage.googleapis.com/storytellerbucket/images/image_{i+1}.png" for i in range(3)]
+
+    for name, pipeline in (("legacy", legacy_pipeline), ("document", document_pipeline)):
+        seconds = min(timeit.repeat(lambda: pipeline(text, image_paths), number=repeats, repeat=5)) / repeats
+        _, chunks = pipeline(text, image_paths)
+        sizes = [len(chunk.encode('utf-8')) for chunk in chunks]
+        print(f"{name:>8}: {seconds * 1e6:9.1f} us/story, {len(chunks)} TTS chunks, "
+              f"largest {max(sizes)} bytes, mean fill {sum(sizes) / len(sizes) / 5000:.0%}")
+
+
+if __name__ == '__main__':
+    main()
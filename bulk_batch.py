@@ -0,0 +1,267 @@
+"""Offline bulk generation through the OpenAI Batch API.
+
+The completions of every item are collected into Batch API JSONL files,
+submitted and polled, in three rounds: the stories; their summaries and
+glossaries of names; and their translations, a few paragraphs per request
+like in the live pipeline (see translation.py). Their results are then fed
+into the regular pipeline, which still generates the images and audio.
+
+Usage: python bulk_batch.py items.json [--local]
+"""
+import io
+import json
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from app import (
+    client, choose_setting, story_messages, summary_messages, complete_translation,
+    add_ssml_anchors, generate_and_store_story_content
+)
+from languages import TARGET_LANGUAGES
+from story_document import StoryDocument
+import rate_limit
+import translation
+
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "30"))
+FINISHED_BATCH_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchRequestError(Exception):
+    """Raised for a request that did not produce a completion in the batch."""
+
+
+class LocalBatchClient:
+    """Stand-in for the Files and Batches endpoints of the OpenAI client.
+
+    Batches are executed synchronously when they are created, by calling
+    complete(body) for every request line. complete must return the chat
+    completion as a dict; by default the real chat completions endpoint is
+    called, so this can also be used to run bulk mode without the Batch API.
+    """
+
+    def __init__(self, complete=None):
+        self._complete = complete or (
+            lambda body: rate_limit.call("openai", client.chat.completions.create, **body).model_dump()
+        )
+        self._files = {}
+        self._batches = {}
+        self.files = _LocalFiles(self)
+        self.batches = _LocalBatches(self)
+
+
+class _LocalFiles:
+    def __init__(self, backend):
+        self._backend = backend
+
+    def create(self, file, purpose):
+        name, data = file
+        file_id = f"file-{uuid.uuid4().hex}"
+        self._backend._files[file_id] = data if isinstance(data, bytes) else data.read()
+        return _Record(id=file_id, filename=name, purpose=purpose)
+
+    def content(self, file_id):
+        return _Record(text=self._backend._files[file_id].decode('utf-8'))
+
+
+class _LocalBatches:
+    def __init__(self, backend):
+        self._backend = backend
+
+    def create(self, input_file_id, endpoint, completion_window):
+        output = io.StringIO()
+        for line in self._backend._files[input_file_id].decode('utf-8').splitlines():
+            request = json.loads(line)
+            try:
+                body = self._backend._complete(request['body'])
+                result = {"custom_id": request['custom_id'], "response": {"status_code": 200, "body": body}, "error": None}
+            except Exception as e:
+                result = {"custom_id": request['custom_id'], "response": None, "error": {"message": str(e)}}
+            output.write(json.dumps(result) + "\n")
+        output_file_id = self._backend.files.create(("output.jsonl", output.getvalue().encode('utf-8')), "batch_output").id
+        batch = _Record(id=f"batch-{uuid.uuid4().hex}", status="completed", output_file_id=output_file_id, error_file_id=None)
+        self._backend._batches[batch.id] = batch
+        return batch
+
+    def retrieve(self, batch_id):
+        return self._backend._batches[batch_id]
+
+
+class _Record:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def chat_request(custom_id, messages, max_tokens, temperature=None):
+    body = {"model": "gpt-4o", "messages": messages, "max_tokens": max_tokens}
+    if temperature is not None:
+        body["temperature"] = temperature
+    return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}
+
+
+def _submission_slot(batch_client):
+    # A local batch makes its requests while it is being created, each in a
+    # slot of its own, so creating it must not hold one as well
+    return rate_limit.slot(None if isinstance(batch_client, LocalBatchClient) else "openai")
+
+
+def run_chat_batch(batch_client, requests, poll_interval=BATCH_POLL_INTERVAL):
+    """Run chat completion requests as one batch.
+
+    Returns a dict mapping every custom_id to the completion text, or to a
+    BatchRequestError if that request failed.
+    """
+    if not requests:
+        return {}
+    jsonl = "".join(json.dumps(request) + "\n" for request in requests).encode('utf-8')
+    # Uploads and submissions aren't retried: a retry of one whose response
+    # was lost would submit the batch twice
+    with _submission_slot(batch_client):
+        input_file = batch_client.files.create(file=("requests.jsonl", jsonl), purpose="batch")
+    with _submission_slot(batch_client):
+        batch = batch_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+    while batch.status not in FINISHED_BATCH_STATUSES:
+        time.sleep(poll_interval)
+        batch = rate_limit.call("openai", batch_client.batches.retrieve, batch.id)
+
+    results = {request["custom_id"]: BatchRequestError(f"Batch {batch.id} ended as {batch.status}") for request in requests}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in rate_limit.call("openai", batch_client.files.content, file_id).text.splitlines():
+            result = json.loads(line)
+            response = result.get("response")
+            if response and response.get("status_code") == 200:
+                results[result["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+            else:
+                error = result.get("error") or (response or {}).get("body", {}).get("error")
+                results[result["custom_id"]] = BatchRequestError(str(error))
+    return results
+
+
+def run_bulk(items, batch_client=None, executor=None, progress=None, poll_interval=BATCH_POLL_INTERVAL):
+    """Generate a list of batch items through the Batch API.
+
+    Returns one result per item, in request order, in the same shape as the
+    /generate-stories-batch results.
+    """
+    batch_client = batch_client or client
+    notify = progress or (lambda stage, status: None)
+    results = [None] * len(items)
+    stories = {}
+
+    # Phase 1: the English stories
+    story_requests = []
+    for index, item in enumerate(items):
+        protagonist, location = choose_setting(item.get('genre'))
+        if protagonist is None:
+            results[index] = {"status": "success", "data": {"error": "Unsupported genre"}}
+            continue
+        try:
+            prompt = item.get('prompt').format(location)
+        except Exception as e:
+            results[index] = {"status": "error", "message": str(e)}
+            continue
+        stories[index] = {"protagonist": protagonist, "location": location}
+        messages = story_messages(prompt, "You are a storyteller.", protagonist)
+        story_requests.append(chat_request(f"story-{index}", messages, 2500, temperature=0.7))
+
+    notify("stories", "running")
+    completions = run_chat_batch(batch_client, story_requests, poll_interval)
+    notify("stories", "done")
+
+    # Phase 2: the summaries, and the glossaries of names for the translations
+    followup_requests = []
+    for index, story in list(stories.items()):
+        completion = completions[f"story-{index}"]
+        if isinstance(completion, Exception):
+            results[index] = {"status": "error", "message": str(completion)}
+            del stories[index]
+            continue
+        story["content_en"] = add_ssml_anchors(completion)
+        story["document"] = StoryDocument.from_ssml(story["content_en"])
+        text = "\n\n".join(paragraph.text for paragraph in story["document"].paragraphs)
+        followup_requests.append(chat_request(f"glossary-{index}",
+                                              translation.glossary_messages(text, TARGET_LANGUAGES), 800))
+        followup_requests.append(chat_request(f"summary-{index}", summary_messages(story["content_en"]), 100))
+
+    notify("summaries", "running")
+    summaries = run_chat_batch(batch_client, followup_requests, poll_interval)
+    notify("summaries", "done")
+
+    # Phase 3: the translations, a group of paragraphs per request like translate_story
+    translation_requests = []
+    for index, story in stories.items():
+        glossary = summaries[f"glossary-{index}"]
+        # Without a glossary the names are still translated, just not as consistently
+        story["glossary"] = translation.parse_glossary(
+            "" if isinstance(glossary, Exception) else glossary, TARGET_LANGUAGES
+        )
+        story["groups"] = translation.document_groups(story["document"])
+        for language in TARGET_LANGUAGES:
+            for group, texts in enumerate(story["groups"]):
+                messages = translation.group_messages(texts, language, story["glossary"][language])
+                translation_requests.append(chat_request(f"translation-{language}-{index}-{group}", messages,
+                                                         translation.group_max_tokens(texts)))
+
+    notify("translations", "running")
+    completions = run_chat_batch(batch_client, translation_requests, poll_interval)
+    notify("translations", "done")
+
+    def translate(index, story, language):
+        translated = []
+        for group, texts in enumerate(story["groups"]):
+            completion = completions[f"translation-{language}-{index}-{group}"]
+            if isinstance(completion, Exception):
+                raise completion
+            # Answers that merged or split paragraphs are translated again, one paragraph per live request
+            translated += translation.translate_group(texts, language, story["glossary"][language],
+                                                      complete_translation, answer=completion)
+        return translation.with_translations(story["document"], translated).to_ssml()
+
+    # Phase 4: images, audio and storage through the regular pipeline
+    def finish(index, story):
+        item = items[index]
+        summary = summaries[f"summary-{index}"]
+        if isinstance(summary, Exception):
+            raise summary
+        return generate_and_store_story_content(
+            item.get('prompt'), item.get('title'), item.get('tags', []), item.get('genre'),
+            protagonist=story["protagonist"], location=story["location"],
+            content_en=story["content_en"], summary=summary,
+            translations={language: translate(index, story, language) for language in TARGET_LANGUAGES}
+        )
+
+    notify("media", "running")
+    own_executor = executor is None
+    executor = executor or ThreadPoolExecutor(max_workers=4, thread_name_prefix="bulk")
+    try:
+        futures = {executor.submit(finish, index, story): index for index, story in stories.items()}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                results[index] = {"status": "success", "data": future.result()}
+            except Exception as e:
+                results[index] = {"status": "error", "message": str(e)}
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False)
+    notify("media", "done")
+
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    with open(sys.argv[1]) as f:
+        batch_items = json.load(f)
+    backend = LocalBatchClient() if '--local' in sys.argv else None
+    for line in run_bulk(batch_items, batch_client=backend):
+        print(json.dumps(line))
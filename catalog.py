@@ -0,0 +1,314 @@
+"""Compact catalog of the stories stored in the bucket.
+
+The catalog lives in two places:
+
+* ``catalog/manifest.json`` - a compacted list of entries, rewritten by
+  ``compact_manifest`` (or ``rebuild_manifest`` for a full bucket scan).
+  A Catalog compacts it in the background once its journal backlog reaches
+  compact_backlog entries.
+* ``catalog/journal/`` - one small object per story written by the generator
+  as soon as the story is stored. Journal names sort by creation time, so
+  readers only need to list the objects they have not seen yet.
+
+Usage: python catalog.py [rebuild|compact]
+"""
+import json
+import random
+from bisect import bisect_right
+import sys
+import threading
+import time
+from languages import story_languages
+import story_store
+
+MANIFEST_BLOB = 'catalog/manifest.json'
+JOURNAL_PREFIX = 'catalog/journal/'
+
+# Journal objects can become visible slightly out of order, so readers re-list
+# this far behind the newest entry they have seen and compaction leaves the
+# most recent entries in the journal.
+JOURNAL_GRACE_SECONDS = 300
+
+
+def blob_name_from_url(url):
+    """Extract the blob name from a public storage URL."""
+    return '/'.join(url.split('/')[4:])
+
+
+def make_entry(story_id, title, genre, tags, story_blob, image_blobs, tts_blobs, image_variants=None,
+               languages=None):
+    """image_variants lists, per image, the width, format and blob of each of its variants.
+
+    Entries without languages are of stories in the languages.LEGACY_LANGUAGES.
+    """
+    entry = {
+        'id': story_id,
+        'title': title,
+        'genre': genre,
+        'tags': tags,
+        'story_blob': story_blob,
+        'image_blobs': image_blobs,
+        'tts_blobs': tts_blobs,
+        'image_variants': image_variants or []
+    }
+    if languages is not None:
+        entry['languages'] = list(languages)
+    return entry
+
+
+def image_variant_blobs(image_variants):
+    """Replace the URLs in the image_variants of story_data.json with blob names."""
+    return [[{'width': variant['width'], 'format': variant['format'], 'blob': blob_name_from_url(variant['url'])}
+             for variant in variants] for variants in image_variants]
+
+
+def entry_from_story_data(story_blob, story_data):
+    """Build a catalog entry from the name and contents of a meta.json (or legacy story_data.json)."""
+    return make_entry(
+        story_blob.split('/')[-2],
+        story_data['title'],
+        story_data['genre'],
+        story_data.get('tags', []),
+        story_blob,
+        [blob_name_from_url(url) for url in story_data.get('image_urls', [])],
+        {key: blob_name_from_url(url) for key, url in story_data.get('tts_urls', {}).items()},
+        image_variant_blobs(story_data.get('image_variants', [])),
+        story_languages(story_data)
+    )
+
+
+def _journal_name(timestamp_ns, story_id):
+    return f'{JOURNAL_PREFIX}{timestamp_ns:020d}-{story_id}.json'
+
+
+def _journal_timestamp(blob_name):
+    return int(blob_name[len(JOURNAL_PREFIX):].split('-', 1)[0])
+
+
+def record_story(bucket, entry):
+    """Append a story to the catalog journal."""
+    blob = bucket.blob(_journal_name(time.time_ns(), entry['id']))
+    blob.upload_from_string(json.dumps(entry), content_type='application/json')
+
+
+def write_manifest(bucket, entries, journal_offset='', if_generation_match=None):
+    """Replace the manifest with entries, covering the journal up to journal_offset.
+
+    With if_generation_match, the manifest is only replaced if it is still at
+    that generation (0: if there is none yet).
+    """
+    manifest = {'journal_offset': journal_offset, 'entries': entries}
+    blob = bucket.blob(MANIFEST_BLOB)
+    blob.upload_from_string(json.dumps(manifest), content_type='application/json',
+                            if_generation_match=if_generation_match)
+
+
+def _read_manifest(bucket):
+    blob = bucket.get_blob(MANIFEST_BLOB)
+    if blob is None:
+        return None, {'journal_offset': '', 'entries': []}
+    return blob.generation, json.loads(blob.download_as_bytes(if_generation_match=blob.generation))
+
+
+def compact_manifest(bucket):
+    """Fold settled journal entries into the manifest and delete them from the journal.
+
+    Fails, leaving the journal as it is, if the manifest changed meanwhile.
+    """
+    generation, manifest = _read_manifest(bucket)
+    entries = {entry['id']: entry for entry in manifest['entries']}
+    cutoff = time.time_ns() - JOURNAL_GRACE_SECONDS * 10**9
+    journal_offset = manifest['journal_offset']
+    folded = []
+    for blob in bucket.list_blobs(prefix=JOURNAL_PREFIX, start_offset=journal_offset or None):
+        if blob.name <= journal_offset or _journal_timestamp(blob.name) > cutoff:
+            continue
+        entry = json.loads(blob.download_as_bytes())
+        entries[entry['id']] = entry
+        journal_offset = max(journal_offset, blob.name)
+        folded.append(blob)
+    if not folded:
+        return 0
+    write_manifest(bucket, list(entries.values()), journal_offset, if_generation_match=generation or 0)
+    for blob in folded:
+        blob.delete()
+    return len(folded)
+
+
+def rebuild_manifest(bucket, if_generation_match=None):
+    """Rebuild the manifest from the meta.json of every story in the bucket.
+
+    Stories that only have a legacy story_data.json are listed with that.
+    if_generation_match is that of write_manifest.
+    """
+    story_blobs = {}
+    for blob in bucket.list_blobs(prefix='stories/'):
+        for name in (story_store.LEGACY_NAME, story_store.META_NAME):
+            if blob.name.endswith('/' + name):
+                prefix = blob.name[:-len(name)]
+                if not story_blobs.get(prefix, '').endswith(story_store.META_NAME):
+                    story_blobs[prefix] = blob.name
+    entries = [entry_from_story_data(name, story_store.read_meta(bucket, name)) for name in story_blobs.values()]
+    write_manifest(bucket, entries, if_generation_match=if_generation_match)
+    return len(entries)
+
+
+class Catalog:
+    """In-memory view of the catalog with O(1) random selection per genre.
+
+    The view is refreshed at most every refresh_seconds: the manifest is only
+    downloaded again when its generation changed, and the journal is listed
+    from the newest entry already seen. When a refresh finds compact_backlog
+    or more journal entries past the manifest (0: never), they are folded into
+    the manifest on a background thread, so that the next cold start reads
+    them all with the manifest instead of one object per story.
+
+    With rebuild_missing, a bucket without a manifest (one that predates the
+    catalog) gets one from rebuild_manifest on the first refresh, rather than
+    the catalog only listing the stories in the journal.
+    """
+
+    def __init__(self, bucket, refresh_seconds=60, compact_backlog=0, rebuild_missing=False):
+        self._bucket = bucket
+        self._refresh_seconds = refresh_seconds
+        self._compact_backlog = compact_backlog
+        self._rebuild_missing = rebuild_missing
+        self._compacting = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._entries = {}
+        self._by_genre = {}
+        self._all = []
+        self._sorted = {None: ([], [])}
+        self._manifest_generation = None
+        self._manifest_offset = ''
+        self._journal_offset = ''
+        self._last_refresh = None
+
+    def random_entry(self, genre=None):
+        self._maybe_refresh()
+        candidates = self._all if genre is None else self._by_genre.get(genre, [])
+        if not candidates:
+            return None
+        return random.choice(candidates)
+
+    def get(self, story_id):
+        self._maybe_refresh()
+        return self._entries.get(story_id)
+
+    def size(self):
+        return len(self._all)
+
+    def load(self):
+        """Load the catalog now instead of on the first lookup (refreshing it if it is stale)."""
+        self._maybe_refresh()
+
+    def page(self, genre=None, tags=(), after=None, limit=20):
+        """Return up to limit entries having all of tags, in id order after the id `after`,
+        and whether more entries follow.
+        """
+        self._maybe_refresh()
+        ids, entries = self._sorted.get(genre, ([], []))
+        start = bisect_right(ids, after) if after else 0
+        result = []
+        for i in range(start, len(entries)):
+            if all(tag in entries[i]['tags'] for tag in tags):
+                if len(result) == limit:
+                    return result, True
+                result.append(entries[i])
+        return result, False
+
+    def _maybe_refresh(self):
+        if self._last_refresh is None:
+            # Nothing to serve yet, so everybody waits for the first load
+            with self._refresh_lock:
+                if self._last_refresh is None:
+                    self.refresh()
+            return
+        if time.monotonic() - self._last_refresh < self._refresh_seconds:
+            return
+        # Only one thread refreshes, the others keep serving the current view
+        if self._refresh_lock.acquire(blocking=False):
+            try:
+                self.refresh()
+            finally:
+                self._refresh_lock.release()
+
+    def refresh(self):
+        entries = dict(self._entries)
+        manifest_blob = self._bucket.get_blob(MANIFEST_BLOB)
+        if manifest_blob is None and self._rebuild_missing:
+            self._rebuild_missing = False
+            try:
+                rebuild_manifest(self._bucket, if_generation_match=0)
+            except Exception as e:
+                # Another instance wrote the manifest first, most likely
+                print(f"Catalog rebuild failed: {e}")
+            manifest_blob = self._bucket.get_blob(MANIFEST_BLOB)
+        generation = manifest_blob.generation if manifest_blob is not None else None
+        if generation != self._manifest_generation:
+            _, manifest = _read_manifest(self._bucket)
+            for entry in manifest['entries']:
+                entries[entry['id']] = entry
+            self._manifest_generation = generation
+            self._manifest_offset = manifest['journal_offset']
+            self._journal_offset = max(self._journal_offset, manifest['journal_offset'])
+
+        start_offset = self._journal_offset
+        if start_offset:
+            grace_ns = JOURNAL_GRACE_SECONDS * 10**9
+            start_offset = _journal_name(max(_journal_timestamp(start_offset) - grace_ns, 0), '')
+        backlog = 0
+        for blob in self._bucket.list_blobs(prefix=JOURNAL_PREFIX, start_offset=start_offset or None):
+            story_id = blob.name[len(JOURNAL_PREFIX):].split('-', 1)[1][:-len('.json')]
+            if story_id not in entries:
+                entries[story_id] = json.loads(blob.download_as_bytes())
+            self._journal_offset = max(self._journal_offset, blob.name)
+            backlog += blob.name > self._manifest_offset
+
+        self._index(entries)
+        self._last_refresh = time.monotonic()
+        if self._compact_backlog and backlog >= self._compact_backlog:
+            self._compact_in_background()
+
+    def _compact_in_background(self):
+        if not self._compacting.acquire(blocking=False):
+            return  # Already compacting
+
+        def compact():
+            try:
+                compact_manifest(self._bucket)
+            except Exception as e:
+                # Another instance compacted meanwhile, most likely; the next backlog retries
+                print(f"Catalog compaction failed: {e}")
+            finally:
+                self._compacting.release()
+
+        threading.Thread(target=compact, name="catalog-compaction", daemon=True).start()
+
+    def _index(self, entries):
+        by_genre = {}
+        for entry in entries.values():
+            by_genre.setdefault(entry['genre'], []).append(entry)
+        # Swap in complete structures so readers never see a partial index
+        sorted_entries = {}
+        for genre, genre_entries in [(None, list(entries.values()))] + list(by_genre.items()):
+            genre_entries = sorted(genre_entries, key=lambda entry: entry['id'])
+            sorted_entries[genre] = ([entry['id'] for entry in genre_entries], genre_entries)
+        self._entries = entries
+        self._by_genre = by_genre
+        self._all = list(entries.values())
+        self._sorted = sorted_entries
+
+
+if __name__ == '__main__':
+    from google.cloud import storage
+
+    bucket = storage.Client().bucket('storytellerbucket')
+    command = sys.argv[1] if len(sys.argv) > 1 else 'compact'
+    if command == 'rebuild':
+        print(f"Rebuilt manifest with {rebuild_manifest(bucket)} stories")
+    elif command == 'compact':
+        print(f"Folded {compact_manifest(bucket)} journal entries into the manifest")
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,76 @@
+import json
+import threading
+import time
+
+
+class StoryCheckpoint:
+    """Persisted stage outputs of one story pipeline.
+
+    Everything lives under stories/<genre>/<story_id>/:
+
+    * stage_manifest.json - the pipeline request, the checkpointed stages and
+      the pipeline status. Written when the pipeline starts and ends, so that
+      concurrent stages never contend on a single object.
+    * checkpoints/<stage>.json - the output of every completed stage.
+    """
+
+    def __init__(self, bucket, genre, story_id):
+        self.bucket = bucket
+        self.genre = genre
+        self.story_id = story_id
+        self.prefix = f'stories/{genre}/{story_id}/'
+        self._lock = threading.Lock()
+        self._manifest = None
+
+    @property
+    def manifest_blob_name(self):
+        return self.prefix + 'stage_manifest.json'
+
+    def _stage_blob_name(self, stage):
+        return f'{self.prefix}checkpoints/{stage}.json'
+
+    def start(self, request, stages):
+        """Record the pipeline request, unless this is a resumed pipeline, and its checkpointed stages."""
+        manifest = self.load_manifest()
+        if manifest is None:
+            manifest = {'request': request, 'created_at': time.time()}
+        manifest.update({'stages': stages, 'status': 'running', 'updated_at': time.time()})
+        self._write_manifest(manifest)
+
+    def finish(self, status, error=None):
+        manifest = dict(self.load_manifest() or {})
+        manifest.update({'status': status, 'error': error, 'updated_at': time.time()})
+        self._write_manifest(manifest)
+
+    def replace(self, genre, story_id):
+        """Record that the story was replaced by story_id in genre, a new story for the same idempotency key."""
+        manifest = dict(self.load_manifest() or {})
+        manifest.update({'replaced_by': {'genre': genre, 'story_id': story_id}, 'updated_at': time.time()})
+        self._write_manifest(manifest)
+
+    def load_manifest(self):
+        with self._lock:
+            if self._manifest is None:
+                blob = self.bucket.get_blob(self.manifest_blob_name)
+                if blob is not None:
+                    self._manifest = json.loads(blob.download_as_bytes())
+            return self._manifest
+
+    def _write_manifest(self, manifest):
+        with self._lock:
+            self._manifest = manifest
+            blob = self.bucket.blob(self.manifest_blob_name)
+            blob.upload_from_string(json.dumps(manifest), content_type='application/json')
+
+    def record(self, stage, result):
+        blob = self.bucket.blob(self._stage_blob_name(stage))
+        blob.upload_from_string(json.dumps(result), content_type='application/json')
+
+    def completed(self):
+        """Return the outputs of every checkpointed stage, keyed by stage name."""
+        results = {}
+        prefix = f'{self.prefix}checkpoints/'
+        for blob in self.bucket.list_blobs(prefix=prefix):
+            if blob.name.endswith('.json'):
+                results[blob.name[len(prefix):-len('.json')]] = json.loads(blob.download_as_bytes())
+        return results
@@ -0,0 +1,75 @@
+"""Registry of lazily created service clients.
+
+Clients, and the secrets they are built from, are created on first use
+instead of at import time, so a process can bind its port and answer
+requests right away. warm_up_in_background() creates them ahead of the
+first request that needs them. Every client is created once and shared by
+all threads; a client whose creation failed is retried on its next use.
+"""
+import threading
+
+_factories = {}
+_locks = {}
+_instances = {}
+_registry_lock = threading.Lock()
+
+
+def register(name, factory):
+    """Register how to create a client; returns a LazyClient standing in for it."""
+    with _registry_lock:
+        _factories[name] = factory
+        _locks[name] = threading.Lock()
+    return LazyClient(name)
+
+
+def get(name):
+    instance = _instances.get(name)
+    if instance is not None:
+        return instance
+    with _locks[name]:
+        if name not in _instances:
+            _instances[name] = _factories[name]()
+        return _instances[name]
+
+
+class LazyClient:
+    """Forwards attribute access to a registered client, creating it on first use.
+
+    Pass get(name) instead to code that type-checks its arguments, such as
+    the credentials of generate_signed_url.
+    """
+
+    __slots__ = ('_name',)
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(get(self._name), attr)
+
+    def __repr__(self):
+        return f"<LazyClient {self._name}>"
+
+
+def warm_up(names=None):
+    """Create the given (by default all) registered clients, ignoring failures."""
+    for name in names or list(_factories):
+        try:
+            get(name)
+        except Exception:
+            pass  # Raised again on first use
+
+
+def warm_up_in_background(names=None, then=()):
+    """Warm up clients on a daemon thread, then run the callables in then."""
+    def run():
+        warm_up(names)
+        for task in then:
+            try:
+                task()
+            except Exception:
+                pass
+
+    thread = threading.Thread(target=run, name="client-warm-up", daemon=True)
+    thread.start()
+    return thread
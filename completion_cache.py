@@ -0,0 +1,66 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class CompletionCache:
+    """On-disk cache of chat completions.
+
+    Entries expire ttl_seconds after they were written, and the least
+    recently used entries are evicted once the cached text exceeds max_bytes.
+    """
+
+    def __init__(self, path, max_bytes, ttl_seconds):
+        self._max_bytes = max_bytes
+        self._ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)")
+        self._db.commit()
+
+    @staticmethod
+    def key(model, messages, max_tokens, temperature=None, seed=None):
+        request = [model, messages, max_tokens, temperature, seed]
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, created FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now - self._ttl_seconds:
+                self._db.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            self._db.execute("UPDATE completions SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            return row[0]
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode('utf-8')), now, now)
+            )
+            self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now):
+        self._db.execute("DELETE FROM completions WHERE created < ?", (now - self._ttl_seconds,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self._max_bytes:
+            return
+        for key, size in self._db.execute("SELECT key, size FROM completions ORDER BY accessed").fetchall():
+            self._db.execute("DELETE FROM completions WHERE key = ?", (key,))
+            total -= size
+            if total <= self._max_bytes:
+                break
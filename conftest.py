@@ -0,0 +1,14 @@
+"""Runs the tests against the fakes in fakes.py.
+
+Unlike test_generate_stories.py, which drives running servers and is run
+as a script, they need neither servers nor credentials: python -m pytest -q
+"""
+import os
+import tempfile
+
+os.environ.setdefault("STORYTELLER_FAKE_BACKENDS", "1")
+for _backend in ("OPENAI", "DALLE", "TTS", "GCS"):
+    os.environ.setdefault(f"FAKE_{_backend}_LATENCY", "0")
+os.environ.setdefault("TTS_CACHE_DIR", tempfile.mkdtemp(prefix="storyteller-tts-cache-"))
+
+collect_ignore = ["test_generate_stories.py"]
@@ -0,0 +1,420 @@
+"""In-process stand-ins for OpenAI, Google Text-to-Speech and Cloud Storage.
+
+They implement just the parts of each client that the pipeline uses, with a
+configurable latency, jitter and error rate per backend, so that the
+pipeline can be benchmarked offline. app.py uses them instead of the real
+clients when STORYTELLER_FAKE_BACKENDS is set; every backend is configured
+with FAKE_<BACKEND>_LATENCY (mean seconds per call), FAKE_<BACKEND>_JITTER
+(fraction of the latency), FAKE_<BACKEND>_ERROR_RATE and FAKE_<BACKEND>_QUOTA
+(requests per minute, beyond which calls are throttled like the real API
+throttles them), where <BACKEND> is OPENAI, DALLE, TTS or GCS.
+"""
+import io
+import os
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+import zlib
+from google.api_core.exceptions import ResourceExhausted
+
+# A silent MPEG-2 Layer III frame: 32 kbps, 24 kHz, mono, like Google TTS MP3s
+MP3_FRAME_HEADER = b'\xff\xf3\x44\xc4'
+MP3_FRAME_BYTES = 96
+MP3_FRAME_SECONDS = 576 / 24000
+MP3_FRAME = MP3_FRAME_HEADER + bytes(MP3_FRAME_BYTES - len(MP3_FRAME_HEADER))
+
+# Characters spoken per second, to size the fake audio
+SPOKEN_CHARS_PER_SECOND = 14
+
+_MARK = re.compile(r'<mark name="([^"]*)"/>')
+# How translation.py tells how many paragraphs to translate
+_PARAGRAPH_COUNT = re.compile(r'It has (\d+) paragraph')
+_TAG = re.compile(r'<[^>]*>')
+
+_WORDS = (
+    "the", "a", "little", "dragon", "star", "ship", "forest", "moon", "brave", "quiet",
+    "river", "castle", "robot", "found", "smiled", "flew", "over", "under", "light", "dream",
+    "friend", "old", "map", "secret", "door", "sang", "across", "bright", "cloud", "home"
+)
+
+
+class FakeBackendError(Exception):
+    """An injected failure of a fake backend."""
+
+
+class FakeRateLimitError(Exception):
+    """A throttled call, shaped like openai.RateLimitError: HTTP 429 with a Retry-After."""
+
+    status_code = 429
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.response = _Record(headers={'retry-after-ms': str(round(retry_after * 1000))} if retry_after else {})
+
+
+class Latency:
+    """Sleeps for about mean seconds per call, and fails error_rate of the calls.
+
+    With a quota (requests per minute), calls beyond it are rejected with a
+    throttled error, as by a token bucket holding one second of requests.
+    """
+
+    def __init__(self, mean=0.0, jitter=0.0, error_rate=0.0, error=FakeBackendError, quota=0,
+                 throttled=FakeRateLimitError):
+        self.mean = mean
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error = error
+        self.quota = quota
+        self.throttled = throttled
+        self.throttled_calls = 0
+        self._tokens = max(quota / 60, 1)
+        self._refilled = time.monotonic()
+        self._random = random.Random()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, backend, mean, error=FakeBackendError, throttled=FakeRateLimitError):
+        prefix = f"FAKE_{backend.upper()}_"
+        return cls(
+            mean=float(os.getenv(prefix + "LATENCY", str(mean))),
+            jitter=float(os.getenv(prefix + "JITTER", "0.2")),
+            error_rate=float(os.getenv(prefix + "ERROR_RATE", "0")),
+            error=error,
+            quota=float(os.getenv(prefix + "QUOTA", "0")),
+            throttled=throttled
+        )
+
+    def admit(self):
+        """Raise the throttled error if the call exceeds the quota."""
+        if not self.quota:
+            return
+        rate = self.quota / 60
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - self._refilled) * rate, max(rate, 1))
+            self._refilled = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            self.throttled_calls += 1
+            retry_after = (1 - self._tokens) / rate
+        message = f"Quota of {self.quota:g} requests per minute exceeded"
+        if issubclass(self.throttled, FakeRateLimitError):
+            raise self.throttled(message, retry_after)
+        raise self.throttled(message)
+
+    def wait(self, scale=1.0, admit=True):
+        if admit:
+            self.admit()
+        with self._lock:
+            delay = self.mean * scale * self._random.uniform(1 - self.jitter, 1 + self.jitter)
+            fail = self._random.random() < self.error_rate
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            raise self.error(f"Injected {self.error.__name__}")
+
+
+def fake_text(rng, paragraphs=6, sentences=5):
+    result = []
+    for _ in range(paragraphs):
+        result.append(' '.join(
+            ' '.join(rng.choice(_WORDS) for _ in range(rng.randint(6, 14))).capitalize() + '.'
+            for _ in range(sentences)
+        ))
+    return '\n\n'.join(result)
+
+
+def fake_png(width=1024, height=1024):
+    """An RGB PNG of a noisy gradient, about as large as a generated illustration."""
+    noise = random.Random(0).randbytes(width * 3)
+    rows = b''.join(
+        b'\x00' + bytes(((x // 3) * 7 + y * 3) % 256 ^ (noise[(x + y * 17) % len(noise)] & 0x3f)
+                         for x in range(width * 3))
+        for y in range(height)
+    )
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
+def fake_mp3(seconds):
+    return MP3_FRAME * max(1, int(seconds / MP3_FRAME_SECONDS))
+
+
+class _Record:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def model_dump(self):
+        return {key: _dump(value) for key, value in self.__dict__.items()}
+
+
+def _dump(value):
+    if isinstance(value, _Record):
+        return value.model_dump()
+    if isinstance(value, list):
+        return [_dump(item) for item in value]
+    return value
+
+
+class FakeOpenAI:
+    """Chat completions (plain and streamed) and image generation.
+
+    Completions are random stories of about the requested length, so that
+    every story renders to different audio.
+    """
+
+    def __init__(self, chat_latency=None, image_latency=None, paragraphs=6):
+        self.chat_latency = chat_latency or Latency()
+        self.image_latency = image_latency or Latency()
+        self.paragraphs = paragraphs
+        self.chat = _Record(completions=_FakeCompletions(self))
+        self.images = _FakeImages(self)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            chat_latency=Latency.from_env("openai", 2.0),
+            image_latency=Latency.from_env("dalle", 5.0),
+            paragraphs=int(os.getenv("FAKE_STORY_PARAGRAPHS", "6"))
+        )
+
+
+class _FakeCompletions:
+    def __init__(self, openai):
+        self._openai = openai
+
+    def create(self, model, messages, max_tokens=None, stream=False, seed=None, **kwargs):
+        rng = random.Random(seed) if seed is not None else random.Random()
+        paragraphs = self._openai.paragraphs if max_tokens is None or max_tokens > 500 else 1
+        # Translations have as many paragraphs as their source
+        count = _PARAGRAPH_COUNT.search(messages[-1]["content"])
+        if count:
+            paragraphs = int(count.group(1))
+        content = fake_text(rng, paragraphs)
+        if stream:
+            self._openai.chat_latency.admit()
+            return self._stream(content)
+        self._openai.chat_latency.wait()
+        message = _Record(role="assistant", content=content)
+        return _Record(
+            id=f"chatcmpl-{uuid.uuid4().hex}", model=model,
+            choices=[_Record(index=0, message=message, finish_reason="stop")]
+        )
+
+    def _stream(self, content):
+        # The latency is spread over the streamed chunks
+        pieces = content.split(' ')
+        for i, piece in enumerate(pieces):
+            self._openai.chat_latency.wait(1 / len(pieces), admit=False)
+            delta = _Record(content=piece if i == 0 else ' ' + piece)
+            yield _Record(choices=[_Record(index=0, delta=delta)])
+
+
+class _FakeImages:
+    def __init__(self, openai):
+        self._openai = openai
+
+    def generate(self, model, prompt, n=1, size="1024x1024", **kwargs):
+        self._openai.image_latency.wait()
+        return _Record(data=[_Record(url=f"fake://images/{uuid.uuid4().hex}.png") for _ in range(n)])
+
+
+class FakeTextToSpeech:
+    """synthesize_speech() returns silent MP3 audio as long as the input would take to speak,
+    and the time of every SSML mark.
+
+    Injected errors and throttled calls are ResourceExhausted, like the TTS
+    quota errors the pipeline retries.
+    """
+
+    def __init__(self, latency=None):
+        self.latency = latency or Latency(error=ResourceExhausted)
+
+    @classmethod
+    def from_env(cls):
+        return cls(Latency.from_env("tts", 1.0, error=ResourceExhausted, throttled=ResourceExhausted))
+
+    def synthesize_speech(self, request=None, input=None, voice=None, audio_config=None, **kwargs):
+        self.latency.wait()
+        ssml = (request.input if request is not None else input).ssml
+        # Every mark is reached after the text before it has been spoken
+        timepoints = []
+        spoken = 0
+        position = 0
+        for mark in _MARK.finditer(ssml):
+            spoken += len(_TAG.sub('', ssml[position:mark.start()]))
+            position = mark.end()
+            timepoints.append(_Record(mark_name=mark.group(1), time_seconds=spoken / SPOKEN_CHARS_PER_SECOND))
+        spoken += len(_TAG.sub('', ssml[position:]))
+        return _Record(audio_content=fake_mp3(spoken / SPOKEN_CHARS_PER_SECOND), timepoints=timepoints)
+
+
+class FakeHTTPSession:
+    """Serves the images returned by FakeOpenAI, all as the same 1024x1024 PNG."""
+
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self._image = None
+
+    def get(self, url, stream=False, timeout=None):
+        self.latency.wait()
+        if self._image is None:
+            self._image = fake_png()
+        return _FakeHTTPResponse(self._image)
+
+
+class _FakeHTTPResponse:
+    def __init__(self, content):
+        self.content = content
+        self.raw = io.BytesIO(content)
+
+    def raise_for_status(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeBucket:
+    """An in-memory Cloud Storage bucket with object generations."""
+
+    def __init__(self, name='storytellerbucket', latency=None):
+        self.name = name
+        self.latency = latency or Latency()
+        self._objects = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    @classmethod
+    def from_env(cls, name='storytellerbucket'):
+        return cls(name, Latency.from_env("gcs", 0.05))
+
+    def blob(self, blob_name, chunk_size=None):
+        return FakeBlob(self, blob_name)
+
+    def get_blob(self, blob_name):
+        self.latency.wait()
+        with self._lock:
+            stored = self._objects.get(blob_name)
+        if stored is None:
+            return None
+        blob = FakeBlob(self, blob_name)
+        blob.generation, blob.size = stored[1], len(stored[0])
+        return blob
+
+    def list_blobs(self, prefix='', start_offset=None):
+        self.latency.wait()
+        with self._lock:
+            names = sorted(name for name in self._objects
+                           if name.startswith(prefix) and (not start_offset or name >= start_offset))
+        return [FakeBlob(self, name) for name in names]
+
+    def clear(self):
+        with self._lock:
+            self._objects.clear()
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(len(data) for data, _ in self._objects.values())
+
+    def _put(self, blob_name, data, if_generation_match=None):
+        with self._lock:
+            if if_generation_match is not None:
+                stored = self._objects.get(blob_name)
+                if (stored[1] if stored is not None else 0) != if_generation_match:
+                    raise FakeBackendError(f"Generation mismatch for {self.name}/{blob_name}")
+            self._generation += 1
+            self._objects[blob_name] = (data, self._generation)
+            return self._generation
+
+    def _get(self, blob_name, if_generation_match=None):
+        with self._lock:
+            stored = self._objects.get(blob_name)
+        if stored is None:
+            raise FileNotFoundError(f"No such object: {self.name}/{blob_name}")
+        if if_generation_match is not None and stored[1] != if_generation_match:
+            raise FakeBackendError(f"Generation mismatch for {self.name}/{blob_name}")
+        return stored[0]
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+        self.size = None
+
+    @property
+    def public_url(self):
+        return f"https://storage.googleapis.com/{self.bucket.name}/{self.name}"
+
+    def exists(self):
+        return self.bucket.get_blob(self.name) is not None
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None, **kwargs):
+        self.bucket.latency.wait()
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.generation = self.bucket._put(self.name, data, if_generation_match)
+        self.size = len(data)
+
+    def upload_from_file(self, file_obj, content_type=None, **kwargs):
+        self.upload_from_string(file_obj.read(), content_type)
+
+    def download_as_bytes(self, if_generation_match=None, **kwargs):
+        self.bucket.latency.wait()
+        return self.bucket._get(self.name, if_generation_match)
+
+    download_as_string = download_as_bytes
+
+    def open(self, mode='rb', content_type=None, **kwargs):
+        if 'w' in mode:
+            return _FakeUpload(self, content_type)
+        return io.BytesIO(self.download_as_bytes())
+
+    def delete(self):
+        self.bucket.latency.wait()
+        with self.bucket._lock:
+            self.bucket._objects.pop(self.name, None)
+
+    def generate_signed_url(self, version="v4", expiration=None, method='GET', **kwargs):
+        return f"{self.public_url}?X-Goog-Signature={uuid.uuid4().hex}"
+
+
+class _FakeUpload(io.BytesIO):
+    def __init__(self, blob, content_type):
+        super().__init__()
+        self._blob = blob
+        self._content_type = content_type
+
+    def close(self):
+        if not self.closed:
+            self._blob.upload_from_string(self.getvalue(), self._content_type)
+        super().close()
+
+    def terminate(self):
+        """Cancel the upload, like BlobWriter.terminate: nothing is stored."""
+        super().close()
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is not None:
+            self.terminate()
+        else:
+            self.close()
+
+
+def backends_from_env(bucket_name='storytellerbucket'):
+    """Return (bucket, openai_client, tts_client, http_session) fakes configured from the environment."""
+    return FakeBucket.from_env(bucket_name), FakeOpenAI.from_env(), FakeTextToSpeech.from_env(), FakeHTTPSession()
@@ -0,0 +1,122 @@
+"""Idempotency keys of story generation requests.
+
+A client that retries a request, after a timeout say, sends it again with
+the same Idempotency-Key header. The story of a key gets an id derived
+from the key (story_id), so a retry of a request finds the story of the
+first one in the bucket: its result if it is complete, its checkpoints
+otherwise. Within a process, retries that arrive while the first request
+is still running wait for it and share its result, and completed results
+are kept for IDEMPOTENCY_TTL_SECONDS.
+
+A key may only be reused for the same request; IdempotencyConflict is
+raised otherwise.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from single_flight import SingleFlight
+import metrics
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+# Story ids of keys are uuid5s in this namespace
+STORY_NAMESPACE = uuid.UUID('6f1c1a52-8d2e-4b8f-9a57-3c1f0e4d2b71')
+
+idempotent_requests_total = metrics.counter(
+    "storyteller_idempotent_requests_total", "Requests with an idempotency key, by how they were served"
+)
+
+
+class IdempotencyConflict(Exception):
+    """Raised when an idempotency key is reused for a different request."""
+
+
+def valid_key(key):
+    return bool(key) and len(key) <= MAX_KEY_LENGTH
+
+
+def story_id(key):
+    """The story id of the story generated for key."""
+    return str(uuid.uuid5(STORY_NAMESPACE, key))
+
+
+class IdempotentRequests:
+    """Runs each idempotency key's request at most once at a time, and remembers its result.
+
+    Results are kept for ttl_seconds, and at most max_keys of them; the
+    oldest are forgotten first.
+    """
+
+    def __init__(self, ttl_seconds, max_keys=1000):
+        self._ttl_seconds = ttl_seconds
+        self._max_keys = max_keys
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+        self._requests = {}  # The request of every key in flight
+        self._results = OrderedDict()  # key -> (request, finished_at, result)
+
+    def run(self, key, request, func):
+        """Return (result, replayed): func()'s result, or that of an earlier call with the same key.
+
+        replayed is true when the result is not that of this call, but of a
+        completed or in-flight one. Results with an "error" aren't kept, and
+        neither are exceptions, so a failed request can be retried.
+        """
+        ran = []
+
+        def once():
+            try:
+                # The result may have been stored since run() looked for it
+                result = self._result(key, request)
+                if result is None:
+                    ran.append(True)
+                    result = func()
+                    if not (isinstance(result, dict) and "error" in result):
+                        self._store(key, request, result)
+                return result
+            finally:
+                with self._lock:
+                    self._requests.pop(key, None)
+
+        result = self._result(key, request)
+        if result is not None:
+            idempotent_requests_total.inc(outcome="completed")
+            return result, True
+        with self._lock:
+            if self._requests.setdefault(key, request) != request:
+                raise IdempotencyConflict(f"Idempotency key {key} was used for a different request")
+        result = self._flight.do(key, once)
+        idempotent_requests_total.inc(outcome="ran" if ran else "joined")
+        return result, not ran
+
+    def check(self, key, request):
+        """Raise IdempotencyConflict if key is in flight, or has a result, for a request other than request."""
+        with self._lock:
+            in_flight = self._requests.get(key)
+        if in_flight is not None and in_flight != request:
+            raise IdempotencyConflict(f"Idempotency key {key} was used for a different request")
+        self._result(key, request)
+
+    def _result(self, key, request):
+        with self._lock:
+            self._purge_expired()
+            if key not in self._results:
+                return None
+            stored_request, _, result = self._results[key]
+        if stored_request != request:
+            raise IdempotencyConflict(f"Idempotency key {key} was used for a different request")
+        return result
+
+    def _store(self, key, request, result):
+        with self._lock:
+            self._results[key] = (request, time.time(), result)
+            self._results.move_to_end(key)
+            while len(self._results) > self._max_keys:
+                self._results.popitem(last=False)
+
+    def _purge_expired(self):
+        cutoff = time.time() - self._ttl_seconds
+        while self._results and next(iter(self._results.values()))[1] < cutoff:
+            self._results.popitem(last=False)
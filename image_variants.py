@@ -0,0 +1,116 @@
+"""Resized, compressed variants of the story images.
+
+Every stored PNG gets a variant per width in IMAGE_VARIANT_WIDTHS and format
+in IMAGE_VARIANT_FORMATS, stored next to it as image_<n>_<width>w.<ext>.
+Encoding runs on a process pool, so it neither holds the GIL of the
+pipeline threads nor waits for it. Pillow is optional: without it no
+variants are made and clients keep getting the original PNGs.
+"""
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+VARIANT_WIDTHS = tuple(int(width) for width in os.getenv("IMAGE_VARIANT_WIDTHS", "320,640,1024").split(','))
+VARIANT_FORMATS = tuple(os.getenv("IMAGE_VARIANT_FORMATS", "webp,jpeg").split(','))
+VARIANT_QUALITY = int(os.getenv("IMAGE_VARIANT_QUALITY", "80"))
+
+# Pillow format name, file extension and content type of every supported format,
+# in order of preference when a client accepts several
+FORMATS = {
+    "avif": ("AVIF", "avif", "image/avif"),
+    "webp": ("WEBP", "webp", "image/webp"),
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _supported(fmt):
+    if fmt == "jpeg":
+        return True
+    try:
+        return features.check(fmt)
+    except ValueError:  # Pillow versions that don't know the format at all
+        return False
+
+
+def enabled_formats():
+    if Image is None:
+        return ()
+    return tuple(fmt for fmt in VARIANT_FORMATS if fmt in FORMATS and _supported(fmt))
+
+
+def variant_blob_name(blob_name, width, fmt):
+    return f"{blob_name.rsplit('.', 1)[0]}_{width}w.{FORMATS[fmt][1]}"
+
+
+def encode_variants(data, widths, formats, quality):
+    """Return (width, format, encoded bytes) for every variant of the image in data.
+
+    Runs in the worker processes. Widths at or above the original width are
+    encoded at the original size.
+    """
+    original = Image.open(io.BytesIO(data))
+    original.load()
+    if original.mode not in ("RGB", "L"):
+        original = original.convert("RGB")
+    variants = []
+    for width in sorted(set(min(width, original.width) for width in widths)):
+        resized = original if width == original.width else original.resize(
+            (width, round(original.height * width / original.width)), Image.LANCZOS
+        )
+        for fmt in formats:
+            out = io.BytesIO()
+            resized.save(out, FORMATS[fmt][0], quality=quality)
+            variants.append((width, fmt, out.getvalue()))
+    return variants
+
+
+def _process_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned, not forked: forking a process with running threads and open
+            # gRPC channels can deadlock or abort the child
+            _pool = ProcessPoolExecutor(
+                max_workers=int(os.getenv("IMAGE_WORKERS", str(os.cpu_count() or 1))),
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool
+
+
+def encode(data):
+    """Encode the configured variants of an image on the process pool."""
+    formats = enabled_formats()
+    if not formats or not VARIANT_WIDTHS:
+        return []
+    return _process_pool().submit(encode_variants, data, VARIANT_WIDTHS, formats, VARIANT_QUALITY).result()
+
+
+def pick_variant(variants, width, formats):
+    """Pick the variant to serve for a display width, or None for the original.
+
+    variants are dicts with width and format, formats are the formats the
+    client accepts. The most preferred accepted format is used, at the
+    smallest width that is at least the requested one (or the largest one).
+    """
+    for fmt in FORMATS:
+        if fmt not in formats:
+            continue
+        candidates = sorted((variant for variant in variants if variant['format'] == fmt),
+                            key=lambda variant: variant['width'])
+        if not candidates:
+            continue
+        for variant in candidates:
+            if variant['width'] >= width:
+                return variant
+        return candidates[-1]
+    return None
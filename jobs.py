@@ -0,0 +1,115 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+jobs_in_flight = metrics.gauge("storyteller_jobs", "Background jobs by state")
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue is at its maximum depth."""
+
+
+class Job:
+    def __init__(self, job_id):
+        self.id = job_id
+        self.status = "queued"
+        self.stages = {}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def update_stage(self, stage, status):
+        # Called from the pipeline's stage threads
+        with self._lock:
+            self.stages[stage] = status
+
+    def to_dict(self):
+        job = {
+            "job_id": self.id,
+            "status": self.status,
+            "stages": self._stages_snapshot(),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+        if self.result is not None:
+            job["result"] = self.result
+        if self.error is not None:
+            job["error"] = self.error
+        return job
+
+    def _stages_snapshot(self):
+        with self._lock:
+            return dict(self.stages)
+
+
+class JobQueue:
+    """Runs jobs on a bounded pool of background workers.
+
+    Submissions are rejected with QueueFull once max_queue_depth jobs are
+    waiting for a worker. Finished jobs are kept for retention_seconds so
+    that clients can poll for the result.
+    """
+
+    def __init__(self, max_workers, max_queue_depth, retention_seconds=3600):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._max_queue_depth = max_queue_depth
+        self._retention_seconds = retention_seconds
+        self._jobs = {}
+        self._queued = 0
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, progress=job.update_stage, **kwargs) and return the job."""
+        with self._lock:
+            self._purge_expired()
+            if self._queued >= self._max_queue_depth:
+                raise QueueFull(f"{self._queued} jobs are already waiting")
+            job = Job(str(uuid.uuid4()))
+            self._jobs[job.id] = job
+            self._queued += 1
+        jobs_in_flight.inc(state="queued")
+        self._executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def depth(self):
+        with self._lock:
+            return self._queued
+
+    def full(self):
+        """Whether a job submitted now would be rejected with QueueFull."""
+        return self.depth() >= self._max_queue_depth
+
+    def _run(self, job, func, args, kwargs):
+        with self._lock:
+            self._queued -= 1
+        jobs_in_flight.dec(state="queued")
+        jobs_in_flight.inc(state="running")
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            job.result = func(*args, progress=job.update_stage, **kwargs)
+            failed = isinstance(job.result, dict) and "error" in job.result
+            job.status = "failed" if failed else "succeeded"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            jobs_in_flight.dec(state="running")
+
+    def _purge_expired(self):
+        cutoff = time.time() - self._retention_seconds
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
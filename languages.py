@@ -0,0 +1,36 @@
+"""The languages stories are written and translated in.
+
+Stories are written in SOURCE_LANGUAGE and translated to every language in
+TARGET_LANGUAGES (comma separated language codes, "tr" by default). Each
+language is stored as content_<code> and has its own voices in tts.py.
+"""
+import os
+
+# Every language stories can be translated to, by code
+LANGUAGES = {
+    "en": "English",
+    "tr": "Turkish",
+    "de": "German",
+    "es": "Spanish",
+    "fr": "French",
+}
+
+# How a name is adapted to the language, for the translation prompts
+NAME_EXAMPLES = {
+    "tr": ("Sir Alaric", "Sör Alarik"),
+}
+
+SOURCE_LANGUAGE = "en"
+TARGET_LANGUAGES = tuple(code for code in os.getenv("TARGET_LANGUAGES", "tr").split(',') if code)
+for _code in TARGET_LANGUAGES:
+    if _code not in LANGUAGES or _code == SOURCE_LANGUAGE:
+        raise ValueError(f"Unsupported target language in TARGET_LANGUAGES: {_code}")
+STORY_LANGUAGES = (SOURCE_LANGUAGE,) + TARGET_LANGUAGES
+
+# Stories stored before the languages were configurable don't list theirs
+LEGACY_LANGUAGES = ("en", "tr")
+
+
+def story_languages(record):
+    """The languages of a stored story, given its catalog entry or meta.json."""
+    return tuple(record.get('languages', LEGACY_LANGUAGES))
@@ -0,0 +1,237 @@
+"""Per-provider rate limiting and retries of calls to external APIs.
+
+Every provider (openai, dalle, tts, gcs) has one AdaptiveLimiter, shared by
+all threads of the process. It bounds both the number of calls in flight
+and the rate at which calls start (a token bucket, configured in requests
+per minute). Both limits adapt to the provider: a throttled call (HTTP 429,
+or gRPC RESOURCE_EXHAUSTED) halves them, and every successful call raises
+them again, additively, up to their configured maximum. A Retry-After on a
+throttled call holds back every caller of the provider, not just the one
+that got it.
+
+Configured per provider with <PROVIDER>_CONCURRENCY,
+<PROVIDER>_REQUESTS_PER_MINUTE (0 for no rate limit),
+<PROVIDER>_MAX_RETRIES and <PROVIDER>_RETRY_BASE_DELAY.
+"""
+import datetime
+import email.utils
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+import metrics
+
+# Default concurrency and requests per minute of every provider
+PROVIDER_DEFAULTS = {
+    "openai": (8, 500),
+    "dalle": (4, 15),
+    "tts": (8, 1000),
+    "gcs": (16, 0),
+}
+# Calls allowed to start at once above the rate, in seconds' worth of calls
+BURST_SECONDS = float(os.getenv("RATE_LIMIT_BURST_SECONDS", "1.0"))
+# Retry delays never exceed this many seconds
+MAX_RETRY_DELAY = float(os.getenv("RATE_LIMIT_MAX_RETRY_DELAY", "60"))
+# How far throttling lowers the limits, and how fast they grow back: the
+# concurrency by one per round of calls, the rate by RATE_INCREASE of its
+# maximum per second. Calls throttled within DECREASE_INTERVAL seconds of a
+# decrease were most likely sent before it, so they don't lower the limits
+# again.
+DECREASE_FACTOR = 0.5
+DECREASE_INTERVAL = 1.0
+RATE_INCREASE = 0.05
+
+# HTTP status codes of calls that are retried
+THROTTLED_STATUSES = (429,)
+TRANSIENT_STATUSES = (500, 502, 503, 504)
+
+provider_wait_seconds = metrics.histogram(
+    "storyteller_provider_wait_seconds", "Time spent waiting for a provider's concurrency and rate limits"
+)
+concurrency_limit = metrics.gauge("storyteller_provider_concurrency_limit", "Current concurrency limit per provider")
+current_rate = metrics.gauge("storyteller_provider_rate_limit", "Current rate limit per provider, in requests per second")
+calls_in_flight = metrics.gauge("storyteller_provider_calls_in_flight", "Calls in flight per provider")
+throttled_total = metrics.counter("storyteller_provider_throttled_total", "Calls throttled by the provider")
+retries_total = metrics.counter("storyteller_provider_retries_total", "Retried calls, by provider and reason")
+
+
+def _status(error):
+    # openai errors have a status_code, google.api_core errors an HTTP code
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(error, 'code', None)
+    return status if isinstance(status, int) else None
+
+
+def retry_reason(error):
+    """Why a failed call should be retried ("throttled" or "transient"), or None if it shouldn't."""
+    status = _status(error)
+    if status in THROTTLED_STATUSES:
+        return "throttled"
+    if status in TRANSIENT_STATUSES:
+        return "transient"
+    # Matched by name, so that the openai package needn't be imported here
+    if any(cls.__name__ == 'APIConnectionError' for cls in type(error).__mro__):
+        return "transient"
+    return None
+
+
+def retry_after(error):
+    """The seconds to wait given by the Retry-After of a failed call's response, if any."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    value = headers.get('retry-after-ms')
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    # Retry-After may also be an HTTP date
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):  # Malformed: raised by Python 3.10+, older versions return None
+        return None
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(date.timestamp() - time.time(), 0)
+
+
+class AdaptiveLimiter:
+    """Concurrency and rate limits of one provider that back off when it throttles calls."""
+
+    def __init__(self, provider, max_concurrency, requests_per_minute=0, max_retries=5, retry_base_delay=1.0):
+        self.provider = provider
+        self.max_concurrency = max_concurrency
+        self.max_rate = requests_per_minute / 60
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.concurrency = float(max_concurrency)
+        self.rate = self.max_rate
+        self._in_flight = 0
+        self._next_start = 0.0  # When the next call may start at the current rate
+        self._paused_until = 0.0
+        self._last_decrease = float('-inf')
+        self._condition = threading.Condition()
+        self._publish()
+
+    @classmethod
+    def from_env(cls, provider):
+        concurrency, requests_per_minute = PROVIDER_DEFAULTS[provider]
+        prefix = provider.upper() + "_"
+        return cls(
+            provider,
+            max_concurrency=int(os.getenv(prefix + "CONCURRENCY", str(concurrency))),
+            requests_per_minute=float(os.getenv(prefix + "REQUESTS_PER_MINUTE", str(requests_per_minute))),
+            max_retries=int(os.getenv(prefix + "MAX_RETRIES", os.getenv("RATE_LIMIT_MAX_RETRIES", "5"))),
+            retry_base_delay=float(os.getenv(prefix + "RETRY_BASE_DELAY", "1.0"))
+        )
+
+    def _publish(self):
+        concurrency_limit.set(round(self.concurrency, 2), provider=self.provider)
+        current_rate.set(round(self.rate, 3), provider=self.provider)
+        calls_in_flight.set(self._in_flight, provider=self.provider)
+
+    def _acquire(self):
+        with self._condition:
+            while self._in_flight >= max(int(self.concurrency), 1):
+                self._condition.wait()
+            self._in_flight += 1
+            self._publish()
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                start = max(now, self._paused_until)
+                if self.rate > 0:
+                    # Calls are spaced 1/rate apart, with up to BURST_SECONDS of them at once
+                    start = max(start, self._next_start - BURST_SECONDS)
+                if start <= now:
+                    if self.rate > 0:
+                        self._next_start = max(self._next_start, now) + 1 / self.rate
+                    return
+            # Waited for outside the lock, since a throttled call may push the start back meanwhile
+            time.sleep(start - now)
+
+    def _release(self, error=None):
+        with self._condition:
+            self._in_flight -= 1
+            try:
+                if error is not None and retry_reason(error) == "throttled":
+                    throttled_total.inc(provider=self.provider)
+                    now = time.monotonic()
+                    if now - self._last_decrease >= DECREASE_INTERVAL:
+                        self._last_decrease = now
+                        self.concurrency = max(self.concurrency * DECREASE_FACTOR, 1.0)
+                        self.rate = max(self.rate * DECREASE_FACTOR, self.max_rate * RATE_INCREASE)
+                    delay = retry_after(error)
+                    if delay:
+                        self._paused_until = max(self._paused_until, now + delay)
+                elif error is None:
+                    self.concurrency = min(self.concurrency + 1 / self.concurrency, self.max_concurrency)
+                    if self.rate > 0:
+                        # There are about rate successful calls per second
+                        self.rate = min(self.rate + self.max_rate * RATE_INCREASE / self.rate, self.max_rate)
+            finally:
+                # Whatever happens, the callers waiting for the released slot are woken up
+                self._publish()
+                self._condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """Run the block as one call to the provider, within its limits. It is not retried."""
+        start = time.perf_counter()
+        self._acquire()
+        provider_wait_seconds.observe(time.perf_counter() - start, provider=self.provider)
+        try:
+            yield
+        except BaseException as e:
+            self._release(e)
+            raise
+        else:
+            self._release()
+
+    def call(self, func, *args, **kwargs):
+        """Call func within the provider's limits, retrying throttled and transient failures.
+
+        Retries back off exponentially, with jitter so that parallel callers
+        don't retry in lockstep.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.slot():
+                    return func(*args, **kwargs)
+            except Exception as e:
+                reason = retry_reason(e)
+                if reason is None or attempt == self.max_retries:
+                    raise
+                retries_total.inc(provider=self.provider, reason=reason)
+                delay = min(self.retry_base_delay * 2 ** attempt, MAX_RETRY_DELAY)
+                time.sleep(delay * random.uniform(0.5, 1.5))
+
+
+limiters = {provider: AdaptiveLimiter.from_env(provider) for provider in PROVIDER_DEFAULTS}
+
+
+def call(provider, func, *args, **kwargs):
+    """Call func as a call to provider (see AdaptiveLimiter.call)."""
+    return limiters[provider].call(func, *args, **kwargs)
+
+
+def slot(provider):
+    """Hold a slot of provider for the block, or nothing if provider is None."""
+    if provider is None:
+        return _no_slot()
+    return limiters[provider].slot()
+
+
+@contextmanager
+def _no_slot():
+    yield
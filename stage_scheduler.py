@@ -0,0 +1,176 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import rate_limit
+
+stage_seconds = metrics.histogram("storyteller_stage_seconds", "Time spent running each pipeline stage")
+
+# Shared pool that runs individual stages. Callers of StageScheduler.run() must
+# not themselves be running on this pool, otherwise they could starve it.
+_stage_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("PIPELINE_WORKERS", "32")),
+    thread_name_prefix="stage"
+)
+
+
+class Stage:
+    def __init__(self, name, func, deps, provider, checkpoint):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.provider = provider
+        self.checkpoint = checkpoint
+
+
+class StageScheduler:
+    """Runs a graph of pipeline stages, starting each one as soon as its inputs are ready.
+
+    Every stage is called with the results of its dependencies as positional
+    arguments, in the order the dependencies were declared. If a listener is
+    given it is called as listener(stage_name, status) whenever a stage
+    starts ("running") or ends ("done" or "failed").
+
+    If a checkpoint is given, the result of every stage added with
+    checkpoint=True is passed to checkpoint.record(stage_name, result) before
+    the stage counts as done.
+    """
+
+    def __init__(self, executor=None, listener=None, checkpoint=None):
+        self._executor = executor or _stage_executor
+        self._listener = listener
+        self._checkpoint = checkpoint
+        self._stages = {}
+        self._dependents = {}
+        self._started_at = None
+        self._timings = {}
+
+    def add(self, name, func, deps=(), provider=None, checkpoint=False):
+        if name in self._stages:
+            raise ValueError(f"Duplicate stage: {name}")
+        for dep in deps:
+            if dep not in self._stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dep}")
+            self._dependents[dep].append(name)
+        self._stages[name] = Stage(name, func, deps, provider, checkpoint)
+        self._dependents[name] = []
+
+    def checkpointed_stages(self):
+        return [name for name, stage in self._stages.items() if stage.checkpoint]
+
+    def run(self, completed=None):
+        """Run every stage and return a dict of results keyed by stage name.
+
+        completed maps the names of stages that already ran to their results.
+        Those stages are not run again, and neither are stages whose results
+        are only needed by completed stages (their results are then missing
+        from the returned dict).
+
+        Stages that depend on a failed stage are never started, but the
+        others still run, so that their results are checkpointed and a retry
+        only has to redo the failed part. The first stage error is re-raised
+        once they have finished.
+        """
+        lock = threading.RLock()
+        finished = threading.Event()
+        self._started_at = time.perf_counter()
+        results = dict(completed or {})
+        errors = []
+        running = [0]
+
+        # Stages were added after their dependencies, so walking them backwards
+        # sees every dependent before the stages it depends on
+        needed = set()
+        for name in reversed(list(self._stages)):
+            if name in results:
+                self._notify(name, "resumed")
+            elif not self._dependents[name] or any(dependent in needed for dependent in self._dependents[name]):
+                needed.add(name)
+        waiting = {name: {dep for dep in self._stages[name].deps if dep not in results} for name in needed}
+
+        def start(name):
+            stage = self._stages[name]
+            args = [results[dep] for dep in stage.deps]
+            running[0] += 1
+            self._notify(name, "running")
+            future = self._executor.submit(self._call, stage, args)
+            future.add_done_callback(lambda f: complete(name, f))
+
+        def complete(name, future):
+            with lock:
+                running[0] -= 1
+                try:
+                    results[name] = future.result()
+                    self._notify(name, "done")
+                except BaseException as e:
+                    errors.append(e)
+                    self._notify(name, "failed")
+                else:
+                    for dependent in self._dependents[name]:
+                        if dependent not in waiting:
+                            continue
+                        waiting[dependent].discard(name)
+                        if not waiting[dependent]:
+                            start(dependent)
+                if running[0] == 0:
+                    finished.set()
+
+        with lock:
+            # Stages that finish before their callback is attached complete
+            # synchronously, so hold a token until every root stage has started
+            running[0] += 1
+            for name in [name for name, deps in waiting.items() if not deps]:
+                start(name)
+            running[0] -= 1
+            if running[0] == 0:
+                finished.set()
+
+        finished.wait()
+        if errors:
+            raise errors[0]
+        return results
+
+    def _notify(self, name, status):
+        if self._listener is not None:
+            self._listener(name, status)
+
+    def _call(self, stage, args):
+        queued = time.perf_counter()
+        # A stage with a provider runs as one call to it (see rate_limit.py)
+        with rate_limit.slot(stage.provider):
+            start = time.perf_counter()
+            result = stage.func(*args)
+        if stage.checkpoint and self._checkpoint is not None:
+            self._checkpoint.record(stage.name, result)
+        end = time.perf_counter()
+        stage_seconds.observe(end - start, stage=stage.name)
+        self._timings[stage.name] = (queued, start, end)
+        return result
+
+    def trace(self):
+        """Return the timing of every stage of the last run and its critical path.
+
+        Times are in seconds since the run started. The critical path is the
+        chain of stages, each the last to finish among the dependencies of the
+        next, that ends with the last stage to finish.
+        """
+        timings = dict(self._timings)
+        stages = {
+            name: {
+                "queued": round(queued - self._started_at, 4),
+                "start": round(start - self._started_at, 4),
+                "end": round(end - self._started_at, 4)
+            }
+            for name, (queued, start, end) in timings.items()
+        }
+
+        critical_path = []
+        current = max(timings, key=lambda name: timings[name][2], default=None)
+        while current is not None:
+            critical_path.append(current)
+            deps = [dep for dep in self._stages[current].deps if dep in timings]
+            current = max(deps, key=lambda name: timings[name][2], default=None)
+        critical_path.reverse()
+
+        return {"stages": stages, "critical_path": critical_path}
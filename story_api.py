@@ -1,17 +1,49 @@
-import random
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, redirect, url_for
 from google.cloud import storage
 from google.cloud import secretmanager
+from google.cloud import texttospeech_v1beta1 as texttospeech
 from google.oauth2 import service_account
+from werkzeug.middleware.proxy_fix import ProxyFix
 import json
 import datetime
+import gzip
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from catalog import Catalog
+from image_variants import FORMATS, pick_variant
+from languages import LANGUAGES, story_languages
+from single_flight import SingleFlight
+from story_document import StoryDocument
+from tts import VOICES_BY_KEY, SpeechRenderer, index_blob_name, voice_blob_name, voice_language
+import metrics
+import story_store
+import clients
 
 app = Flask(__name__)
+# Cloud Run terminates TLS in front of the service; take the scheme and host of the
+# URLs built with url_for(_external=True) from its X-Forwarded-* headers
+app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
-# Set up Cloud Storage
-storage_client = storage.Client()
 bucket_name = 'storytellerbucket'
-bucket = storage_client.bucket(bucket_name)
+
+# Set STORYTELLER_FAKE_BACKENDS to serve from the in-memory bucket in fakes.py
+FAKE_BACKENDS = os.getenv("STORYTELLER_FAKE_BACKENDS", "").lower() in ('1', 'true', 'yes')
+
+# Set up Cloud Storage
+if FAKE_BACKENDS:
+    import fakes
+    bucket = fakes.FakeBucket.from_env(bucket_name)
+else:
+    # Created on first use, so the port is bound before any client is (see clients.py)
+    bucket = clients.register("bucket", lambda: storage.Client().bucket(bucket_name))
+
+# In-memory story catalog, refreshed incrementally from the bucket (and built
+# from the stories in it on the first start against a bucket without one)
+catalog = Catalog(bucket, refresh_seconds=int(os.getenv("CATALOG_REFRESH_SECONDS", "60")),
+                  compact_backlog=int(os.getenv("CATALOG_COMPACT_BACKLOG", "100")), rebuild_missing=True)
 
 # Fetch the service account key from Secret Manager
 def get_secret(secret_name):
@@ -21,58 +53,226 @@ def get_secret(secret_name):
     secret_data = response.payload.data.decode('UTF-8')
     return secret_data
 
-# Load the service account JSON key
-service_account_json = get_secret('storyteller_service_account')
-signing_credentials = service_account.Credentials.from_service_account_info(json.loads(service_account_json))
+# Load the service account JSON key when the first URL is signed
+def load_signing_credentials():
+    if FAKE_BACKENDS:
+        return None  # Fake blobs sign without credentials
+    service_account_json = get_secret('storyteller_service_account')
+    return service_account.Credentials.from_service_account_info(json.loads(service_account_json))
 
-def generate_signed_url(blob_name, expiration_time=3600):
-    """Generate a signed URL for a given blob using signing credentials."""
+clients.register("signing_credentials", load_signing_credentials)
+
+random_story_seconds = metrics.histogram("story_api_random_story_seconds", "Latency of /random-story")
+list_stories_seconds = metrics.histogram("story_api_list_stories_seconds", "Latency of /stories")
+signed_url_lookups = metrics.counter("story_api_signed_url_lookups_total", "Signed URL cache lookups, by result")
+catalog_stories = metrics.gauge("story_api_catalog_stories", "Stories in the loaded catalog")
+voice_renders = metrics.counter("story_api_voice_renders_total", "Voices rendered on first request")
+
+class SignedUrlCache:
+    """Bounded LRU of signed URLs keyed by blob name and expiration time.
+
+    A URL is handed out again until safety_margin seconds before it expires,
+    so clients always get at least that much time to use it.
+    """
+
+    def __init__(self, max_entries, safety_margin):
+        self._max_entries = max_entries
+        self._safety_margin = safety_margin
+        self._urls = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_sign(self, blob_name, expiration_time, sign):
+        key = (blob_name, expiration_time)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._urls.get(key)
+            if cached is not None and cached[1] - self._safety_margin > now:
+                self._urls.move_to_end(key)
+                signed_url_lookups.inc(result="hit")
+                return cached[0]
+        signed_url_lookups.inc(result="miss")
+
+        url = sign(blob_name, expiration_time)
+        with self._lock:
+            self._urls[key] = (url, now + expiration_time)
+            self._urls.move_to_end(key)
+            while len(self._urls) > self._max_entries:
+                self._urls.popitem(last=False)
+        return url
+
+
+signed_url_cache = SignedUrlCache(
+    max_entries=int(os.getenv("SIGNED_URL_CACHE_SIZE", "10000")),
+    safety_margin=int(os.getenv("SIGNED_URL_SAFETY_MARGIN", "600"))
+)
+
+def sign_blob_url(blob_name, expiration_time):
     blob = bucket.blob(blob_name)
     url = blob.generate_signed_url(
         version="v4",
         expiration=datetime.timedelta(seconds=expiration_time),
         method='GET',
-        credentials=signing_credentials
+        credentials=clients.get("signing_credentials")
     )
     return url
 
+def generate_signed_url(blob_name, expiration_time=3600):
+    """Generate a signed URL for a given blob using signing credentials, reusing cached ones."""
+    return signed_url_cache.get_or_sign(blob_name, expiration_time, sign_blob_url)
+
+
+# Voices that weren't rendered with the story are rendered here on first request
+_rendered_lock = threading.Lock()
+voice_render_flight = SingleFlight()
+rendered_voice_blobs = OrderedDict()
+RENDERED_VOICE_MEMO_SIZE = int(os.getenv("RENDERED_VOICE_MEMO_SIZE", "10000"))
+
+def create_speech_renderer():
+    if FAKE_BACKENDS:
+        tts_client = fakes.FakeTextToSpeech.from_env()
+    else:
+        tts_client = texttospeech.TextToSpeechClient()
+    return SpeechRenderer(tts_client, bucket)
+
+speech = clients.register("speech", create_speech_renderer)
 
-def get_blob_name_from_url(url):
-    """Extract the blob name from a full URL."""
-    # Assuming the URL format is consistent, split the URL to get the blob name.
-    return '/'.join(url.split('/')[4:])  # Adjust based on your actual URL structure
-
-
-def get_random_story(genre=None):
-    blobs = bucket.list_blobs(prefix='stories/')
-    stories = []
-
-    for blob in blobs:
-        if blob.name.endswith('story_data.json'):
-            story_data = json.loads(blob.download_as_string())
-            if genre is None or story_data['genre'] == genre:
-                # Convert full URLs to blob names (relative paths) before generating signed URLs
-                signed_image_urls = [generate_signed_url(get_blob_name_from_url(image_url)) for image_url in story_data['image_urls']]
-                signed_tts_urls = {key: generate_signed_url(get_blob_name_from_url(tts_url)) for key, tts_url in story_data['tts_urls'].items()}
-
-                stories.append({
-                    'id': blob.name.split('/')[-3],
-                    'title': story_data['title'],
-                    'genre': story_data['genre'],
-                    'tags': story_data['tags'],
-                    'summary': story_data.get('summary', ''),
-                    'image_urls': signed_image_urls,
-                    'tts_urls': signed_tts_urls,
-                    'content_en': story_data.get('content_en', ''),  # English story content
-                    'content_tr': story_data.get('content_tr', '')   # Turkish story content
-                })
-
-    if not stories:
+def _remember_rendered(blob_name):
+    with _rendered_lock:
+        rendered_voice_blobs[blob_name] = True
+        rendered_voice_blobs.move_to_end(blob_name)
+        while len(rendered_voice_blobs) > RENDERED_VOICE_MEMO_SIZE:
+            rendered_voice_blobs.popitem(last=False)
+
+def _render_voice(entry, voice, blob_name):
+    # The index is written after the audio, so it marks a complete render (by any instance)
+    if bucket.get_blob(index_blob_name(blob_name)) is None:
+        ssml = story_store.read_content(bucket, entry['story_blob'], voice_language(voice))
+        speech.render_voice(StoryDocument.from_ssml(ssml).tts_chunks(), voice, blob_name)
+        voice_renders.inc()
+    _remember_rendered(blob_name)
+
+def has_voice(entry, key):
+    """Whether the voice exists and reads one of the story's languages."""
+    return key in VOICES_BY_KEY and voice_language(VOICES_BY_KEY[key]) in story_languages(entry)
+
+def voice_audio_blob(entry, key):
+    """The blob of a story's audio in a voice, rendering and storing it first if needed."""
+    if key in entry['tts_blobs']:
+        return entry['tts_blobs'][key]
+    voice = VOICES_BY_KEY[key]
+    blob_name = voice_blob_name(entry['genre'], entry['id'], voice)
+    if blob_name not in rendered_voice_blobs:
+        voice_render_flight.do(blob_name, lambda: _render_voice(entry, voice, blob_name))
+    return blob_name
+
+def image_blob_for(entry, i, width, formats):
+    """The blob of the i-th image to serve: its best variant for width, or the original."""
+    variants = entry.get('image_variants', [])
+    if width is not None and i < len(variants):
+        variant = pick_variant(variants[i], width, formats)
+        if variant is not None:
+            return variant['blob']
+    return entry['image_blobs'][i]
+
+# Fields of a story in API responses; summary is read from its meta.json, the
+# content_<language> ones from its content objects (see story_store.py) and
+# tts_indexes from the index stored next to each voice. A story has the content
+# fields of its own languages only.
+STORY_FIELDS = ('id', 'title', 'genre', 'tags', 'summary', 'image_urls', 'tts_urls', 'tts_indexes') + tuple(
+    f'content_{language}' for language in LANGUAGES
+)
+DEFAULT_LIST_FIELDS = ('id', 'title', 'genre', 'tags')
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "100"))
+# Smaller responses aren't worth compressing
+GZIP_MIN_BYTES = 1024
+
+# Downloads of the stored data of every story in a /stories page
+story_fetch_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("STORY_FETCH_CONCURRENCY", "8")),
+    thread_name_prefix="story-fetch"
+)
+
+def load_story_data(entry, fields=STORY_FIELDS):
+    """Download the parts of a story's stored data that fields need, if any."""
+    legacy = story_store.is_legacy(entry['story_blob'])
+    # Legacy story_data.json files hold the indexes of the voices rendered with the story
+    meta = 'summary' in fields or (legacy and 'tts_indexes' in fields)
+    languages = [language for language in story_languages(entry) if f'content_{language}' in fields]
+    indexes = {}
+    if 'tts_indexes' in fields and not legacy:
+        for key, blob_name in entry['tts_blobs'].items():
+            indexes[key] = story_store.download_executor.submit(story_store.read_index, bucket, blob_name)
+    story_data = story_store.read_story(bucket, entry['story_blob'], meta, languages) if meta or languages else {}
+    if indexes:
+        story_data['tts_indexes'] = {key: future.result() for key, future in indexes.items()}
+        missing = [key for key, index in story_data['tts_indexes'].items() if index is None]
+        if missing:
+            # Not migrated yet (see story_store.migrate): the indexes may still be in meta.json
+            meta_indexes = story_store.read_meta(bucket, entry['story_blob']).get('tts_indexes', {})
+            for key in missing:
+                story_data['tts_indexes'][key] = meta_indexes.get(key, {})
+    return story_data
+
+def requested_fields(default):
+    """The fields query parameter as a list, and the unknown fields in it."""
+    fields = [field for field in request.args.get('fields', ','.join(default)).split(',') if field]
+    return fields, [field for field in fields if field not in STORY_FIELDS]
+
+def render_story(entry, fields=STORY_FIELDS, image_width=None, image_formats=('jpeg',), story_data=None):
+    """The requested fields of a story; story_data is needed for the fields load_story_data reads only."""
+    story = {}
+    for field in fields:
+        if field in ('id', 'title', 'genre', 'tags'):
+            story[field] = entry[field]
+        elif field == 'image_urls':
+            story[field] = [generate_signed_url(image_blob_for(entry, i, image_width, image_formats))
+                            for i in range(len(entry['image_blobs']))]
+        elif field == 'tts_urls':
+            tts_urls = {key: generate_signed_url(blob_name) for key, blob_name in entry['tts_blobs'].items()}
+            # Voices that haven't been rendered yet are served through /stories/<id>/audio/<voice>
+            for key in VOICES_BY_KEY:
+                if key not in tts_urls and has_voice(entry, key):
+                    tts_urls[key] = url_for('get_voice_audio', story_id=entry['id'], voice=key, _external=True)
+            story[field] = tts_urls
+        elif field == 'tts_indexes':
+            # Per voice, the time and byte range of every page, for Range requests on the tts_urls
+            story[field] = story_data.get('tts_indexes', {})
+        elif field == 'summary' or field[len('content_'):] in story_languages(entry):
+            story[field] = story_data.get(field, '')
+    return story
+
+def get_random_story(genre=None, image_width=None, image_formats=('jpeg',), fields=STORY_FIELDS):
+    """Pick a random story; with an image_width, images are served as variants in one of image_formats."""
+    entry = catalog.random_entry(genre)
+    if entry is None:
         return None
 
-    return random.choice(stories)
+    # Only what the chosen story's fields need is downloaded and signed
+    return render_story(entry, fields, image_width, image_formats, load_story_data(entry, fields))
 
+def image_options():
+    """The image_width and accepted image formats of the request."""
+    # Optional: the display width of the images, to get a smaller variant instead of the original PNG
+    image_width = request.args.get('image_width', type=int)
+    if request.args.get('image_format') in FORMATS:
+        return image_width, (request.args['image_format'],)
+    return image_width, tuple(fmt for fmt, (_, _, content_type) in FORMATS.items()
+                              if fmt == 'jpeg' or content_type in request.accept_mimetypes.values())
 
+def conditional_json(payload):
+    """A JSON response with an ETag, answered with 304 when the client's copy is current,
+    and gzip-compressed for clients that accept it.
+    """
+    response = Response(json.dumps(payload, separators=(',', ':')), mimetype='application/json')
+    response.add_etag(weak=True)  # Weak, since the same ETag is sent for both encodings
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    response = response.make_conditional(request)
+    if (response.status_code == 200 and 'gzip' in request.accept_encodings
+            and response.content_length > GZIP_MIN_BYTES):
+        response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
 
 
 @app.route('/')
@@ -85,12 +285,83 @@ def fetch_random_story():
     if genre not in ['fantasy', 'sci-fi', None]:  # Assuming 'any' means None
         return jsonify({"error": "Invalid genre preference"}), 400
 
-    story = get_random_story(genre)
+    # Optional: the fields to return (comma separated), by default all of them
+    fields, unknown = requested_fields(STORY_FIELDS)
+    if unknown:
+        return jsonify({"error": f"Unknown fields: {', '.join(unknown)}"}), 400
+    image_width, image_formats = image_options()
+
+    with random_story_seconds.time():
+        story = get_random_story(genre, image_width, image_formats, fields)
 
     if story is None:
         return jsonify({"error": "No stories found for this genre"}), 404
 
     return jsonify(story), 200
 
+@app.route('/stories', methods=['GET'])
+def list_stories():
+    """List stories in id order, a page at a time.
+
+    Query parameters: genre, tags (comma separated, all must match), fields
+    (comma separated, default id,title,genre,tags), page_size and cursor (the
+    next_cursor of the previous page). image_width and image_format select
+    image variants as for /random-story.
+    """
+    genre = request.args.get('genre')
+    if genre not in ['fantasy', 'sci-fi', None]:
+        return jsonify({"error": "Invalid genre preference"}), 400
+    tags = [tag for tag in request.args.get('tags', '').split(',') if tag]
+    fields, unknown = requested_fields(DEFAULT_LIST_FIELDS)
+    if unknown:
+        return jsonify({"error": f"Unknown fields: {', '.join(unknown)}"}), 400
+    page_size = request.args.get('page_size', 20, type=int)
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        return jsonify({"error": f"page_size must be between 1 and {MAX_PAGE_SIZE}"}), 400
+    image_width, image_formats = image_options()
+
+    with list_stories_seconds.time():
+        entries, more = catalog.page(genre, tags, request.args.get('cursor'), page_size)
+        story_data = list(story_fetch_executor.map(lambda entry: load_story_data(entry, fields), entries))
+        stories = [render_story(entry, fields, image_width, image_formats, data)
+                   for entry, data in zip(entries, story_data)]
+
+    return conditional_json({
+        "stories": stories,
+        "next_cursor": entries[-1]['id'] if more else None
+    })
+
+@app.route('/stories/<story_id>/audio/<voice>', methods=['GET'])
+def get_voice_audio(story_id, voice):
+    """Redirect to the story's audio in the voice, rendering it on the first request."""
+    entry = catalog.get(story_id)
+    if entry is None or not has_voice(entry, voice):
+        return jsonify({"error": "Unknown story or voice"}), 404
+    return redirect(generate_signed_url(voice_audio_blob(entry, voice)))
+
+@app.route('/stories/<story_id>/audio/<voice>/index', methods=['GET'])
+def get_voice_audio_index(story_id, voice):
+    """The page index of the story's audio in the voice (see audio_index.py)."""
+    entry = catalog.get(story_id)
+    if entry is None or not has_voice(entry, voice):
+        return jsonify({"error": "Unknown story or voice"}), 404
+    if voice in entry['tts_blobs']:
+        index = None
+        if not story_store.is_legacy(entry['story_blob']):
+            index = story_store.read_index(bucket, entry['tts_blobs'][voice])
+        if index is None:
+            # Legacy and not yet migrated stories keep the indexes in their story data
+            index = story_store.read_meta(bucket, entry['story_blob']).get('tts_indexes', {}).get(voice, {})
+        return jsonify(index), 200
+    index = bucket.blob(index_blob_name(voice_audio_blob(entry, voice))).download_as_string()
+    return Response(index, content_type='application/json')
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    catalog_stories.set(catalog.size())
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080)
+    # Serve right away; clients and the catalog are loaded meanwhile (or by the first request)
+    clients.warm_up_in_background(then=[catalog.load])
+    app.run(host='0.0.0.0', port=int(os.getenv("PORT", "8080")))
@@ -0,0 +1,186 @@
+"""Parsed representation of a story and its SSML/HTML/TTS renderings.
+
+A story is parsed once into paragraphs and sentences, and every rendering is
+produced from that in a single pass:
+
+* to_ssml()            - the SSML stored as content_<language>
+* to_html(image_paths) - the SSML with the story images inlined
+* tts_chunks()         - SSML chunks for the TTS API, packed up to the byte limit
+"""
+import re
+
+BREAK = "<break time='700ms'/>"
+SPEAK_OVERHEAD = len('<speak>') + len('</speak>')
+TTS_MAX_CHUNK_BYTES = 5000
+
+_SENTENCE_END = re.compile(r'(?<=[.!?])(?=\s)')
+_TAG = re.compile(r'<[^>]*>')
+_MARK_NAME = re.compile(r'name="([^"]*)"')
+
+
+def _mark_tag(name):
+    return f'<mark name="{name}"/>'
+
+
+def _image_tag(image_url, i):
+    return f' <img src="{image_url}" alt="story_image_{i+1}" />'
+
+
+class Sentence:
+    __slots__ = ('text', 'ssml', 'size')
+
+    def __init__(self, text):
+        self.text = text
+        self.ssml = text.replace(".", "." + BREAK)
+        self.size = len(self.ssml.encode('utf-8'))
+
+
+class Paragraph:
+    __slots__ = ('text', 'ssml', 'size', 'mark', '_sentences')
+
+    def __init__(self, text, mark=None):
+        self.text = text
+        self.ssml = text.replace(".", "." + BREAK)
+        self.size = len(self.ssml.encode('utf-8'))
+        self.mark = mark
+        self._sentences = None
+
+    @property
+    def sentences(self):
+        # Only paragraphs that straddle a TTS chunk boundary are ever split
+        if self._sentences is None:
+            self._sentences = [Sentence(sentence) for sentence in _SENTENCE_END.split(self.text)]
+        return self._sentences
+
+    def mark_tag(self):
+        return _mark_tag(self.mark) if self.mark is not None else ''
+
+
+class StoryDocument:
+    __slots__ = ('paragraphs',)
+
+    def __init__(self, paragraphs):
+        self.paragraphs = paragraphs
+
+    @classmethod
+    def from_text(cls, text):
+        """Parse plain story text, with paragraphs separated by blank lines."""
+        return cls([Paragraph(paragraph, f"page_{i+1}") for i, paragraph in enumerate(text.split("\n\n"))])
+
+    @classmethod
+    def from_ssml(cls, ssml):
+        """Parse SSML produced by to_ssml() or to_html().
+
+        Breaks and images are dropped (they are re-rendered), and every mark is
+        attached to the paragraph before it. Unknown tags are kept as text.
+        """
+        paragraphs = []
+        text = []
+        in_paragraph = False
+        position = 0
+        for tag in _TAG.finditer(ssml):
+            if in_paragraph:
+                text.append(ssml[position:tag.start()])
+            position = tag.end()
+            value = tag.group()
+            if value == '<p>':
+                if in_paragraph:
+                    paragraphs.append(Paragraph(''.join(text)))
+                text = []
+                in_paragraph = True
+            elif value == '</p>':
+                if in_paragraph:
+                    paragraphs.append(Paragraph(''.join(text)))
+                in_paragraph = False
+            elif value.startswith('<mark '):
+                name = _MARK_NAME.search(value)
+                if paragraphs and paragraphs[-1].mark is None and name:
+                    paragraphs[-1].mark = name.group(1)
+            elif value.startswith('<img ') or value == BREAK or value in ('<speak>', '</speak>'):
+                if value.startswith('<img ') and text and text[-1].endswith(' '):
+                    text[-1] = text[-1][:-1]  # Images are rendered with a leading space
+            elif in_paragraph:
+                text.append(value)
+        if in_paragraph:
+            paragraphs.append(Paragraph(''.join(text) + ssml[position:]))
+        return cls(paragraphs)
+
+    def to_ssml(self, image_paths=()):
+        parts = ['<speak>']
+        for i, paragraph in enumerate(self.paragraphs):
+            parts.append('<p>')
+            parts.append(paragraph.ssml)
+            if i < len(image_paths):
+                parts.append(_image_tag(image_paths[i], i))
+            parts.append('</p>')
+            parts.append(paragraph.mark_tag())
+        parts.append('</speak>')
+        # One image more than there are paragraphs ends up after the story
+        if len(image_paths) > len(self.paragraphs):
+            parts.append(_image_tag(image_paths[len(self.paragraphs)], len(self.paragraphs)))
+        return ''.join(parts)
+
+    def to_html(self, image_paths):
+        """Render the SSML with the i-th image appended to the i-th paragraph."""
+        return self.to_ssml(image_paths)
+
+    def tts_chunks(self, max_bytes=TTS_MAX_CHUNK_BYTES):
+        """Pack the story into as few SSML chunks of at most max_bytes as possible.
+
+        Chunks are filled greedily, which is optimal for an ordered sequence.
+        Paragraphs are split across chunks at sentence boundaries (or at word
+        boundaries for sentences that don't fit a chunk on their own), and
+        each paragraph's mark stays right after its last sentence.
+        """
+        chunks = []
+        parts = []
+        size = SPEAK_OVERHEAD
+
+        def flush():
+            chunks.append(f"<speak>{''.join(parts)}</speak>")
+            parts.clear()
+            return SPEAK_OVERHEAD
+
+        for paragraph in self.paragraphs:
+            mark_tag = paragraph.mark_tag()
+            whole = len('<p></p>') + paragraph.size + len(mark_tag)
+            if size + whole <= max_bytes:
+                parts.append(f"<p>{paragraph.ssml}</p>{mark_tag}")
+                size += whole
+                continue
+
+            in_paragraph = False
+            pieces = list(self._pieces(paragraph, max_bytes - SPEAK_OVERHEAD - len('<p></p>') - len(mark_tag)))
+            for j, (piece, piece_size) in enumerate(pieces):
+                # Room needed to close the paragraph (and add its mark) after this piece
+                closing = len('</p>') + (len(mark_tag) if j == len(pieces) - 1 else 0)
+                opening = 0 if in_paragraph else len('<p>')
+                if parts and size + opening + piece_size + closing > max_bytes:
+                    if in_paragraph:
+                        parts.append('</p>')
+                    size = flush()
+                    in_paragraph = False
+                if not in_paragraph:
+                    parts.append('<p>')
+                    size += len('<p>')
+                    in_paragraph = True
+                parts.append(piece)
+                size += piece_size
+            parts.append('</p>')
+            parts.append(mark_tag)
+            size += len('</p>') + len(mark_tag)
+
+        if parts:
+            flush()
+        return chunks
+
+    @staticmethod
+    def _pieces(paragraph, max_piece_bytes):
+        for sentence in paragraph.sentences:
+            if sentence.size <= max_piece_bytes:
+                yield sentence.ssml, sentence.size
+                continue
+            # A single sentence longer than a chunk is split between words
+            for word in re.split(r'(?<=\s)(?=\S)', sentence.text):
+                word = Sentence(word)
+                yield word.ssml, word.size
@@ -0,0 +1,177 @@
+"""Storage layout of a story's text and metadata.
+
+A story is stored under stories/<genre>/<story_id>/ as
+
+* ``meta.json`` - title, genre, tags, languages, summary and the image and
+  audio URLs: everything but the story text, a few KB. (The page index of each voice
+  is stored next to its audio, see tts.index_blob_name.)
+* ``content_<language>.ssml.gz`` - the SSML of the story in each language,
+  gzip-compressed.
+
+Readers download only the objects they need. Stories stored before this
+layout have a single ``story_data.json`` with the metadata, the content
+of both languages and the page index of every voice; the readers below
+accept its name wherever they accept that of a meta.json. ``migrate``
+stores them in the current layout.
+
+Usage: python story_store.py migrate
+"""
+import gzip
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core.exceptions import NotFound
+from languages import story_languages
+from tts import index_blob_name
+import metrics
+
+META_NAME = 'meta.json'
+LEGACY_NAME = 'story_data.json'
+
+# The objects of a story are downloaded in parallel on this pool
+download_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("STORY_DOWNLOAD_CONCURRENCY", "16")),
+    thread_name_prefix="story-download"
+)
+
+story_bytes_read = metrics.counter("storyteller_story_bytes_read_total",
+                                   "Bytes of stored stories downloaded, by object kind")
+
+
+def meta_blob_name(prefix):
+    return prefix + META_NAME
+
+
+def content_blob_name(prefix, language):
+    return f'{prefix}content_{language}.ssml.gz'
+
+
+def is_legacy(story_blob):
+    return story_blob.endswith(LEGACY_NAME)
+
+
+def encode_content(ssml):
+    return gzip.compress(ssml.encode('utf-8'), compresslevel=9)
+
+
+def write_story(bucket, prefix, story_data):
+    """Store story_data (with a content_<language> per language) under prefix; returns the meta.json blob name.
+
+    meta.json is written last, so a story whose meta.json exists is complete.
+    """
+    meta = {key: value for key, value in story_data.items() if not key.startswith('content_')}
+    meta['languages'] = [key[len('content_'):] for key in story_data if key.startswith('content_')]
+    for language in meta['languages']:
+        bucket.blob(content_blob_name(prefix, language)).upload_from_string(
+            encode_content(story_data[f'content_{language}']), content_type='application/gzip'
+        )
+    meta_blob = bucket.blob(meta_blob_name(prefix))
+    meta_blob.upload_from_string(json.dumps(meta), content_type='application/json')
+    return meta_blob.name
+
+
+def download(bucket, blob_name, kind):
+    data = bucket.blob(blob_name).download_as_bytes()
+    story_bytes_read.inc(len(data), kind=kind)
+    return data
+
+
+def read_story(bucket, story_blob, meta=True, languages=None):
+    """Read the metadata (unless meta is false) and the content_<language> of the given languages.
+
+    story_blob is the name of a meta.json or of a legacy story_data.json.
+    Without languages, the content of every language of the story is read
+    (after its metadata). Returns a dict in the shape of story_data.json.
+    """
+    if is_legacy(story_blob):
+        return json.loads(download(bucket, story_blob, "legacy"))
+    if languages is None:
+        story = read_meta(bucket, story_blob)
+        story.update(read_story(bucket, story_blob, meta=False, languages=story_languages(story)))
+        return story
+    prefix = story_blob[:-len(META_NAME)]
+    downloads = [(story_blob, "meta")] if meta else []
+    downloads += [(content_blob_name(prefix, language), "content") for language in languages]
+    if len(downloads) > 1:
+        data = list(download_executor.map(lambda args: download(bucket, *args), downloads))
+    else:
+        data = [download(bucket, *args) for args in downloads]
+
+    story = json.loads(data.pop(0)) if meta else {}
+    for language, content in zip(languages, data):
+        story[f'content_{language}'] = gzip.decompress(content).decode('utf-8')
+    return story
+
+
+def read_index(bucket, audio_blob_name):
+    """The page index stored next to an audio blob, or None if it has none."""
+    try:
+        return json.loads(download(bucket, index_blob_name(audio_blob_name), "index"))
+    except (NotFound, FileNotFoundError):  # FileNotFoundError: the in-memory bucket of fakes.py
+        return None
+
+
+def read_meta(bucket, story_blob):
+    return read_story(bucket, story_blob, languages=())
+
+
+def read_content(bucket, story_blob, language):
+    """The SSML of the story in language (such as "en" or "tr")."""
+    return read_story(bucket, story_blob, meta=False, languages=(language,))[f'content_{language}']
+
+
+def find_story(bucket, prefix):
+    """The name of the meta.json (or legacy story_data.json) of the story under prefix, or None."""
+    for name in (META_NAME, LEGACY_NAME):
+        if bucket.get_blob(prefix + name) is not None:
+            return prefix + name
+    return None
+
+
+def write_indexes(bucket, story_data):
+    """Store the tts_indexes of story_data next to their audio, and remove them from it."""
+    for key, index in story_data.pop('tts_indexes', {}).items():
+        url = story_data.get('tts_urls', {}).get(key)
+        if url is not None:
+            audio_blob_name = '/'.join(url.split('/')[4:])
+            bucket.blob(index_blob_name(audio_blob_name)).upload_from_string(
+                json.dumps(index), content_type='application/json'
+            )
+
+
+def migrate(bucket):
+    """Store every story that only has a legacy story_data.json in the current layout.
+
+    The page indexes of its voices are stored next to their audio. Stories
+    migrated before that was done, whose meta.json still holds the indexes,
+    get them moved as well. The story_data.json is kept; rebuild the catalog
+    manifest afterwards to point it at the meta.json objects.
+    """
+    names = {blob.name for blob in bucket.list_blobs(prefix='stories/')}
+    migrated = 0
+    for name in sorted(names):
+        # The indexes are written first, so that they exist once meta.json doesn't hold them
+        if is_legacy(name) and meta_blob_name(name[:-len(LEGACY_NAME)]) not in names:
+            story_data = read_story(bucket, name)
+            write_indexes(bucket, story_data)
+            write_story(bucket, name[:-len(LEGACY_NAME)], story_data)
+            migrated += 1
+        elif name.endswith('/' + META_NAME):
+            meta = read_meta(bucket, name)
+            if 'tts_indexes' in meta:
+                write_indexes(bucket, meta)
+                bucket.blob(name).upload_from_string(json.dumps(meta), content_type='application/json')
+                migrated += 1
+    return migrated
+
+
+if __name__ == '__main__':
+    from google.cloud import storage
+
+    bucket = storage.Client().bucket('storytellerbucket')
+    if sys.argv[1:] == ['migrate']:
+        print(f"Migrated {migrate(bucket)} stories; run python catalog.py rebuild next")
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,100 @@
+import json
+import time
+import app
+import image_variants
+from jobs import JobQueue, QueueFull
+from story_document import StoryDocument
+
+
+def test_a_resumed_story_only_redoes_the_failed_stages(monkeypatch):
+    monkeypatch.setattr(image_variants, "VARIANT_WIDTHS", ())
+    images = []
+    generate_image = app.generate_image
+    monkeypatch.setattr(app, "generate_image", lambda *args: images.append(args) or generate_image(*args))
+    render_voice = app.speech.render_voice
+    failures = []
+
+    def fail_once(chunks, voice, file_path):
+        if not failures:
+            failures.append(voice)
+            raise RuntimeError("synthesis failed")
+        return render_voice(chunks, voice, file_path)
+
+    monkeypatch.setattr(app.speech, "render_voice", fail_once)
+    client = app.app.test_client()
+
+    failed = client.post('/generate-story', json={"genre": "fantasy", "prompt": "In {}...", "title": "Again"})
+    assert failed.status_code == 500
+    error = failed.get_json()
+    assert error["resume_url"] == "/resume-story"
+    generated = len(images)
+    assert generated == app.NUM_IMAGES
+
+    resumed = client.post('/resume-story', json={"genre": error["genre"], "story_id": error["story_id"]})
+    assert resumed.status_code == 201
+    story = resumed.get_json()
+    assert story["story_id"] == error["story_id"]
+    assert len(story["image_urls"]) == app.NUM_IMAGES
+    assert len(images) == generated
+
+    unknown = client.post('/resume-story', json={"genre": "fantasy", "story_id": "no-such-story"})
+    assert unknown.status_code == 404
+
+
+def events(response):
+    return [(block.split("\n")[0][len("event: "):], json.loads(block.split("\n")[1][len("data: "):]))
+            for block in response.get_data(as_text=True).strip().split("\n\n")]
+
+
+def wait_for_job(client, status_url):
+    deadline = time.monotonic() + 120
+    while client.get(status_url).get_json()["finished_at"] is None and time.monotonic() < deadline:
+        time.sleep(0.1)
+    return client.get(status_url).get_json()
+
+
+def test_the_story_stream_ends_once_the_rest_is_queued(monkeypatch):
+    monkeypatch.setattr(image_variants, "VARIANT_WIDTHS", ())
+    client = app.app.test_client()
+    response = client.post('/generate-story/stream', json={"genre": "fantasy", "prompt": "In {}...", "title": "Live"})
+    assert response.status_code == 200
+    streamed = events(response)
+    assert {event for event, _ in streamed[:-1]} == {"paragraph"}
+    event, job = streamed[-1]
+    assert event == "job"
+    assert wait_for_job(client, job["status_url"])["status"] == "succeeded"
+
+
+def test_a_full_queue_refuses_streams_before_writing_the_story(monkeypatch):
+    stories = []
+    monkeypatch.setattr(app, "stream_story", lambda *args: stories.append(args) or iter(()))
+    monkeypatch.setattr(app, "job_queue", JobQueue(max_workers=1, max_queue_depth=0))
+    response = app.app.test_client().post('/generate-story/stream',
+                                          json={"genre": "fantasy", "prompt": "In {}...", "title": "Full"})
+    assert response.status_code == 503 and response.headers["Retry-After"] == "30"
+    assert stories == []
+
+
+def test_a_streamed_story_that_cannot_be_queued_can_be_resumed(monkeypatch):
+    class FillsUpMeanwhile(JobQueue):
+        def full(self):
+            return False
+
+        def submit(self, func, *args, **kwargs):
+            raise QueueFull("filled up while the story was written")
+
+    monkeypatch.setattr(image_variants, "VARIANT_WIDTHS", ())
+    monkeypatch.setattr(app, "job_queue", FillsUpMeanwhile(max_workers=1, max_queue_depth=1))
+    client = app.app.test_client()
+    streamed = events(client.post('/generate-story/stream',
+                                  json={"genre": "sci-fi", "prompt": "In {}...", "title": "Late"}))
+    event, error = streamed[-1]
+    assert event == "error" and error["resume_url"] == "/resume-story"
+    paragraphs = [payload["text"] for event, payload in streamed if event == "paragraph"]
+
+    monkeypatch.setattr(app, "stream_story", None)
+    monkeypatch.setattr(app, "generate_story", None)
+    resumed = client.post('/resume-story', json={"genre": error["genre"], "story_id": error["story_id"]})
+    assert resumed.status_code == 201
+    document = StoryDocument.from_ssml(resumed.get_json()["content_en"])
+    assert [paragraph.text for paragraph in document.paragraphs] == paragraphs
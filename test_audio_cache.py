@@ -0,0 +1,32 @@
+import os
+import fakes
+from audio_cache import AudioCache
+
+
+def test_the_least_recently_used_audio_is_evicted(tmp_path):
+    cache = AudioCache(str(tmp_path), max_bytes=1000)
+    for age, key in enumerate(["c", "b", "a"]):
+        cache.put(key, key.encode() * 300)
+        os.utime(tmp_path / key, (1000 - age, 1000 - age))
+    assert cache.get("a") == b"a" * 300  # Now the most recently used
+
+    cache.put("d", b"d" * 300)
+    assert cache.get("b") is None
+    assert sorted(os.listdir(tmp_path)) == ["a", "c", "d"]
+
+    # Evicting goes below the limit, so the next put fits without another scan
+    cache.put("e", b"e" * 50)
+    assert sorted(os.listdir(tmp_path)) == ["a", "c", "d", "e"]
+
+
+def test_evicted_audio_is_still_shared_through_the_bucket(tmp_path):
+    bucket = fakes.FakeBucket()
+    first = AudioCache(str(tmp_path / "first"), max_bytes=100, bucket=bucket)
+    first.put(AudioCache.key("voice", "<speak/>"), b"x" * 80)
+    first.put(AudioCache.key("voice", "<speak>2</speak>"), b"y" * 80)
+    assert os.listdir(tmp_path / "first") == [AudioCache.key("voice", "<speak>2</speak>")]
+
+    assert first.get(AudioCache.key("voice", "<speak/>")) == b"x" * 80
+    second = AudioCache(str(tmp_path / "second"), max_bytes=100, bucket=bucket)
+    assert second.get(AudioCache.key("voice", "<speak>2</speak>")) == b"y" * 80
+    assert second.get(AudioCache.key("voice", "<speak>3</speak>")) is None
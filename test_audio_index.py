@@ -0,0 +1,21 @@
+import pytest
+import audio_index
+import fakes
+
+
+def test_audio_index_maps_pages_to_frame_aligned_byte_ranges():
+    frames, seconds = audio_index.frames(fakes.fake_mp3(1.0))
+    assert len(frames) == int(1.0 / fakes.MP3_FRAME_SECONDS)
+    assert seconds == pytest.approx(len(frames) * fakes.MP3_FRAME_SECONDS)
+
+    first, second = fakes.fake_mp3(2.0), fakes.fake_mp3(1.0)
+    builder = audio_index.AudioIndexBuilder()
+    builder.add(first, [("page_1", 1.0), ("page_2", 2.0)])
+    builder.add(second, [("page_3", 0.5)])
+    index = builder.index()
+    assert index["bytes"] == len(first) + len(second)
+    assert [page["page"] for page in index["pages"]] == ["page_1", "page_2", "page_3"]
+    for previous, page in zip(index["pages"], index["pages"][1:]):
+        assert page["start_byte"] == previous["end_byte"]
+        assert page["start_byte"] % fakes.MP3_FRAME_BYTES == 0
+    assert index["pages"][2]["end_byte"] >= len(first)
@@ -0,0 +1,52 @@
+import threading
+import pytest
+import app
+import rate_limit
+from bulk_batch import LocalBatchClient, chat_request, run_bulk, run_chat_batch
+from rate_limit import AdaptiveLimiter
+from story_document import StoryDocument
+
+
+def test_bulk_generation_with_the_local_batch_client():
+    items = [
+        {"prompt": "In {}...", "title": "The Dragon", "genre": "fantasy", "tags": ["dragons"]},
+        {"prompt": "In {}...", "title": "Nowhere", "genre": "western"},
+    ]
+    results = run_bulk(items, batch_client=LocalBatchClient(), poll_interval=0)
+
+    assert results[0]["status"] == "success"
+    story = results[0]["data"]
+    english, turkish = (StoryDocument.from_ssml(story[field]) for field in ("content_en", "content_tr"))
+    assert [paragraph.mark for paragraph in turkish.paragraphs] == [paragraph.mark for paragraph in english.paragraphs]
+    assert story["content_tr"].count("<speak>") == 1
+    assert app.bucket.get_blob(f"stories/fantasy/{story['story_id']}/meta.json") is not None
+    assert results[1] == {"status": "success", "data": {"error": "Unsupported genre"}}
+
+
+def test_local_batches_run_with_a_single_openai_slot(monkeypatch):
+    monkeypatch.setitem(rate_limit.limiters, "openai", AdaptiveLimiter("openai", max_concurrency=1))
+    requests = [chat_request(f"story-{i}", [{"role": "user", "content": "A story"}], 100) for i in range(3)]
+    results = {}
+    worker = threading.Thread(target=lambda: results.update(run_chat_batch(LocalBatchClient(), requests, 0)),
+                              daemon=True)
+    worker.start()
+    worker.join(30)
+    assert sorted(results) == ["story-0", "story-1", "story-2"]
+
+
+def test_batch_submissions_are_not_retried():
+    class ServiceUnavailable(Exception):
+        status_code = 503
+
+    submissions = []
+
+    class UnavailableBatches:
+        def create(self, **kwargs):
+            submissions.append(kwargs)
+            raise ServiceUnavailable("the response was lost")
+
+    batch_client = LocalBatchClient()
+    batch_client.batches = UnavailableBatches()
+    with pytest.raises(ServiceUnavailable):
+        run_chat_batch(batch_client, [chat_request("story-0", [{"role": "user", "content": "A story"}], 100)], 0)
+    assert len(submissions) == 1
@@ -0,0 +1,36 @@
+import catalog
+import fakes
+import story_store
+
+
+def test_catalog_reads_the_journal_and_the_compacted_manifest(monkeypatch):
+    monkeypatch.setattr(catalog, "JOURNAL_GRACE_SECONDS", 0)
+    bucket = fakes.FakeBucket()
+    for i, genre in enumerate(["fantasy", "fantasy", "sci-fi"]):
+        catalog.record_story(bucket, catalog.make_entry(f"story-{i}", "Title", genre, [], "blob", [], {}))
+    view = catalog.Catalog(bucket, refresh_seconds=0)
+    assert view.get("story-2")["genre"] == "sci-fi"
+
+    assert catalog.compact_manifest(bucket) == 3
+    assert bucket.list_blobs(prefix=catalog.JOURNAL_PREFIX) == []
+    catalog.record_story(bucket, catalog.make_entry("story-3", "Title", "sci-fi", [], "blob", [], {}))
+
+    fresh = catalog.Catalog(bucket, refresh_seconds=0)
+    entries, more = fresh.page(genre="sci-fi")
+    assert [entry["id"] for entry in entries] == ["story-2", "story-3"] and not more
+    assert fresh.random_entry("fantasy")["id"] in ("story-0", "story-1")
+
+
+def test_a_bucket_without_a_manifest_gets_one_built_from_its_stories():
+    bucket = fakes.FakeBucket()
+    story_store.write_story(bucket, "stories/fantasy/old/", {
+        "title": "Old", "genre": "fantasy", "tags": [], "image_urls": [], "tts_urls": {},
+        "content_en": "<speak><p>Once.</p></speak>", "content_tr": "<speak><p>Bir.</p></speak>"
+    })
+    view = catalog.Catalog(bucket, refresh_seconds=0, rebuild_missing=True)
+    assert view.random_entry("fantasy")["id"] == "old"
+    generation = bucket.get_blob(catalog.MANIFEST_BLOB).generation
+
+    # Only a missing manifest is rebuilt
+    catalog.Catalog(bucket, refresh_seconds=0, rebuild_missing=True).load()
+    assert bucket.get_blob(catalog.MANIFEST_BLOB).generation == generation
@@ -0,0 +1,40 @@
+import completion_cache
+from completion_cache import CompletionCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def test_completions_expire_after_their_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(completion_cache, "time", clock)
+    cache = CompletionCache(":memory:", max_bytes=1000, ttl_seconds=60)
+    key = CompletionCache.key("gpt-4o", [{"role": "user", "content": "A story"}], 100, seed=1)
+    assert key != CompletionCache.key("gpt-4o", [{"role": "user", "content": "A story"}], 100, seed=2)
+
+    cache.put(key, "Once upon a time")
+    clock.now += 60
+    assert cache.get(key) == "Once upon a time"
+    # Reading an entry doesn't extend its life
+    clock.now += 1
+    assert cache.get(key) is None
+
+
+def test_the_least_recently_used_completions_are_evicted(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(completion_cache, "time", clock)
+    cache = CompletionCache(":memory:", max_bytes=30, ttl_seconds=3600)
+    for key in ("a", "b", "c"):
+        clock.now += 1
+        cache.put(key, key * 10)
+    clock.now += 1
+    assert cache.get("a") == "a" * 10
+
+    clock.now += 1
+    cache.put("d", "d" * 10)
+    assert [cache.get(key) is not None for key in ("a", "b", "c", "d")] == [True, False, True, True]
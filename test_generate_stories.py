@@ -1,4 +1,5 @@
 import os
+import json
 import requests
 import random
 from dotenv import load_dotenv
@@ -168,11 +169,14 @@ def test_generate_stories_batch():
             payload = generate_random_payload(genre)
             batch_payload.append(payload)
 
-    response = requests.post(batch_url, json=batch_payload, headers=headers)
+    response = requests.post(batch_url, json=batch_payload, headers=headers, stream=True)
 
     if response.status_code == 201:
+        # Results arrive as NDJSON, one line per story as soon as it is done
+        for line in response.iter_lines():
+            if line:
+                print("Result:", json.loads(line))
         print("Batch stories generated and stored successfully!")
-        print("Response:", response.json())
     else:
         print("Failed to generate batch stories.")
         print("Status Code:", response.status_code)
@@ -0,0 +1,96 @@
+import threading
+import time
+import pytest
+import app
+import image_variants
+from idempotency import IdempotencyConflict, IdempotentRequests
+
+
+def test_concurrent_requests_with_a_key_share_one_call():
+    requests = IdempotentRequests(ttl_seconds=60)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def generate():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {"story_id": "s"}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(requests.run("key", {"title": "A"}, generate)))
+               for _ in range(3)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(replayed for _, replayed in results) == [False, True, True]
+    assert requests.run("key", {"title": "A"}, generate) == ({"story_id": "s"}, True)
+    with pytest.raises(IdempotencyConflict):
+        requests.run("key", {"title": "B"}, generate)
+
+
+def test_failed_requests_with_a_key_can_be_retried():
+    requests = IdempotentRequests(ttl_seconds=60)
+    assert requests.run("key", {}, lambda: {"error": "Unsupported genre"}) == ({"error": "Unsupported genre"}, False)
+    assert requests.run("key", {}, lambda: {"story_id": "s"}) == ({"story_id": "s"}, False)
+
+
+def test_retries_with_an_idempotency_key_get_the_same_story(monkeypatch):
+    monkeypatch.setattr(image_variants, "VARIANT_WIDTHS", ())
+    client = app.app.test_client()
+    body = {"genre": "sci-fi", "prompt": "In {}...", "title": "Stars"}
+    headers = {"Idempotency-Key": "retried-request"}
+
+    def new_instance(ttl_seconds=3600):
+        # A retry that reaches another instance, which only has the bucket
+        monkeypatch.setattr(app, "IDEMPOTENCY_TTL_SECONDS", ttl_seconds)
+        monkeypatch.setattr(app, "idempotent_requests", IdempotentRequests(ttl_seconds))
+
+    new_instance()
+    first = client.post('/generate-story', json=body, headers=headers)
+    assert first.status_code == 201
+    new_instance()
+    retry = client.post('/generate-story', json=body, headers=headers)
+    assert retry.status_code == 201 and retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.get_json() == first.get_json()
+
+    conflict = client.post('/generate-story', json=dict(body, title="Moons"), headers=headers)
+    assert conflict.status_code == 422
+    new_instance()
+    other_genre = client.post('/generate-story', json=dict(body, genre="fantasy"), headers=headers)
+    assert other_genre.status_code == 422
+
+    # Once the key expires, it is free for any request; the new story is what later retries get on any instance
+    new_instance(ttl_seconds=0)
+    second = client.post('/generate-story', json=dict(body, genre="fantasy", title="Dragons"), headers=headers)
+    assert second.status_code == 201
+    assert second.get_json()["story_id"] != first.get_json()["story_id"]
+    new_instance()
+    retry = client.post('/generate-story', json=dict(body, genre="fantasy", title="Dragons"), headers=headers)
+    assert retry.get_json()["story_id"] == second.get_json()["story_id"]
+    assert client.post('/generate-story', json=body, headers=headers).status_code == 422
+
+
+def test_async_retries_with_an_idempotency_key_get_the_same_job(monkeypatch):
+    monkeypatch.setattr(image_variants, "VARIANT_WIDTHS", ())
+    client = app.app.test_client()
+    body = {"genre": "fantasy", "prompt": "In {}...", "title": "Async"}
+    headers = {"Idempotency-Key": "async-request"}
+
+    responses = [client.post('/generate-story?async=true', json=body, headers=headers) for _ in range(3)]
+    assert [response.status_code for response in responses] == [202] * 3
+    assert len({response.get_json()["job_id"] for response in responses}) == 1
+    conflict = client.post('/generate-story?async=true', json=dict(body, title="Other"), headers=headers)
+    assert conflict.status_code == 422
+
+    job_url = responses[0].headers["Location"]
+    deadline = time.monotonic() + 120
+    while client.get(job_url).get_json()["finished_at"] is None and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert client.get(job_url).get_json()["status"] == "succeeded"
@@ -0,0 +1,38 @@
+import threading
+import time
+import pytest
+import app
+from jobs import JobQueue, QueueFull
+
+
+def test_jobs_beyond_the_queue_depth_are_shed():
+    queue = JobQueue(max_workers=1, max_queue_depth=1)
+    started, release = threading.Event(), threading.Event()
+
+    def block(progress):
+        started.set()
+        release.wait(5)
+        return {"story_id": "s"}
+
+    running = queue.submit(block)
+    started.wait(5)
+    waiting = queue.submit(lambda progress: {"error": "Unsupported genre"})
+    assert queue.full()
+    with pytest.raises(QueueFull):
+        queue.submit(block)
+
+    release.set()
+    deadline = time.monotonic() + 5
+    while waiting.finished_at is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert queue.get(running.id).to_dict()["status"] == "succeeded"
+    assert queue.get(waiting.id).to_dict()["status"] == "failed"
+    assert not queue.full()
+
+
+def test_async_requests_get_503_when_the_queue_is_full(monkeypatch):
+    monkeypatch.setattr(app, "job_queue", JobQueue(max_workers=1, max_queue_depth=0))
+    response = app.app.test_client().post('/generate-story?async=true',
+                                          json={"genre": "fantasy", "prompt": "In {}...", "title": "Busy"})
+    assert response.status_code == 503 and response.headers["Retry-After"] == "30"
+    assert app.app.test_client().get('/jobs/no-such-job').status_code == 404
@@ -0,0 +1,43 @@
+import email.utils
+import time
+import pytest
+import fakes
+from rate_limit import AdaptiveLimiter, retry_after
+
+
+def test_throttled_calls_are_retried_and_lower_the_limits():
+    limiter = AdaptiveLimiter("test", max_concurrency=4, max_retries=2, retry_base_delay=0)
+    calls = []
+
+    def throttled_twice():
+        calls.append(1)
+        if len(calls) <= 2:
+            raise fakes.FakeRateLimitError("throttled")
+        return "ok"
+
+    assert limiter.call(throttled_twice) == "ok"
+    assert len(calls) == 3
+    assert limiter.concurrency < 4
+
+    def failing():
+        calls.append(1)
+        raise ValueError("not retried")
+
+    calls.clear()
+    with pytest.raises(ValueError):
+        limiter.call(failing)
+    assert len(calls) == 1
+
+
+def test_retry_after_accepts_seconds_and_dates_and_ignores_garbage():
+    def error(**headers):
+        return fakes._Record(response=fakes._Record(headers=headers))
+
+    assert retry_after(error(**{'retry-after-ms': '1500'})) == 1.5
+    assert retry_after(error(**{'retry-after': '3'})) == 3.0
+    assert retry_after(error(**{'retry-after': 'Wed, 21 Oct 2015 07:28:00 GMT'})) == 0
+    assert 0 < retry_after(error(**{'retry-after': email.utils.formatdate(time.time() + 60, usegmt=True)})) <= 60
+    # A -0000 zone parses to a naive datetime, which is still UTC
+    assert 0 < retry_after(error(**{'retry-after': email.utils.formatdate(time.time() + 60)})) <= 60
+    assert retry_after(error(**{'retry-after': 'soon'})) is None
+    assert retry_after(fakes.FakeRateLimitError("throttled")) is None
@@ -0,0 +1,50 @@
+import pytest
+from stage_scheduler import StageScheduler
+
+
+def test_stages_run_after_their_dependencies():
+    scheduler = StageScheduler()
+    scheduler.add("a", lambda: 1)
+    scheduler.add("b", lambda a: a + 1, deps=["a"])
+    scheduler.add("c", lambda a: a * 10, deps=["a"])
+    scheduler.add("d", lambda b, c: b + c, deps=["b", "c"])
+    assert scheduler.run() == {"a": 1, "b": 2, "c": 10, "d": 12}
+
+
+def test_completed_stages_are_not_run_again():
+    calls = []
+    scheduler = StageScheduler()
+    scheduler.add("a", lambda: calls.append("a"))
+    scheduler.add("b", lambda a: calls.append("b"), deps=["a"])
+    scheduler.add("c", lambda b: b + 1, deps=["b"])
+    assert scheduler.run(completed={"b": 5}) == {"b": 5, "c": 6}
+    assert calls == []
+
+
+def test_stages_after_a_failed_stage_are_not_started():
+    calls = []
+    scheduler = StageScheduler()
+    scheduler.add("a", lambda: 1 / 0)
+    scheduler.add("b", lambda a: calls.append("b"), deps=["a"])
+    with pytest.raises(ZeroDivisionError):
+        scheduler.run()
+    assert calls == []
+
+
+def test_independent_stages_still_run_and_are_checkpointed_when_a_stage_fails():
+    class Checkpoint:
+        def __init__(self):
+            self.recorded = {}
+
+        def record(self, stage, result):
+            self.recorded[stage] = result
+
+    checkpoint = Checkpoint()
+    scheduler = StageScheduler(checkpoint=checkpoint)
+    scheduler.add("text", lambda: 1 / 0)
+    scheduler.add("tts", lambda text: text, deps=["text"], checkpoint=True)
+    scheduler.add("image", lambda: "https://images/1.png")
+    scheduler.add("upload", lambda url: "stored.png", deps=["image"], checkpoint=True)
+    with pytest.raises(ZeroDivisionError):
+        scheduler.run()
+    assert checkpoint.recorded == {"upload": "stored.png"}
@@ -0,0 +1,68 @@
+import gzip
+import json
+import catalog
+import fakes
+import story_api
+import story_store
+from story_api import SignedUrlCache
+
+
+def test_signed_urls_are_reused_until_the_safety_margin(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(story_api.time, "monotonic", lambda: now[0])
+    signed = []
+
+    def sign(blob_name, expiration_time):
+        signed.append(blob_name)
+        return f"https://signed/{blob_name}?n={len(signed)}"
+
+    cache = SignedUrlCache(max_entries=2, safety_margin=600)
+    url = cache.get_or_sign("a.mp3", 3600, sign)
+    now[0] += 2999
+    assert cache.get_or_sign("a.mp3", 3600, sign) == url
+    # Reusing it now would leave a client less than the margin
+    now[0] += 1
+    assert cache.get_or_sign("a.mp3", 3600, sign) != url
+    assert cache.get_or_sign("a.mp3", 60, sign) != cache.get_or_sign("a.mp3", 3600, sign)
+    assert signed == ["a.mp3"] * 3
+
+    # Only max_entries URLs are kept, the least recently used are signed again
+    cache.get_or_sign("b.mp3", 3600, sign)
+    cache.get_or_sign("a.mp3", 3600, sign)
+    cache.get_or_sign("c.mp3", 3600, sign)
+    cache.get_or_sign("a.mp3", 3600, sign)
+    cache.get_or_sign("b.mp3", 3600, sign)
+    assert signed == ["a.mp3"] * 3 + ["b.mp3", "c.mp3", "b.mp3"]
+
+
+def test_story_listings_are_paged_cached_and_compressed(monkeypatch):
+    bucket = fakes.FakeBucket()
+    for i in range(30):
+        story_store.write_story(bucket, f"stories/fantasy/story-{i:02d}/", {
+            "title": f"The long and winding tale number {i}", "genre": "fantasy", "tags": ["dragons"],
+            "image_urls": [], "tts_urls": {},
+            "content_en": "<speak><p>Once.</p></speak>", "content_tr": "<speak><p>Bir.</p></speak>"
+        })
+    catalog.rebuild_manifest(bucket)
+    monkeypatch.setattr(story_api, "bucket", bucket)
+    monkeypatch.setattr(story_api, "catalog", catalog.Catalog(bucket, refresh_seconds=0))
+    client = story_api.app.test_client()
+
+    first = client.get('/stories?page_size=20&fields=id,title')
+    assert first.status_code == 200
+    page = first.get_json()
+    assert [story["id"] for story in page["stories"]] == [f"story-{i:02d}" for i in range(20)]
+    assert set(page["stories"][0]) == {"id", "title"}
+    rest = client.get(f'/stories?page_size=20&fields=id,title&cursor={page["next_cursor"]}').get_json()
+    assert len(rest["stories"]) == 10 and rest["next_cursor"] is None
+
+    etag = first.headers["ETag"]
+    assert client.get('/stories?page_size=20&fields=id,title', headers={"If-None-Match": etag}).status_code == 304
+    assert client.get('/stories?page_size=19&fields=id,title', headers={"If-None-Match": etag}).status_code == 200
+
+    compressed = client.get('/stories?page_size=20&fields=id,title', headers={"Accept-Encoding": "gzip"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert compressed.headers["ETag"] == etag and "Accept-Encoding" in compressed.headers["Vary"]
+    assert json.loads(gzip.decompress(compressed.get_data())) == page
+    small = client.get('/stories?page_size=1&fields=id', headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in small.headers
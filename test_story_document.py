@@ -0,0 +1,15 @@
+import random
+import re
+import fakes
+from story_document import StoryDocument
+
+
+def test_tts_chunks_fit_the_limit_and_keep_the_marks_in_order():
+    text = fakes.fake_text(random.Random(1), paragraphs=30, sentences=8)
+    long_sentence = ' '.join(['word'] * 400) + '.'
+    document = StoryDocument.from_text(text + "\n\n" + long_sentence)
+    chunks = document.tts_chunks(max_bytes=1000)
+    assert len(chunks) > 1
+    assert all(len(chunk.encode('utf-8')) <= 1000 for chunk in chunks)
+    marks = re.findall(r'<mark name="([^"]*)"/>', ''.join(chunks))
+    assert marks == [f"page_{i + 1}" for i in range(31)]
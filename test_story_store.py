@@ -0,0 +1,43 @@
+import json
+import catalog
+import fakes
+import story_api
+import story_store
+
+
+def test_legacy_stories_are_readable_before_and_after_migration(monkeypatch):
+    bucket = fakes.FakeBucket()
+    monkeypatch.setattr(story_api, "bucket", bucket)
+    audio = bucket.blob("stories/fantasy/old/en/young_woman.mp3")
+    audio.upload_from_string(fakes.fake_mp3(1.0), content_type='audio/mpeg')
+    index = {"duration_seconds": 1.0, "bytes": len(fakes.fake_mp3(1.0)), "pages": []}
+    story_data = {
+        "title": "Old", "genre": "fantasy", "tags": [], "image_urls": [],
+        "content_en": "<speak><p>Once.</p></speak>", "content_tr": "<speak><p>Bir.</p></speak>",
+        "tts_urls": {"young_woman_en": audio.public_url}, "tts_indexes": {"young_woman_en": index}
+    }
+    bucket.blob("stories/fantasy/old/story_data.json").upload_from_string(json.dumps(story_data))
+
+    def check(headers=None):
+        catalog.rebuild_manifest(bucket)
+        monkeypatch.setattr(story_api, "catalog", catalog.Catalog(bucket, refresh_seconds=0))
+        client = story_api.app.test_client()
+        response = client.get('/random-story', headers=headers)
+        assert response.status_code == 200
+        story = response.get_json()
+        assert story["tts_indexes"] == {"young_woman_en": index}
+        assert story["content_tr"] == story_data["content_tr"]
+        response = client.get('/stories/old/audio/young_woman_en/index')
+        assert response.status_code == 200 and response.get_json() == index
+        return story
+
+    check()
+    # As stored by migrations that left the indexes in meta.json
+    story_store.write_story(bucket, "stories/fantasy/old/", story_data)
+    check()
+
+    assert story_store.migrate(bucket) == 1
+    assert "tts_indexes" not in story_store.read_meta(bucket, "stories/fantasy/old/meta.json")
+    assert story_store.read_index(bucket, audio.name) == index
+    story = check(headers={"X-Forwarded-Proto": "https"})
+    assert story["tts_urls"]["old_man_en"].startswith("https://")
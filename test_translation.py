@@ -0,0 +1,45 @@
+import translation
+from story_document import StoryDocument
+
+
+def test_paragraphs_are_grouped_up_to_the_size_limit():
+    texts = ["a" * 400, "b" * 400, "c" * 400, "d" * 2000, "e" * 10]
+    assert [len(group) for group in translation.paragraph_groups(texts, max_chars=1000)] == [2, 1, 1, 1]
+
+
+def test_answers_that_merge_or_split_paragraphs_are_translated_one_at_a_time():
+    requests = []
+
+    def complete(messages, max_tokens):
+        text = messages[-1]["content"].split("\n\n", 1)[1]
+        requests.append(text)
+        if "\n\n" in text:
+            return text.upper().replace("\n\n", " ")  # Merged into one paragraph
+        return text.upper()
+
+    texts = ["One.", "Two.", "Three."]
+    assert translation.translate_group(texts, "tr", {}, complete) == ["ONE.", "TWO.", "THREE."]
+    assert requests == ["One.\n\nTwo.\n\nThree.", "One.", "Two.", "Three."]
+
+    # A given answer that matches is used as it is
+    requests.clear()
+    assert translation.translate_group(["One.", "Two."], "tr", {}, complete, answer="Bir.\n\nIki.") == ["Bir.", "Iki."]
+    assert requests == []
+    # A single paragraph that came back split is joined
+    assert translation.split_answer("Bir.\n\nIki.", ["One. Two."]) == ["Bir. Iki."]
+
+
+def test_translated_documents_keep_every_paragraph_and_mark():
+    document = StoryDocument.from_text("\n\n".join(f"Paragraph {i} " + "word " * 100 for i in range(12)))
+    glossaries = []
+
+    def complete(messages, max_tokens):
+        glossaries.append("Elara: Elara" in messages[-1]["content"])
+        return "\n\n".join(f"[{text}]" for text in messages[-1]["content"].split("\n\n")[1:])
+
+    translated = translation.translate_document(document, "tr", {"Elara": "Elara"}, complete)
+    assert [paragraph.mark for paragraph in translated.paragraphs] == [paragraph.mark for paragraph in document.paragraphs]
+    assert [paragraph.text for paragraph in translated.paragraphs] == [
+        f"[{paragraph.text}]" for paragraph in document.paragraphs
+    ]
+    assert len(glossaries) > 1 and all(glossaries)
@@ -0,0 +1,24 @@
+import random
+import pytest
+import fakes
+from story_document import StoryDocument
+from tts import VOICES_BY_KEY, SpeechRenderer
+
+
+def test_a_failed_render_stores_no_audio():
+    class FailingTextToSpeech(fakes.FakeTextToSpeech):
+        def synthesize_speech(self, request=None, **kwargs):
+            if '<mark name="page_20"/>' in request.input.ssml:
+                raise ValueError("synthesis failed")
+            return super().synthesize_speech(request=request, **kwargs)
+
+    bucket = fakes.FakeBucket()
+    text = fakes.fake_text(random.Random(2), paragraphs=20)
+    chunks = StoryDocument.from_text(text).tts_chunks(max_bytes=1000)
+    voice = VOICES_BY_KEY["young_woman_en"]
+    with pytest.raises(ValueError):
+        SpeechRenderer(FailingTextToSpeech(), bucket).render_voice(chunks, voice, "stories/audio.mp3")
+    assert bucket.list_blobs(prefix="stories/") == []
+
+    SpeechRenderer(fakes.FakeTextToSpeech(), bucket).render_voice(chunks, voice, "stories/audio.mp3")
+    assert bucket.get_blob("stories/audio.mp3") is not None
@@ -0,0 +1,148 @@
+"""Translation of stories, a few paragraphs per request.
+
+A story is split into groups of consecutive paragraphs that are translated
+concurrently and put back together in order, so translating a story takes
+about as long as translating one group, however long the story is. Names
+are translated once per story, into a glossary that every group's request
+gets, so that a character keeps the same name throughout the translation.
+"""
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from languages import LANGUAGES, NAME_EXAMPLES
+from story_document import Paragraph, StoryDocument
+
+# Paragraphs are grouped up to this many characters per request
+GROUP_CHARS = int(os.getenv("TRANSLATION_GROUP_CHARS", "1200"))
+
+# Groups of every story and language being translated are sent from this pool;
+# the number of requests in flight is limited by rate_limit.py
+translation_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("TRANSLATION_CONCURRENCY", "16")),
+    thread_name_prefix="translation"
+)
+
+_PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+
+
+def paragraph_groups(texts, max_chars=GROUP_CHARS):
+    """Split paragraph texts into lists of consecutive paragraphs of at most max_chars.
+
+    A paragraph longer than max_chars makes a group of its own.
+    """
+    groups = []
+    size = 0
+    for text in texts:
+        if groups and size + len(text) <= max_chars:
+            groups[-1].append(text)
+            size += len(text)
+        else:
+            groups.append([text])
+            size = len(text)
+    return groups
+
+
+def name_hint(language):
+    hint = f"Translate names phonetically so they are pronounceable in {LANGUAGES[language]}."
+    if language in NAME_EXAMPLES:
+        name, translated = NAME_EXAMPLES[language]
+        hint += f" For example, '{name}' should become '{translated}'."
+    return hint
+
+
+def glossary_messages(text, languages):
+    codes = ', '.join(f'"{code}" ({LANGUAGES[code]})' for code in languages)
+    return [
+        {"role": "system", "content": "You are a translator."},
+        {"role": "user", "content": (
+            f"List the names of the characters, places and things in the following story and translate each "
+            f"of them to these languages: {codes}. Translate them phonetically so they are pronounceable in "
+            f"each language. Answer with only a JSON object mapping every language code to an object that "
+            f"maps each name to its translation.\n\n{text}"
+        )}
+    ]
+
+
+def parse_glossary(content, languages):
+    """The glossary of every language in a glossary_messages answer; empty if it can't be parsed."""
+    start, end = content.find('{'), content.rfind('}')
+    try:
+        answer = json.loads(content[start:end + 1]) if start != -1 else {}
+    except ValueError:
+        answer = {}
+    glossary = {}
+    for language in languages:
+        names = answer.get(language) if isinstance(answer, dict) else None
+        glossary[language] = {str(name): str(translated) for name, translated in names.items()} \
+            if isinstance(names, dict) else {}
+    return glossary
+
+
+def group_messages(texts, language, glossary):
+    instructions = (
+        f"Translate the following part of a children's story to {LANGUAGES[language]}. "
+        f"It has {len(texts)} paragraph{'s' if len(texts) > 1 else ''}; keep them separated by blank lines "
+        f"and answer with only the translation. {name_hint(language)}"
+    )
+    if glossary:
+        instructions += " Use these translations of names: " + '; '.join(
+            f"{name}: {translated}" for name, translated in glossary.items()
+        ) + "."
+    return [
+        {"role": "system", "content": "You are a translator."},
+        {"role": "user", "content": f"{instructions}\n\n" + "\n\n".join(texts)}
+    ]
+
+
+def split_answer(answer, texts):
+    """The paragraphs of the translation of a group of texts, or None if there isn't one per text."""
+    paragraphs = [paragraph.strip() for paragraph in _PARAGRAPH_BREAK.split(answer.strip())]
+    if len(paragraphs) == len(texts):
+        return paragraphs
+    if len(texts) == 1:
+        return [' '.join(paragraphs)]
+    return None
+
+
+def group_max_tokens(texts):
+    return min(4000, 200 + sum(map(len, texts)))
+
+
+def translate_group(texts, language, glossary, complete, answer=None):
+    """Translate a group of paragraph texts; answer is the translation if it was already requested."""
+    if answer is None:
+        answer = complete(group_messages(texts, language, glossary), max_tokens=group_max_tokens(texts))
+    paragraphs = split_answer(answer, texts)
+    if paragraphs is not None:
+        return paragraphs
+    # The paragraphs were merged or split, so translate them one at a time to keep the pages aligned
+    return [paragraph for text in texts for paragraph in translate_group([text], language, glossary, complete)]
+
+
+def document_groups(document, max_chars=GROUP_CHARS):
+    """The groups of paragraph texts to translate of a StoryDocument.
+
+    Empty paragraphs are left out, the model would drop them.
+    """
+    return paragraph_groups([paragraph.text for paragraph in document.paragraphs if paragraph.text.strip()],
+                            max_chars)
+
+
+def with_translations(document, translated):
+    """The document with the translations of its document_groups texts, in order; every paragraph keeps its mark."""
+    translated = iter(translated)
+    return StoryDocument([
+        Paragraph(next(translated) if paragraph.text.strip() else paragraph.text, paragraph.mark)
+        for paragraph in document.paragraphs
+    ])
+
+
+def translate_document(document, language, glossary, complete):
+    """Translate a StoryDocument group by group, concurrently.
+
+    complete(messages, max_tokens) returns the text of a chat completion.
+    """
+    futures = [translation_executor.submit(translate_group, group, language, glossary, complete)
+               for group in document_groups(document)]
+    return with_translations(document, [paragraph for future in futures for paragraph in future.result()])
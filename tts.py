@@ -0,0 +1,183 @@
+"""Text-to-speech rendering of stories into MP3s in Cloud Storage.
+
+Shared by the generator, which renders the EAGER_VOICES of every new story,
+and by the story API, which renders any other voice the first time it is
+requested.
+"""
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+# v1beta1 is the Text-to-Speech API version that reports the time of SSML marks
+from google.cloud import texttospeech_v1beta1 as texttospeech
+from audio_cache import AudioCache
+from audio_index import AudioIndexBuilder
+from languages import STORY_LANGUAGES
+import metrics
+import rate_limit
+
+# Chunks of a story are synthesized in parallel on this pool
+tts_chunk_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("TTS_CHUNK_CONCURRENCY", "16")),
+    thread_name_prefix="tts-chunk"
+)
+
+# Chunks synthesized ahead of the one currently being written, per voice
+TTS_STREAM_WINDOW = int(os.getenv("TTS_STREAM_WINDOW", "8"))
+
+# Uploads are sent in parts of this size (must be a multiple of 256 KiB)
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+
+tts_chunk_seconds = metrics.histogram("storyteller_tts_chunk_seconds", "Latency of TTS requests, per chunk")
+tts_chunks_total = metrics.counter("storyteller_tts_chunks_total", "TTS chunks rendered, by audio cache result")
+gcs_upload_seconds = metrics.histogram("storyteller_gcs_upload_seconds", "Time spent uploading to Cloud Storage")
+bytes_transferred_total = metrics.counter("storyteller_bytes_transferred_total", "Bytes uploaded to Cloud Storage")
+
+# Define TTS voices with corrected gender for Turkish voices and more distinct old voices
+VOICES = [
+    {"name": "en-US-Wavenet-D", "gender": texttospeech.SsmlVoiceGender.MALE, "age": "young_man"},
+    {"name": "en-GB-Wavenet-A", "gender": texttospeech.SsmlVoiceGender.FEMALE, "age": "young_woman"},
+    {"name": "en-GB-Wavenet-D", "gender": texttospeech.SsmlVoiceGender.MALE, "age": "old_man"},
+    {"name": "en-US-Wavenet-C", "gender": texttospeech.SsmlVoiceGender.FEMALE, "age": "old_woman"},
+    {"name": "tr-TR-Wavenet-B", "gender": texttospeech.SsmlVoiceGender.MALE, "age": "young_man"},  # Corrected
+    {"name": "tr-TR-Wavenet-C", "gender": texttospeech.SsmlVoiceGender.FEMALE, "age": "young_woman"},  # Corrected
+    {"name": "tr-TR-Wavenet-E", "gender": texttospeech.SsmlVoiceGender.MALE, "age": "old_man"},
+    {"name": "tr-TR-Wavenet-D", "gender": texttospeech.SsmlVoiceGender.FEMALE, "age": "old_woman"},  # Corrected
+    {"name": "de-DE-Wavenet-B", "gender": texttospeech.SsmlVoiceGender.MALE, "age": "young_man"},
+    {"name": "de-DE-Wavenet-A", "gender": texttospeech.SsmlVoiceGender.FEMALE, "age": "young_woman"},
+    {"name": "de-DE-Wavenet-D", "gender": texttospeech.SsmlVoiceGender.MALE, "age": "old_man"},
+    {"name": "de-DE-Wavenet-C", "gender": texttospeech.SsmlVoiceGender.FEMALE, "age": "old_woman"},
+    {"name": "es-ES-Wavenet-B", "gender": texttospeech.SsmlVoiceGender.MALE, "age": "young_man"},
+    {"name": "es-ES-Wavenet-C", "gender": texttospeech.SsmlVoiceGender.FEMALE, "age": "young_woman"},
+    {"name": "fr-FR-Wavenet-B", "gender": texttospeech.SsmlVoiceGender.MALE, "age": "young_man"},
+    {"name": "fr-FR-Wavenet-A", "gender": texttospeech.SsmlVoiceGender.FEMALE, "age": "young_woman"},
+    {"name": "fr-FR-Wavenet-D", "gender": texttospeech.SsmlVoiceGender.MALE, "age": "old_man"},
+    {"name": "fr-FR-Wavenet-C", "gender": texttospeech.SsmlVoiceGender.FEMALE, "age": "old_woman"}
+]
+
+
+def voice_language(voice):
+    """The story language a voice reads, such as "en" or "tr"."""
+    return voice['name'].split('-')[0]
+
+
+def voice_key(voice):
+    return f'{voice["age"]}_{voice_language(voice)}'
+
+
+VOICES_BY_KEY = {voice_key(voice): voice for voice in VOICES}
+
+# Voices rendered when a story is generated (by default a young woman's in every
+# language); the others are rendered when first requested
+EAGER_VOICES = [key for key in os.getenv(
+    "EAGER_VOICES", ','.join(f"young_woman_{language}" for language in STORY_LANGUAGES)
+).split(',') if key]
+
+
+def voice_blob_name(genre, story_id, voice):
+    return f'stories/{genre}/{story_id}/{voice_language(voice)}/{voice["age"]}.mp3'
+
+
+def index_blob_name(audio_blob_name):
+    return audio_blob_name[:-len('.mp3')] + '.index.json'
+
+
+class SpeechRenderer:
+    """Renders SSML chunks to MP3 with a TTS client, caching chunk audio in an optional AudioCache."""
+
+    def __init__(self, client, bucket, cache=None):
+        self.client = client
+        self.bucket = bucket
+        self.cache = cache
+
+    def synthesize_chunk(self, chunk, voice, audio_config):
+        """Synthesize one SSML chunk within the TTS rate limits, retrying throttled requests.
+
+        Returns the audio and the (name, seconds) of every mark in the chunk.
+        """
+        cache_key = AudioCache.key(
+            chunk,
+            texttospeech.VoiceSelectionParams.serialize(voice),
+            texttospeech.AudioConfig.serialize(audio_config)
+        )
+        if self.cache is not None:
+            audio = self.cache.get(cache_key)
+            marks = self.cache.get(cache_key + '.marks')
+            if audio is not None and marks is not None:
+                tts_chunks_total.inc(cache="hit")
+                return audio, [tuple(mark) for mark in json.loads(marks)]
+        tts_chunks_total.inc(cache="miss")
+
+        synthesize_request = texttospeech.SynthesizeSpeechRequest(
+            input=texttospeech.SynthesisInput(ssml=chunk),
+            voice=voice,
+            audio_config=audio_config,
+            enable_time_pointing=[texttospeech.SynthesizeSpeechRequest.TimepointType.SSML_MARK]
+        )
+        def synthesize():
+            with tts_chunk_seconds.time():
+                return self.client.synthesize_speech(request=synthesize_request)
+
+        response = rate_limit.call("tts", synthesize)
+        marks = [(timepoint.mark_name, timepoint.time_seconds) for timepoint in response.timepoints]
+        if self.cache is not None:
+            self.cache.put(cache_key, response.audio_content)
+            self.cache.put(cache_key + '.marks', json.dumps(marks).encode('utf-8'))
+        return response.audio_content, marks
+
+    def iter_speech(self, chunks, language_code, name, gender):
+        """Yield the audio and marks of each SSML chunk in order while later chunks are still being synthesized."""
+        voice = texttospeech.VoiceSelectionParams(
+            language_code=language_code,
+            name=name,
+            ssml_gender=gender
+        )
+        audio_config = texttospeech.AudioConfig(
+            audio_encoding=texttospeech.AudioEncoding.MP3,
+            speaking_rate=0.9  # Adjust speaking rate to slow down the speech
+        )
+
+        # At most TTS_STREAM_WINDOW chunks are in flight or buffered at a time
+        pending = deque()
+        for chunk in chunks:
+            pending.append(tts_chunk_executor.submit(self.synthesize_chunk, chunk, voice, audio_config))
+            if len(pending) >= TTS_STREAM_WINDOW:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def stream_to_gcs(self, chunks, language_code, name, gender, file_path):
+        """Synthesize SSML chunks straight into a resumable upload, one chunk at a time.
+
+        Returns the URL of the audio and its page index (see audio_index.py).
+        """
+        blob = self.bucket.blob(file_path, chunk_size=UPLOAD_CHUNK_SIZE)
+        index = AudioIndexBuilder()
+        upload_seconds = 0.0
+        f = blob.open('wb', content_type='audio/mpeg')
+        try:
+            for audio, marks in self.iter_speech(chunks, language_code, name, gender):
+                index.add(audio, marks)
+                start = time.perf_counter()
+                f.write(audio)
+                upload_seconds += time.perf_counter() - start
+                bytes_transferred_total.inc(len(audio), kind="audio")
+        except BaseException:
+            # Cancel the upload; closing it would store the truncated audio at file_path
+            f.terminate()
+            raise
+        start = time.perf_counter()
+        f.close()
+        upload_seconds += time.perf_counter() - start
+        gcs_upload_seconds.observe(upload_seconds, kind="audio")
+        return {"url": blob.public_url, "index": index.index()}
+
+    def render_voice(self, chunks, voice, file_path):
+        """Render a voice to file_path, and its page index next to it (see index_blob_name)."""
+        result = self.stream_to_gcs(chunks, voice['name'][:5], voice['name'], voice['gender'], file_path)
+        # The index is written after the audio, so it marks a complete render
+        self.bucket.blob(index_blob_name(file_path)).upload_from_string(
+            json.dumps(result['index']), content_type='application/json'
+        )
+        return result